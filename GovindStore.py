@@ -12,8 +12,25 @@ import datetime as dt
 import cloudinary
 import cloudinary.uploader
 import random
+import threading
+import os
+import json
+import time
+import uuid
+import heapq
+import io
+import queue
+import re
+import zipfile
+import tempfile
+import functools
+import weakref
+import hmac
+import hashlib
 import smtplib
 from email.message import EmailMessage  
+from streamlit_cookies_manager import EncryptedCookieManager
+from PIL import Image, ImageOps
 from datetime import datetime, timedelta 
 
 
@@ -40,6 +57,7 @@ PAYMENT_TAB = "Payment"
 BILLING_TAB = "Billing"
 MEDICATION_MASTER_TAB = "Medication_Master"
 MEDICATION_LOG_TAB = "Medication_Log"
+MEDICATION_STOCK_TAB = "Medication_Stock"
 BANK_TRANSACTION_TAB="Bank_Transaction"
 WALLET_TRANSACTION_TAB="Wallet_Transaction"
 
@@ -57,6 +75,7 @@ def reset_Session_value():
     st.session_state.show_add_cow = False
     st.session_state.show_add_form = False
     st.session_state.show_give_medication = False
+    st.session_state.show_batch_treatment = False
     st.session_state.show_add_medicine = False
     st.session_state.show_edit_user = False
     st.session_state.show_edit_info = False
@@ -64,8 +83,8 @@ def reset_Session_value():
     st.session_state.show_change_password = False
     st.session_state.show_Bank_Transaction_form = False
 
-def init_gsheets():
-    creds_dict = dict(st.secrets["gcp_service_account"])
+def init_gsheets(creds_dict=None):
+    creds_dict = dict(creds_dict or st.secrets["gcp_service_account"])
     creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
 
     creds = Credentials.from_service_account_info(
@@ -101,7 +120,76 @@ def open_sheet(sheet_id: str, tab: str):
         return sh.worksheet(tab)
     except gspread.WorksheetNotFound:
         return sh.get_worksheet(0)
-        
+
+# ============================================================
+# SHEET LOADERS (CONTENT-VERSIONED CACHE)
+# ============================================================
+# id(frame) -> (weakref to frame, version) for frames handed out by sheet loaders
+_FRAME_VERSIONS = {}
+
+def row_hashes(df, start=0):
+    """Per-row content hashes weighted by 1-based position (start + 1, ...); uint64, wrapping."""
+    h = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return h * np.arange(start + 1, start + len(h) + 1, dtype=np.uint64)
+
+def content_version(df):
+    """
+    (rows, header hash, body checksum): changes exactly when the data does.
+    The body is a position-weighted sum of row hashes, so the checksum of
+    any prefix can be derived from it (prefix_checksum).
+    """
+    header = int(pd.util.hash_pandas_object(pd.Index(df.columns.astype(str)), index=False).sum())
+    if df.empty:
+        return (0, header, 0)
+    return (len(df), header, int(row_hashes(df).sum()))
+
+def prefix_checksum(df, n):
+    """Body checksum of df.iloc[:n], from frame_version(df) in O(len(df) - n)."""
+    body = frame_version(df)[2]
+    tail = int(row_hashes(df.iloc[n:], n).sum()) if len(df) > n else 0
+    return (body - tail) % 2**64
+
+def _remember_version(df, version):
+    key = id(df)
+    _FRAME_VERSIONS[key] = (weakref.ref(df), version)
+    weakref.finalize(df, _FRAME_VERSIONS.pop, key, None)
+    return df
+
+def frame_version(df):
+    """
+    Cache key for a frame. Frames returned by a sheet_loader carry the
+    content version computed once when the sheet was read (looked up by
+    identity, so copies and slices never inherit it); any other frame is
+    hashed here.
+    """
+    entry = _FRAME_VERSIONS.get(id(df))
+    if entry and entry[0]() is df:
+        return entry[1]
+    return content_version(df)
+
+def sheet_loader(ttl):
+    """
+    st.cache_data(ttl) for a function returning one sheet as a frame.
+    The content version is computed once per load and cached next to the
+    frame, so frame_version on the result is O(1) and stays the same
+    across reloads while the sheet is unchanged.
+    """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def read(*args):
+            df = fn(*args)
+            return df, content_version(df)
+
+        cached = st.cache_data(ttl=ttl)(read)
+
+        @functools.wraps(fn)
+        def load(*args):
+            return _remember_version(*cached(*args))
+
+        load.clear = cached.clear
+        return load
+    return wrap
+
 @st.cache_resource
 def open_customer_sheet():
     client = init_gsheets()
@@ -111,7 +199,7 @@ def open_customer_sheet():
     except gspread.WorksheetNotFound:
         return sh.worksheet(0)
 
-@st.cache_data(ttl=300)  # cache for 5 minutes
+@sheet_loader(ttl=300)  # cache for 5 minutes
 def get_customers_df():
     ws = open_customer_sheet()
     data = ws.get_all_values()
@@ -178,6 +266,18 @@ def safe_cell(val):
     return val
 
 
+EXPENSE_HEADER = [
+            "ExpenseID",
+            "Date",
+            "Category",
+            "CowID",
+            "Amount",
+            "PaymentMode",
+            "ExpenseBy",
+            "FileURL",
+            "Notes",
+            "Timestamp",
+        ]
 INVESTMENT_HEADER = [
             "InvestmentID",
             "Date",
@@ -189,6 +289,10 @@ INVESTMENT_HEADER = [
             "Notes",
             "Timestamp",
         ]
+PAYMENT_HEADER = [
+            "PaymentID","BillID","CustomerID","CustomerName",
+            "PaidAmount","PaymentMode","ReceivedBy","ReceivedOn","Remarks"
+        ]
 BILLING_HEADER = [
             "BillID","CustomerID","CustomerName",
             "FromDate","ToDate",
@@ -269,6 +373,21 @@ COW_HEADER = [
 ]
 
 
+# =======================
+# 📦 Medication Stock Header
+# =======================
+
+MEDICATION_STOCK_HEADER = [
+    "MovementID",
+    "MedicineID",
+    "MovementType",   # PURCHASE / DOSE / ADJUSTMENT
+    "Quantity",       # signed: + in, - out
+    "RefID",
+    "Notes",
+    "CreatedBy",
+    "CreatedOn"
+]
+
 # =======================
 # 💊 Medication Log Header
 # =======================
@@ -293,7 +412,7 @@ MEDICATION_LOG_HEADER = [
 # LOAD AUTH DATA
 # ============================================================
 
-@st.cache_data(ttl=30)
+@sheet_loader(ttl=30)
 def load_bills():
     ws = open_billing_sheet()
     rows = ws.get_all_values()
@@ -322,7 +441,70 @@ def load_auth_data():
     df.columns = df.columns.astype(str).str.strip().str.lower()
     return df
 
-auth_df = load_auth_data()
+# ---------- USER DIRECTORY (INDEXED AUTH TABLE) ----------
+USER_DIRECTORY_TTL = 300  # seconds before the auth sheet is read again
+
+@st.cache_resource
+def get_user_directory():
+    # by_username / by_userid point at the same record dicts; "_row" is the sheet row
+    return {"lock": threading.Lock(), "built": 0.0, "columns": [], "by_username": {}, "by_userid": {}}
+
+def _index_users(directory, df):
+    records = [dict(r, _row=i + 2) for i, r in enumerate(df.to_dict("records"))]
+    directory["columns"] = df.columns.tolist()
+    directory["by_userid"] = {str(r["userid"]): r for r in records}
+    directory["by_username"] = {str(r["username"]): r for r in records}
+    directory["built"] = time.time()
+
+def user_directory():
+    directory = get_user_directory()
+    with directory["lock"]:
+        if not directory["columns"] or time.time() - directory["built"] > USER_DIRECTORY_TTL:
+            load_auth_data.clear()
+            _index_users(directory, load_auth_data())
+    return directory
+
+def find_user(username=None, userid=None):
+    """Auth record (dict, lowercase keys + "_row") by username or userid; None if unknown."""
+    directory = user_directory()
+    if username is not None:
+        return directory["by_username"].get(str(username))
+    return directory["by_userid"].get(str(userid))
+
+def user_name(userid, default=""):
+    user = find_user(userid=userid)
+    return user["name"] if user else default
+
+def user_col(col_name):
+    """1-based auth-sheet column of col_name (headers are matched lowercase)."""
+    return user_directory()["columns"].index(col_name.lower()) + 1
+
+def users_df():
+    directory = user_directory()
+    with directory["lock"]:
+        records = sorted(directory["by_userid"].values(), key=lambda r: r["_row"])
+    return pd.DataFrame(records, columns=directory["columns"] + ["_row"])
+
+def dairy_users_df():
+    df = users_df()
+    return df[
+        df["accesslevel"].fillna("").astype(str).str.contains(r"\bdairy\b", case=False)
+    ][["userid", "name"]]
+
+def upsert_user(userid, **fields):
+    """Apply a write just made to the auth sheet to the in-memory directory."""
+    directory = user_directory()
+    with directory["lock"]:
+        user = directory["by_userid"].get(str(userid))
+        if user is None:
+            rows = [r["_row"] for r in directory["by_userid"].values()]
+            user = {c: "" for c in directory["columns"]}
+            user.update(userid=userid, _row=max(rows, default=1) + 1)
+            directory["by_userid"][str(userid)] = user
+        else:
+            directory["by_username"].pop(str(user["username"]), None)
+        user.update(fields)
+        directory["by_username"][str(user["username"])] = user
 
 def open_wallet_sheet():
             return open_sheet(MAIN_SHEET_ID, WALLET_TRANSACTION_TAB)
@@ -342,6 +524,439 @@ def verify_password(stored_hash, password):
 def generate_otp():
     return str(random.randint(100000, 999999))
 
+# ============================================================
+# LOCAL STATE DIR (JOURNAL / UPLOAD QUEUE / LOGIN THROTTLE)
+# ============================================================
+def state_dir():
+    """
+    Writable directory for files that must survive a restart: the
+    STATE_DIR secret or GOVINDSTORE_STATE_DIR env var, else
+    $XDG_STATE_HOME/govindstore (~/.local/state/govindstore), else the
+    system temp dir. None when none is writable; callers then keep their
+    state in memory only.
+    """
+    try:
+        configured = st.secrets.get("STATE_DIR")
+    except Exception:
+        configured = None
+    candidates = [
+        configured or os.environ.get("GOVINDSTORE_STATE_DIR"),
+        os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), "govindstore"),
+        os.path.join(tempfile.gettempdir(), "govindstore"),
+    ]
+    for path in filter(None, candidates):
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(path, os.W_OK):
+            return path
+    return None
+
+STATE_DIR = state_dir()
+
+def state_path(name):
+    return os.path.join(STATE_DIR, name) if STATE_DIR else None
+
+# ============================================================
+# ATTACHMENT UPLOADS (DOWNSCALE + BACKGROUND WORKER)
+# ============================================================
+UPLOAD_MAX_SIDE = 1600      # px, longest side kept for photos
+UPLOAD_JPEG_QUALITY = 80
+UPLOAD_RETRIES = 5
+# queued files (<id>.bin) and their job state (<id>.json) survive restarts here (None = memory only)
+UPLOAD_DIR = state_path(".pending_uploads")
+
+class UploadRejected(Exception):
+    """The target row cannot safely take the URL; retrying will not help."""
+
+# sheet column (1-based) that receives the uploaded file's URL, matched by the ID in column A
+FILE_URL_COLUMNS = {
+    EXPENSE_TAB: EXPENSE_HEADER.index("FileURL") + 1,
+    INVESTMENT_TAB: INVESTMENT_HEADER.index("FileURL") + 1,
+    MEDICATION_MASTER_TAB: MEDECINE_HEADER.index("MedicineImageURL") + 1,
+    BANK_TRANSACTION_TAB: len(BANK_TRANSACTION_HEADER) + 1,  # document URL follows Timestamp
+}
+
+def prepare_upload(file):
+    """
+    (bytes, filename) for an uploaded file. Photos are EXIF-rotated,
+    shrunk to UPLOAD_MAX_SIDE and re-encoded as JPEG when that is smaller;
+    PDFs and undecodable files pass through untouched.
+    """
+    data, name = file.getvalue(), file.name
+    if (getattr(file, "type", "") or "").startswith("image/"):
+        try:
+            img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+            img.thumbnail((UPLOAD_MAX_SIDE, UPLOAD_MAX_SIDE))
+            out = io.BytesIO()
+            img.convert("RGB").save(out, "JPEG", quality=UPLOAD_JPEG_QUALITY, optimize=True, progressive=True)
+            if out.tell() < len(data):
+                data, name = out.getvalue(), os.path.splitext(name)[0] + ".jpg"
+        except Exception:
+            pass
+    return data, name
+
+def cloudinary_upload(data, folder):
+    return upload_to_cloudinary(io.BytesIO(data), folder)
+
+def _upload_path(uploads, job_id, ext):
+    return os.path.join(uploads["dir"], f"{job_id}.{ext}")
+
+def save_upload_job(uploads, job):
+    """
+    Write the job's state (everything but the file bytes) next to its .bin.
+    Best effort: jobs whose file could not be stored stay in memory only.
+    """
+    if not uploads["dir"] or job.get("in_memory"):
+        return
+    meta = {k: v for k, v in job.items() if k != "data"}
+    tmp = _upload_path(uploads, job["id"], "json.tmp")
+    try:
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, _upload_path(uploads, job["id"], "json"))
+    except OSError:
+        pass
+
+def drop_upload_job(uploads, job_id):
+    if not uploads["dir"]:
+        return
+    for ext in ("bin", "json"):
+        try:
+            os.remove(_upload_path(uploads, job_id, ext))
+        except OSError:
+            pass
+
+def load_upload_jobs(directory):
+    jobs = []
+    for fn in sorted(os.listdir(directory)):
+        if not fn.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, fn)) as f:
+                job = json.load(f)
+            with open(os.path.join(directory, fn[:-5] + ".bin"), "rb") as f:
+                job["data"] = f.read()
+        except (OSError, ValueError):
+            continue
+        jobs.append(job)
+    return jobs
+
+def write_file_url(ws, tab, row_id, url):
+    """
+    Put url in the FileURL cell of the one row whose column A is row_id.
+    LookupError until the row has landed; UploadRejected if the ID is not
+    unique or the cell already holds another file.
+    """
+    rows = [i + 1 for i, v in enumerate(ws.col_values(1)) if v == row_id]
+    if not rows:
+        raise LookupError(f"{row_id} is not in {tab} yet")
+    if len(rows) > 1:
+        raise UploadRejected(f"{row_id} matches {len(rows)} rows in {tab}")
+
+    col = FILE_URL_COLUMNS[tab]
+    current = ws.cell(rows[0], col).value
+    if current and current != url:
+        raise UploadRejected(f"{tab} {row_id} already has a different file")
+    ws.update_cell(rows[0], col, url)
+
+def upload_worker(uploads, upload, open_ws):
+    """
+    Upload queued files, then write the URL into every target row.
+    A failure at either step re-queues the job with backoff; the URL is
+    kept so a retry after a failed write-back does not upload again.
+    After UPLOAD_RETRIES attempts (or a rejected row) the job is kept in
+    uploads["failed"] for the page that created the record.
+    """
+    q = uploads["queue"]
+    while True:
+        job = q.get()
+        try:
+            if not job["url"]:
+                job["url"] = upload(job["data"], job["folder"])
+                save_upload_job(uploads, job)
+
+            while job["targets"]:
+                tab, row_id = job["targets"][0]
+                write_file_url(open_ws(tab), tab, row_id, job["url"])
+                job["targets"].pop(0)
+                save_upload_job(uploads, job)
+
+            with uploads["lock"]:
+                uploads["done"] += 1
+            drop_upload_job(uploads, job["id"])
+        except Exception as e:
+            job["attempts"] += 1
+            job["error"] = str(e)
+            final = isinstance(e, UploadRejected) or job["attempts"] >= UPLOAD_RETRIES
+            with uploads["lock"]:
+                uploads["last_error"] = f"{job['name']}: {e}"
+                if final:
+                    job["status"] = "failed"
+                    uploads["failed"][job["id"]] = job
+            save_upload_job(uploads, job)
+            if final:
+                continue
+            retry = threading.Timer(min(2 ** job["attempts"] + random.random(), 120), q.put, args=(job,))
+            retry.daemon = True
+            retry.start()
+        finally:
+            q.task_done()
+
+def start_upload_queue(upload, open_ws, directory=None):
+    """
+    Upload queue + worker thread. `upload(data, folder)` returns the file
+    URL; `open_ws(tab)` returns a worksheet. Both are injectable for tests.
+    With `directory`, jobs are persisted there and resumed on start.
+    """
+    uploads = {
+        "queue": queue.Queue(),
+        "lock": threading.Lock(),
+        "dir": directory,
+        "done": 0,
+        "failed": {},   # job id -> job
+        "last_error": None,
+    }
+    if directory:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            jobs = load_upload_jobs(directory)
+        except OSError:
+            uploads["dir"], jobs = None, []  # unwritable: keep the queue in memory only
+        for job in jobs:
+            if job.get("status") == "failed":
+                uploads["failed"][job["id"]] = job
+            else:
+                uploads["queue"].put(job)
+    threading.Thread(target=upload_worker, args=(uploads, upload, open_ws), name="uploads", daemon=True).start()
+    return uploads
+
+@st.cache_resource
+def get_upload_queue():
+    creds_dict = dict(st.secrets["gcp_service_account"])  # read here, not in the worker thread
+    sheets = {}
+
+    def open_ws(tab):
+        if tab not in sheets:
+            if "book" not in sheets:
+                sheets["book"] = init_gsheets(creds_dict).open_by_key(MAIN_SHEET_ID)
+            sheets[tab] = sheets["book"].worksheet(tab)
+        return sheets[tab]
+
+    return start_upload_queue(cloudinary_upload, open_ws, UPLOAD_DIR)
+
+def queue_upload(file, folder, targets, uploads=None):
+    """
+    Shrink `file` now and upload it in the background; its URL is written
+    to each (tab, row ID) in `targets` once the upload finishes.
+    The file is on disk before this returns, so a restart does not lose it.
+    """
+    uploads = uploads or get_upload_queue()
+    data, name = prepare_upload(file)
+    job = {
+        "id": uuid.uuid4().hex,
+        "data": data,
+        "name": name,
+        "folder": folder,
+        "targets": [list(t) for t in targets],
+        "records": [list(t) for t in targets],
+        "url": "",
+        "attempts": 0,
+        "status": "pending",
+        "error": None,
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if uploads["dir"]:
+        try:
+            with open(_upload_path(uploads, job["id"], "bin"), "wb") as f:
+                f.write(data)
+        except OSError:
+            job["in_memory"] = True
+        save_upload_job(uploads, job)
+    uploads["queue"].put(job)
+
+def retry_upload(job_id, uploads=None):
+    uploads = uploads or get_upload_queue()
+    with uploads["lock"]:
+        job = uploads["failed"].pop(job_id, None)
+    if job:
+        job.update(status="pending", attempts=0, error=None)
+        save_upload_job(uploads, job)
+        uploads["queue"].put(job)
+
+def dismiss_upload(job_id, uploads=None):
+    uploads = uploads or get_upload_queue()
+    with uploads["lock"]:
+        uploads["failed"].pop(job_id, None)
+    drop_upload_job(uploads, job_id)
+
+def upload_failure_notice(tab):
+    """Failed attachment uploads for records in `tab`, with retry / dismiss buttons."""
+    uploads = get_upload_queue()
+    with uploads["lock"]:
+        jobs = [j for j in uploads["failed"].values() if any(t == tab for t, _ in j["records"])]
+
+    for job in jobs:
+        ids = ", ".join(r for t, r in job["records"] if t == tab)
+        st.warning(
+            f"⚠️ Attachment **{job['name']}** for {ids} (saved {job['created']}) "
+            f"was not uploaded: {job['error']}"
+        )
+        c1, c2 = st.columns(2)
+        if c1.button("🔁 Retry upload", key=f"upload_retry_{tab}_{job['id']}"):
+            retry_upload(job["id"], uploads)
+            st.rerun()
+        if c2.button("🗑️ Dismiss", key=f"upload_dismiss_{tab}_{job['id']}"):
+            dismiss_upload(job["id"], uploads)
+            st.rerun()
+
+THUMB_SIZE = 96   # px, longest side of card thumbnails (2x the largest on-card size)
+
+def thumbnail_url(url, size=THUMB_SIZE):
+    """
+    Cloudinary delivery URL for a size-limited preview of `url`; PDFs
+    render their first page as JPEG. None for anything that cannot be
+    transformed (raw uploads, non-Cloudinary links).
+    """
+    if not isinstance(url, str) or "res.cloudinary.com" not in url or "/image/upload/" not in url:
+        return None
+    transform = f"c_limit,w_{size},h_{size},q_auto"
+    base, ext = os.path.splitext(url)
+    if ext.lower() == ".pdf":
+        url, transform = base + ".jpg", transform + ",pg_1"
+    else:
+        transform += ",f_auto"
+    return url.replace("/image/upload/", f"/image/upload/{transform}/", 1)
+
+def attachment_html(url, icon, px=28, style=""):
+    """
+    Card attachment link: a lazy-loaded thumbnail when one can be derived,
+    else the icon. The full file is only fetched when the link is opened.
+    """
+    if not isinstance(url, str) or not url.strip():
+        return ""
+    thumb = thumbnail_url(url)
+    inner = (
+        f"<img src='{thumb}' loading='lazy' decoding='async' alt='{icon}' "
+        f"style='width:{px}px;height:{px}px;object-fit:cover;border-radius:4px;vertical-align:middle;'>"
+        if thumb else icon
+    )
+    return f"<a href='{url}' target='_blank' style='text-decoration:none;{style}'>{inner}</a>"
+
+# ============================================================
+# OUTBOUND MAIL QUEUE (BACKGROUND SMTP)
+# ============================================================
+MAIL_HOST = "smtp.gmail.com"
+MAIL_PORT = 465
+MAIL_BATCH = 20        # messages sent per connection check-out
+MAIL_RETRIES = 4
+MAIL_IDLE_CLOSE = 60   # seconds an idle connection is kept open
+MAIL_STATUS_KEEP = 500 # delivery states remembered for mail_status()
+
+def smtp_ssl_factory(host, port, user, password):
+    def connect():
+        smtp = smtplib.SMTP_SSL(host, port, timeout=30)
+        smtp.login(user, password)
+        return smtp
+    return connect
+
+def _close_smtp(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        pass
+
+def mail_worker(outbox, connect):
+    """
+    Drain outbox["queue"] in batches over one reused SMTP connection.
+    A failed send drops the connection and is re-queued with backoff,
+    up to MAIL_RETRIES attempts; then the message is marked failed and
+    listed in outbox["failed"].
+    """
+    q, smtp = outbox["queue"], None
+    while True:
+        try:
+            batch = [q.get(timeout=MAIL_IDLE_CLOSE)]
+        except queue.Empty:
+            if smtp is not None:
+                _close_smtp(smtp)
+                smtp = None
+            continue
+
+        while len(batch) < MAIL_BATCH:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+
+        for item in batch:
+            try:
+                if smtp is None:
+                    smtp = connect()
+                smtp.send_message(item["msg"])
+                with outbox["lock"]:
+                    outbox["sent"] += 1
+                    outbox["status"][item["id"]] = ("sent", None)
+            except Exception as e:
+                if smtp is not None:
+                    _close_smtp(smtp)
+                    smtp = None
+                item["attempts"] += 1
+                with outbox["lock"]:
+                    outbox["last_error"] = str(e)
+                    if item["attempts"] >= MAIL_RETRIES:
+                        outbox["status"][item["id"]] = ("failed", str(e))
+                        outbox["failed"].append({
+                            "To": item["msg"]["To"],
+                            "Subject": item["msg"]["Subject"],
+                            "Error": str(e),
+                            "FailedAt": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        })
+                        continue
+                retry = threading.Timer(min(2 ** item["attempts"] + random.random(), 60), q.put, args=(item,))
+                retry.daemon = True
+                retry.start()
+            finally:
+                q.task_done()
+
+def start_mail_queue(connect):
+    """Outbox + worker thread; `connect` returns a logged-in SMTP client."""
+    outbox = {
+        "queue": queue.Queue(),
+        "lock": threading.Lock(),
+        "sent": 0,
+        "failed": [],
+        "status": {},   # message id -> ("queued" | "sent" | "failed", error)
+        "last_error": None,
+    }
+    threading.Thread(target=mail_worker, args=(outbox, connect), name="mail", daemon=True).start()
+    return outbox
+
+@st.cache_resource
+def get_mail_queue():
+    # secrets are read here, on the script thread
+    return start_mail_queue(smtp_ssl_factory(
+        MAIL_HOST, MAIL_PORT, st.secrets["EMAIL_USER"], st.secrets["EMAIL_PASS"]
+    ))
+
+def queue_mail(msg, outbox=None):
+    """Hand msg to the mail worker and return at once with its id for mail_status()."""
+    outbox = outbox or get_mail_queue()
+    mail_id = uuid.uuid4().hex
+    with outbox["lock"]:
+        outbox["status"][mail_id] = ("queued", None)
+        for k in list(outbox["status"])[:-MAIL_STATUS_KEEP]:
+            del outbox["status"][k]
+    outbox["queue"].put({"id": mail_id, "msg": msg, "attempts": 0})
+    return mail_id
+
+def mail_status(mail_id, outbox=None):
+    """("queued" | "sent" | "failed", error) for a queue_mail() id."""
+    outbox = outbox or get_mail_queue()
+    with outbox["lock"]:
+        return outbox["status"].get(mail_id, ("failed", "unknown message (server restarted?)"))
+
 def send_otp_email(email, otp):
     msg = EmailMessage()
     msg["Subject"] = "Password Reset OTP"
@@ -356,12 +971,7 @@ Valid for 5 minutes.
 
 If you did not request this, please ignore this email.
 """)
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(
-            st.secrets["EMAIL_USER"],
-            st.secrets["EMAIL_PASS"]
-        )
-        smtp.send_message(msg)
+    return queue_mail(msg)
 
 
 def send_temp_password_email(to_email,name, username, temp_password):
@@ -388,9 +998,7 @@ def send_temp_password_email(to_email,name, username, temp_password):
         Dairy Farm Management Team
         """)
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(st.secrets["EMAIL_USER"], st.secrets["EMAIL_PASS"])
-        smtp.send_message(msg)
+    return queue_mail(msg)
 
 
 
@@ -417,11 +1025,212 @@ def get_col_index(df, col_name):
 for k, v in defaults.items():
     st.session_state.setdefault(k, v)
 
+# ============================================================
+# SIGNED SESSION TOKENS (SKIP LOGIN ON RECONNECT)
+# ============================================================
+SESSION_TTL = 7 * 24 * 3600  # seconds
+SESSION_COOKIE = "session"
+SESSION_FIELDS = ["user_id", "username", "user_name", "user_role", "user_accesslevel"]
+
+def session_secret():
+    secret = st.secrets.get("SESSION_SECRET") or st.secrets["gcp_service_account"]["private_key"]
+    return hashlib.sha256(str(secret).encode()).digest()
+
+def sign_token(payload):
+    return hmac.new(session_secret(), payload.encode(), hashlib.sha256).hexdigest()
+
+@st.cache_resource
+def get_token_store():
+    # token_id -> {"expires": epoch seconds, "profile": {SESSION_FIELDS...}}
+    return {"lock": threading.Lock(), "tokens": {}}
+
+def issue_session_token(profile):
+    """New "<id>.<expires>.<hmac>" token whose profile lives server-side until it expires."""
+    store = get_token_store()
+    now = int(time.time())
+    token_id = uuid.uuid4().hex
+    expires = now + SESSION_TTL
+
+    with store["lock"]:
+        for k in [k for k, v in store["tokens"].items() if v["expires"] < now]:
+            del store["tokens"][k]
+        store["tokens"][token_id] = {"expires": expires, "profile": dict(profile)}
+
+    payload = f"{token_id}.{expires}"
+    return f"{payload}.{sign_token(payload)}"
+
+def validate_session_token(token):
+    """Profile for a valid, unexpired, unrevoked token; None otherwise."""
+    parts = (token or "").split(".")
+    if len(parts) != 3 or not parts[1].isdigit():
+        return None
+
+    token_id, expires, sig = parts
+    if not hmac.compare_digest(sig, sign_token(f"{token_id}.{expires}")):
+        return None
+    if int(expires) < time.time():
+        return None
+
+    store = get_token_store()
+    with store["lock"]:
+        entry = store["tokens"].get(token_id)
+    if entry is None or entry["expires"] < time.time():
+        return None
+    return entry["profile"]
+
+def revoke_session_token(token):
+    store = get_token_store()
+    with store["lock"]:
+        store["tokens"].pop((token or "").split(".")[0], None)
+
+def revoke_user_sessions(user_id):
+    store = get_token_store()
+    with store["lock"]:
+        for k in [k for k, v in store["tokens"].items() if v["profile"]["user_id"] == user_id]:
+            del store["tokens"][k]
+
+def session_profile():
+    return {k: st.session_state[k] for k in SESSION_FIELDS}
+
+cookies = EncryptedCookieManager(prefix="govindstore/", password=session_secret().hex())
+if not cookies.ready():
+    st.stop()
+
+# returning browser: restore the session from the cookie, no sheet read, no bcrypt
+if not st.session_state.authenticated:
+    profile = validate_session_token(cookies.get(SESSION_COOKIE))
+    if profile:
+        for k, v in profile.items():
+            st.session_state[k] = v
+        st.session_state.authenticated = True
+        st.session_state.session_token = cookies.get(SESSION_COOKIE)
+
+# ============================================================
+# LOGIN THROTTLE (TOKEN BUCKETS)
+# ============================================================
+# rule -> (burst, seconds to refill one attempt)
+THROTTLE_RULES = {
+    "login_user": (5, 60),
+    "login_client": (20, 30),
+    "otp_user": (3, 600),
+    "otp_client": (5, 600),
+    "verify_user": (5, 60),
+}
+# buckets survive a restart through this file; None keeps them in memory only
+THROTTLE_PATH = state_path(".login_throttle.json")
+THROTTLE_SAVE_EVERY = 5  # seconds
+TRUSTED_PROXY_HOPS = 1   # reverse proxies in front of the app that append to X-Forwarded-For
+
+def take_token(bucket, burst, refill, now):
+    """
+    Refill `bucket` ({"tokens", "ts"}) up to `now` and spend one token.
+    Returns 0 when the attempt is allowed, else seconds until it would be.
+    """
+    bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["ts"]) / refill)
+    bucket["ts"] = now
+    if bucket["tokens"] >= 1:
+        bucket["tokens"] -= 1
+        return 0
+    return (1 - bucket["tokens"]) * refill
+
+def valid_buckets(raw):
+    """Buckets from the throttle file that match a current rule; anything else is dropped."""
+    buckets = {}
+    if not isinstance(raw, dict):
+        return buckets
+    for key, b in raw.items():
+        if not isinstance(key, str) or key.split(":", 1)[0] not in THROTTLE_RULES or not isinstance(b, dict):
+            continue
+        try:
+            buckets[key] = {"tokens": float(b["tokens"]), "ts": float(b["ts"])}
+        except (KeyError, TypeError, ValueError):
+            continue
+    return buckets
+
+@st.cache_resource
+def get_throttle_store():
+    buckets = {}
+    if THROTTLE_PATH and os.path.exists(THROTTLE_PATH):
+        try:
+            with open(THROTTLE_PATH) as f:
+                buckets = valid_buckets(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return {"lock": threading.Lock(), "buckets": buckets, "saved": 0.0}
+
+def save_throttle(store, now):
+    """Write buckets still below full to THROTTLE_PATH; full ones are the default."""
+    live = {}
+    for key, b in list(store["buckets"].items()):
+        rule = THROTTLE_RULES.get(key.split(":", 1)[0])
+        if rule is None:
+            continue
+        burst, refill = rule
+        if b["tokens"] + (now - b["ts"]) / refill < burst:
+            live[key] = b
+    store["buckets"] = live
+    store["saved"] = now
+    if THROTTLE_PATH:
+        tmp = THROTTLE_PATH + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(live, f)
+        os.replace(tmp, THROTTLE_PATH)
+
+def throttle(rule, ident, store=None, now=None):
+    """Spend one `rule` attempt for `ident`; returns seconds to wait (0 = go ahead)."""
+    store = store or get_throttle_store()
+    now = time.time() if now is None else now
+    burst, _ = THROTTLE_RULES[rule]
+    key = f"{rule}:{str(ident).strip().lower()}"
+
+    with store["lock"]:
+        bucket = store["buckets"].setdefault(key, {"tokens": burst, "ts": now})
+        wait = take_token(bucket, *THROTTLE_RULES[rule], now)
+        if now - store["saved"] >= THROTTLE_SAVE_EVERY:
+            try:
+                save_throttle(store, now)
+            except OSError:
+                pass  # read-only host: keep throttling in memory
+    return wait
+
+def client_key():
+    """
+    Caller address as seen by our own proxy: the X-Forwarded-For entry
+    appended TRUSTED_PROXY_HOPS hops from the right (entries further left
+    are client-supplied and can be forged), else the socket peer, else
+    this browser session. The per-username bucket is the backstop.
+    """
+    try:
+        hops = int(st.secrets.get("TRUSTED_PROXY_HOPS", TRUSTED_PROXY_HOPS))
+    except Exception:
+        hops = TRUSTED_PROXY_HOPS
+    try:
+        forwarded = [a.strip() for a in st.context.headers.get("X-Forwarded-For", "").split(",") if a.strip()]
+        if hops and len(forwarded) >= hops:
+            return forwarded[-hops]
+        ip = getattr(st.context, "ip_address", None)
+        if ip:
+            return ip
+    except Exception:
+        pass
+    return st.session_state.setdefault("_client_key", uuid.uuid4().hex)
+
+def throttled(*checks):
+    """
+    Run (rule, ident) checks; show an error and stop the run if any bucket
+    is empty. Every check is charged, so a client cycling through usernames
+    still runs out of its own attempts.
+    """
+    wait = max(throttle(rule, ident) for rule, ident in checks)
+    if wait:
+        st.error(f"⏳ Too many attempts. Try again in {int(wait) + 1} seconds.")
+        st.stop()
+
 
 def open_bank_sheet():
     return open_sheet(MAIN_SHEET_ID, BANK_TRANSACTION_TAB)
 
-@st.cache_data(ttl=30)
+@sheet_loader(ttl=30)
 def load_wallet_df():
     ws = open_wallet_sheet()
     rows = ws.get_all_values()
@@ -434,6 +1243,35 @@ def load_wallet_df():
 
 
 @st.cache_data(ttl=30)
+def load_wallet_ref_rows():
+    """RefID → sheet row numbers (both legs of a transfer share one RefID)."""
+    df = load_wallet_df()
+    if df.empty:
+        return {}
+    return {
+        ref: (idx + 2).tolist()
+        for ref, idx in df.groupby("RefID").groups.items()
+        if str(ref).strip()
+    }
+
+def set_wallet_status(ref_id, status):
+    """Write `status` into exactly the TxnStatus cells of ref_id's rows, in one call."""
+    rows = load_wallet_ref_rows().get(ref_id, [])
+    if not rows:
+        return 0
+
+    col = WALLET_HEADER.index("TxnStatus") + 1
+    open_wallet_sheet().batch_update(
+        [
+            {"range": gspread.utils.rowcol_to_a1(r, col), "values": [[status]]}
+            for r in rows
+        ],
+        value_input_option="USER_ENTERED"
+    )
+    return len(rows)
+
+
+@sheet_loader(ttl=30)
 def load_bank_transactions():
     ws = open_bank_sheet()
     rows = ws.get_all_values()
@@ -448,20 +1286,131 @@ def load_bank_transactions():
     return pd.DataFrame(rows[1:], columns=rows[0])
 
 
-def get_current_bank_balance(bank_df: pd.DataFrame) -> float:
+# ---------- BANK LEDGER (RUNNING BALANCE) ----------
+def build_bank_ledger(bank_df: pd.DataFrame) -> dict:
+    """
+    Recompute running balances from Amount and TransactionType, ordered by
+    TransactionDate then Timestamp (back-dated rows land in place).
+    The seed is the OpeningBalance of the first sheet row.
+    Returns rows (date-indexed, with SheetRow / CalcOpening / CalcClosing /
+    Mismatch), sorted dates + closing arrays for searchsorted lookups,
+    month-end checkpoints and the current balance. Rows with neither a
+    TransactionDate nor a Timestamp cannot be placed in time; they are
+    left out of the ledger and returned as "undated".
+    """
+    empty = {
+        "rows": pd.DataFrame(columns=list(bank_df.columns) + ["SheetRow", "CalcOpening", "CalcClosing", "Mismatch"]),
+        "dates": np.array([], dtype="datetime64[ns]"),
+        "closing": np.array([], dtype=float),
+        "seed": 0.0,
+        "checkpoints": pd.Series(dtype=float),
+        "balance": 0.0,
+        "undated": bank_df.iloc[:0],
+    }
     if bank_df.empty:
-        return 0.0
-    return float(bank_df.iloc[-1]["ClosingBalance"])
+        return empty
+
+    df = bank_df.copy()
+    df["SheetRow"] = df.index + 2
+    for col in ["Amount", "OpeningBalance", "ClosingBalance"]:
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+
+    ts = pd.to_datetime(df["Timestamp"], errors="coerce")
+    df["TransactionDate"] = (
+        pd.to_datetime(df["TransactionDate"], errors="coerce")
+        .fillna(ts)
+        .dt.normalize()
+    )
+    df["_ts"] = ts
+
+    seed = float(df["OpeningBalance"].iloc[0])
+
+    undated = df[df["TransactionDate"].isna()].drop(columns=["_ts"])
+    df = df[df["TransactionDate"].notna()]
+    if df.empty:
+        return dict(empty, seed=seed, balance=seed, undated=undated)
+
+    df = df.sort_values(["TransactionDate", "_ts"], kind="mergesort", na_position="last")
+
+    signed = np.where(df["TransactionType"] == "CREDIT", df["Amount"], -df["Amount"])
+    df["CalcClosing"] = (seed + np.cumsum(signed)).round(2)
+    df["CalcOpening"] = (df["CalcClosing"] - signed).round(2)
+    df["Mismatch"] = (
+        (df["OpeningBalance"] - df["CalcOpening"]).abs().gt(0.005)
+        | (df["ClosingBalance"] - df["CalcClosing"]).abs().gt(0.005)
+    )
+
+    df = df.drop(columns=["_ts"])
+    df.index = pd.DatetimeIndex(df["TransactionDate"], name="_Date")
+
+    checkpoints = df["CalcClosing"].groupby(
+        df.index.to_period("M").to_timestamp(how="end").normalize()
+    ).last()
+
+    return {
+        "rows": df,
+        "dates": df.index.to_numpy(),
+        "closing": df["CalcClosing"].to_numpy(),
+        "seed": seed,
+        "checkpoints": checkpoints,
+        "balance": float(df["CalcClosing"].iloc[-1]),
+        "undated": undated,
+    }
 
 @st.cache_data(ttl=30)
+def load_bank_ledger():
+    return build_bank_ledger(load_bank_transactions())
+
+def balance_as_of(ledger, day) -> float:
+    """Closing balance after every transaction dated on or before `day` (O(log n))."""
+    pos = ledger["dates"].searchsorted(
+        np.datetime64(pd.Timestamp(day).normalize()), side="right"
+    )
+    return float(ledger["closing"][pos - 1]) if pos else ledger["seed"]
+
+def min_balance_from(ledger, day) -> float:
+    """Lowest balance from `day` onward, so a back-dated debit cannot overdraw later rows."""
+    pos = ledger["dates"].searchsorted(
+        np.datetime64(pd.Timestamp(day).normalize()), side="right"
+    )
+    later = ledger["closing"][pos:]
+    start = balance_as_of(ledger, day)
+    return float(min(start, later.min())) if len(later) else start
+
+def rebalance_writes(ledger, day, signed):
+    """
+    Updates shifting the stored Opening/Closing (K:L) of every row dated
+    after `day` by `signed`, so a back-dated insert leaves them consistent.
+    Rows that already disagree with the ledger (manual edits) are left
+    as they are and stay flagged as Mismatch.
+    """
+    rows = ledger["rows"]
+    if rows.empty:
+        return []
+    later = rows[(rows.index > pd.Timestamp(day).normalize()) & ~rows["Mismatch"]]
+    return [
+        sheet_update(BANK_TRANSACTION_TAB, f"K{r.SheetRow}:L{r.SheetRow}", [[
+            round(r.CalcOpening + signed, 2),
+            round(r.CalcClosing + signed, 2),
+        ]])
+        for r in later.itertuples()
+    ]
+
+def bank_balance(ledger) -> float:
+    return ledger["balance"]
+
+def get_current_bank_balance() -> float:
+    return bank_balance(load_bank_ledger())
+
+@sheet_loader(ttl=30)
 def load_expenses():
             ws = open_expense_sheet()
             rows = ws.get_all_values()
             if len(rows) <= 1:
-                return pd.DataFrame(columns=rows[0])
+                return pd.DataFrame(columns=EXPENSE_HEADER)
             return pd.DataFrame(rows[1:], columns=rows[0])
 
-@st.cache_data(ttl=30)
+@sheet_loader(ttl=30)
 def load_investments():
             ws = open_investment_sheet()
             rows = ws.get_all_values()
@@ -472,10 +1421,106 @@ def load_investments():
     
             return pd.DataFrame(rows[1:], columns=rows[0])
 
+def open_payment_sheet():
+            return open_sheet(MAIN_SHEET_ID, PAYMENT_TAB)
+
+@sheet_loader(ttl=30)
+def load_payments():
+            ws = open_payment_sheet()
+            rows = ws.get_all_values()
+            if len(rows) <= 1:
+                return pd.DataFrame(columns=PAYMENT_HEADER)
+            return pd.DataFrame(rows[1:], columns=rows[0])
+
+def open_med_master():
+            return open_sheet(MAIN_SHEET_ID, MEDICATION_MASTER_TAB)
+
+def open_med_log():
+            return open_sheet(MAIN_SHEET_ID, MEDICATION_LOG_TAB)
+
+@sheet_loader(ttl=30)
+def load_med_master():
+            ws = open_med_master()
+            rows = ws.get_all_values()
+            if len(rows) <= 1:
+                return pd.DataFrame()
+            return pd.DataFrame(rows[1:], columns=rows[0])
+
+@sheet_loader(ttl=30)
+def load_med_logs():
+            ws = open_med_log()
+            rows = ws.get_all_values()
+
+            # Sheet empty → initialize header
+            if not rows:
+                ws.insert_row(MEDICATION_LOG_HEADER, 1)
+                return pd.DataFrame(columns=MEDICATION_LOG_HEADER)
+
+            # Header exists but no data
+            if len(rows) == 1:
+                return pd.DataFrame(columns=rows[0])
+
+            return pd.DataFrame(rows[1:], columns=rows[0])
+
+@st.cache_resource
+def open_med_stock():
+    """Medication_Stock tab; created with its header on first use."""
+    sh = init_gsheets().open_by_key(MAIN_SHEET_ID)
+    try:
+        return sh.worksheet(MEDICATION_STOCK_TAB)
+    except gspread.WorksheetNotFound:
+        ws = sh.add_worksheet(MEDICATION_STOCK_TAB, rows=1000, cols=len(MEDICATION_STOCK_HEADER))
+        ws.append_row(MEDICATION_STOCK_HEADER)
+        return ws
+
+@sheet_loader(ttl=30)
+def load_med_stock():
+            ws = open_med_stock()
+            rows = ws.get_all_values()
+            if len(rows) <= 1:
+                return pd.DataFrame(columns=MEDICATION_STOCK_HEADER)
+            return pd.DataFrame(rows[1:], columns=rows[0])
+
+@st.cache_data(ttl=30)
+def load_medicine_stock():
+    """
+    MedicineID -> current stock. Medication_Master.StockAvailable is the
+    opening balance; every change since is a row in Medication_Stock.
+    """
+    master = load_med_master()
+    moves = load_med_stock()
+
+    opening = (
+        pd.to_numeric(master["StockAvailable"], errors="coerce").fillna(0)
+        .groupby(master["MedicineID"]).last()
+        if not master.empty else pd.Series(dtype=float)
+    )
+    moved = (
+        pd.to_numeric(moves["Quantity"], errors="coerce").fillna(0)
+        .groupby(moves["MedicineID"]).sum()
+        if not moves.empty else pd.Series(dtype=float)
+    )
+    return opening.add(moved, fill_value=0).round(4).to_dict()
+
+def stock_movement(med_id, kind, qty, ref_id="", notes=""):
+    """Journal write for one Medication_Stock row (qty is signed)."""
+    open_med_stock()  # the tab must exist before the journal resolves it by name
+    now = dt.datetime.now()
+    return sheet_append(MEDICATION_STOCK_TAB, [[
+        f"MSTK{now.strftime('%Y%m%d%H%M%S%f')}",
+        med_id,
+        kind,
+        qty,
+        ref_id,
+        notes,
+        st.session_state.user_name,
+        now.strftime("%Y-%m-%d %H:%M:%S"),
+    ]])
+
 def open_milking_sheet():
             return open_sheet(MAIN_SHEET_ID, MILKING_TAB)
 
-@st.cache_data(ttl=120)  
+@sheet_loader(ttl=120)
 def load_milking_data():
     ws = open_milking_sheet()
     rows = ws.get_all_values()
@@ -498,11 +1543,60 @@ def load_milking_data():
 
     return df
 
-    
+
+# ---------- DUPLICATE GUARD (Date, Shift, ID) ----------
+def entry_key(date_val, shift, entity_id):
+    """Normalised (YYYY-MM-DD, Shift, ID) key used by milking and bitran saves."""
+    return (
+        pd.to_datetime(date_val).strftime("%Y-%m-%d"),
+        str(shift).strip(),
+        str(entity_id).strip(),
+    )
+
+def build_entry_keys(df, id_col):
+    if df.empty or not {"Date", "Shift", id_col}.issubset(df.columns):
+        return set()
+
+    dates = pd.to_datetime(df["Date"], errors="coerce").dt.strftime("%Y-%m-%d")
+    return set(zip(
+        dates,
+        df["Shift"].astype(str).str.strip(),
+        df[id_col].astype(str).str.strip(),
+    ))
+
+def fetch_live_entry_keys(ws):
+    """
+    Read Date / Shift / ID (columns A:C in both MILKING_HEADER and
+    BITRAN_HEADER) straight from the sheet, bypassing the cache.
+    """
+    rows = [r for r in ws.get("A2:C") if len(r) == 3]
+    if not rows:
+        return set()
+    return build_entry_keys(
+        pd.DataFrame(rows, columns=["Date", "Shift", "ID"]), "ID"
+    )
+
+@st.cache_data(ttl=120)
+def load_milking_keys():
+    return build_entry_keys(load_milking_data(), "CowID")
+
 def append_milking_rows(rows):
+    """
+    Batch-append milking rows after re-checking the live sheet.
+    Returns the clashing keys (nothing is written) or [] on success.
+    """
     ws = open_milking_sheet()
-    for r in rows:
-        ws.append_row(r, value_input_option="USER_ENTERED")
+    live_keys = fetch_live_entry_keys(ws)
+
+    clashes = [
+        entry_key(r[0], r[1], r[2]) for r in rows
+        if entry_key(r[0], r[1], r[2]) in live_keys
+    ]
+    if clashes:
+        return clashes
+
+    ws.append_rows(rows, value_input_option="USER_ENTERED")
+    return []
 def load_customers():
     ws = open_sheet(MAIN_SHEET_ID, CUSTOMER_TAB)
     rows = ws.get_all_values()
@@ -510,6 +1604,7 @@ def load_customers():
         return pd.DataFrame(columns=["CustomerID", "Name", "Shift", "Status"])
     return pd.DataFrame(rows[1:], columns=rows[0])
 
+@sheet_loader(ttl=30)
 def load_bitran_data():
     ws = open_sheet(MAIN_SHEET_ID, BITRAN_TAB)
     rows = ws.get_all_values()
@@ -518,6 +1613,1624 @@ def load_bitran_data():
         return pd.DataFrame(columns=BITRAN_HEADER)
     return pd.DataFrame(rows[1:], columns=rows[0])
 
+@st.cache_data(ttl=30)
+def load_bitran_keys():
+    return build_entry_keys(load_bitran_data(), "CustomerID")
+
+@st.cache_data(ttl=30)
+def load_bitran_shift_keys():
+    return {k[:2] for k in load_bitran_keys()}
+
+# ---------- DELIVERY SNAPSHOT (ALL CUSTOMERS, ONE PASS) ----------
+def summarize_customer_days(daily, month_start):
+    """
+    daily: one row per (CustomerID, Date) with MilkDelivered summed.
+    Returns one row per customer with MonthTotal, MonthAvg,
+    LastDayTotal and LastUpdate (date of the latest delivery).
+    """
+    if daily.empty:
+        return pd.DataFrame(
+            columns=["CustomerID", "MonthTotal", "MonthAvg", "LastDayTotal", "LastUpdate"]
+        )
+
+    in_month = daily[daily["Date"] >= pd.Timestamp(month_start)]
+    month = in_month.groupby("CustomerID")["MilkDelivered"].agg(
+        MonthTotal="sum", MonthDays="size"
+    )
+
+    last = (
+        daily.sort_values("Date")
+        .groupby("CustomerID")
+        .tail(1)
+        .set_index("CustomerID")
+        .rename(columns={"Date": "LastUpdate", "MilkDelivered": "LastDayTotal"})
+    )
+
+    snap = last.join(month, how="left").fillna({"MonthTotal": 0, "MonthDays": 0})
+    snap["MonthAvg"] = (
+        snap["MonthTotal"] / snap["MonthDays"].where(snap["MonthDays"] > 0)
+    ).fillna(0).round(2)
+
+    return snap.drop(columns=["MonthDays"]).reset_index()
+
+# ---------- BILL CALCULATION (ONE CUSTOMER, ONE PERIOD) ----------
+def calculate_milk(bitran_df, customer_id, from_date, to_date):
+    """
+    (morning, evening, total, missing day numbers, daily pattern) for one
+    customer between from_date and to_date. bitran_df needs a datetime
+    Date and numeric MilkDelivered.
+    """
+    if bitran_df.empty:
+        return 0, 0, 0, [], []
+
+    df = bitran_df[
+        (bitran_df["CustomerID"] == customer_id) &
+        (bitran_df["Date"] >= pd.to_datetime(from_date)) &
+        (bitran_df["Date"] <= pd.to_datetime(to_date))
+    ].copy()
+
+    df["day"] = df["Date"].dt.date
+
+    morning = df[df["Shift"] == "Morning"]["MilkDelivered"].sum()
+    evening = df[df["Shift"] == "Evening"]["MilkDelivered"].sum()
+    total = morning + evening
+
+    # ---- DAILY PATTERN LOGIC ----
+    all_dates = pd.date_range(from_date, to_date)
+    daily_pattern = []
+    missing_dates = []
+
+    for d in all_dates:
+        day_total = df[df["day"] == d.date()]["MilkDelivered"].sum()
+        daily_pattern.append(round(day_total, 2))
+        if day_total == 0:
+            missing_dates.append(d.day)
+
+    return (
+        round(morning, 2),
+        round(evening, 2),
+        round(total, 2),
+        missing_dates,
+        daily_pattern
+    )
+
+# ============================================================
+# WRITE-AHEAD JOURNAL (MULTI-SHEET OPERATIONS)
+# ============================================================
+JOURNAL_PATH = state_path(".sheet_journal.jsonl")  # None = journal in memory only
+JOURNAL_RETRIES = 5
+
+class JournalConflict(Exception):
+    """An op key came back with different writes while its first payload is still pending."""
+
+def op_key(form):
+    """Idempotency key for one submit of `form`; stable across reruns until cleared."""
+    k = f"_opkey_{form}"
+    if k not in st.session_state:
+        st.session_state[k] = f"{form.upper()}-{uuid.uuid4().hex}"
+    return st.session_state[k]
+
+def clear_op_key(form):
+    st.session_state.pop(f"_opkey_{form}", None)
+
+def sheet_append(tab, rows):
+    return {"tab": tab, "kind": "append", "rows": rows}
+
+def sheet_update(tab, a1, values):
+    return {"tab": tab, "kind": "update", "range": a1, "values": values}
+
+def _plain(v):
+    return v.item() if hasattr(v, "item") else str(v)
+
+def writes_digest(writes):
+    """
+    Hash of what a submit writes, with generated values masked (timestamps
+    and the 14+ digit stamps in IDs), so retrying the same input matches
+    and changed input does not.
+    """
+    text = json.dumps(writes, default=_plain, sort_keys=True)
+    text = re.sub(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?", "#", text)
+    text = re.sub(r"\d{14,}", "#", text)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+@st.cache_resource
+def get_journal():
+    """
+    Load the journal, keep only ops that never finished (pending, or held
+    for an admin) and rewrite the file with them (done ops cannot recur:
+    their keys died with the sessions). If the file cannot be read or
+    written the journal runs in memory only (ops then die with the process).
+    """
+    path, ops = JOURNAL_PATH, {}
+    try:
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    ops.setdefault(rec["key"], {}).update(rec)
+
+        ops = {k: op for k, op in ops.items() if op.get("status") in ("pending", "held")}
+        if path:
+            with open(path, "w") as f:
+                for op in ops.values():
+                    f.write(json.dumps(op) + "\n")
+    except OSError:
+        path = None
+
+    # lock guards ops and the file; flushing holds keys whose batch_update is in flight
+    return {"lock": threading.Lock(), "ops": ops, "flushing": set(), "path": path}
+
+def journal_write(journal, rec):
+    if journal["path"]:
+        try:
+            with open(journal["path"], "a") as f:
+                f.write(json.dumps(rec) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            journal["path"] = None  # e.g. disk full / read-only: carry on in memory
+    journal["ops"].setdefault(rec["key"], {}).update(rec)
+
+def to_cell(v):
+    if v is None or (isinstance(v, float) and np.isnan(v)):
+        return {}
+    if isinstance(v, bool):
+        return {"userEnteredValue": {"boolValue": v}}
+    if isinstance(v, (int, float)):
+        return {"userEnteredValue": {"numberValue": v}}
+    v = str(v)
+    if v.startswith("="):
+        return {"userEnteredValue": {"formulaValue": v}}
+    return {"userEnteredValue": {"stringValue": v}}
+
+def build_batch_requests(writes):
+    requests = []
+    for w in writes:
+        ws = open_sheet(MAIN_SHEET_ID, w["tab"])
+
+        if w["kind"] == "append":
+            requests.append({"appendCells": {
+                "sheetId": ws.id,
+                "rows": [{"values": [to_cell(v) for v in r]} for r in w["rows"]],
+                "fields": "userEnteredValue",
+            }})
+        else:
+            row, col = gspread.utils.a1_to_rowcol(w["range"].split(":")[0])
+            requests.append({"updateCells": {
+                "start": {"sheetId": ws.id, "rowIndex": row - 1, "columnIndex": col - 1},
+                "rows": [{"values": [to_cell(v) for v in r]} for r in w["values"]],
+                "fields": "userEnteredValue",
+            }})
+    return requests
+
+def read_cells(writes):
+    """
+    Current values of every cell the update writes in `writes` cover, as
+    strings padded to the written shape (one batch read). Used as the
+    pre-image that a later roll-forward compares against.
+    """
+    updates = [w for w in writes if w["kind"] == "update"]
+    if not updates:
+        return []
+
+    ranges = []
+    for w in updates:
+        row, col = gspread.utils.a1_to_rowcol(w["range"].split(":")[0])
+        end = gspread.utils.rowcol_to_a1(row + len(w["values"]) - 1, col + max(map(len, w["values"])) - 1)
+        ranges.append(f"'{w['tab']}'!{gspread.utils.rowcol_to_a1(row, col)}:{end}")
+
+    spreadsheet = open_sheet(MAIN_SHEET_ID, updates[0]["tab"]).spreadsheet
+    got = spreadsheet.values_batch_get(ranges).get("valueRanges", [])
+    out = []
+    for w, r in zip(updates, got):
+        vals = r.get("values", [])
+        out.append([
+            [str(vals[i][j]) if i < len(vals) and j < len(vals[i]) else "" for j in range(len(row))]
+            for i, row in enumerate(w["values"])
+        ])
+    return out
+
+def op_applied(writes):
+    """A batch lands atomically, so the ID of its first appended row tells whether it did."""
+    first = next((w for w in writes if w["kind"] == "append"), None)
+    if first is None:
+        return False
+    ws = open_sheet(MAIN_SHEET_ID, first["tab"])
+    return str(first["rows"][0][0]) in set(ws.col_values(1))
+
+def flush_op(op):
+    writes = op["writes"]
+    spreadsheet = open_sheet(MAIN_SHEET_ID, writes[0]["tab"]).spreadsheet
+
+    for attempt in range(JOURNAL_RETRIES):
+        try:
+            # an earlier try may have landed even though its response was lost
+            if (attempt or op.get("attempts")) and op_applied(writes):
+                return
+            spreadsheet.batch_update({"requests": build_batch_requests(writes)})
+            return
+        except Exception:
+            if attempt == JOURNAL_RETRIES - 1:
+                raise
+            time.sleep(min(2 ** attempt + random.random(), 30))
+
+def run_journaled(key, writes):
+    """
+    Record `writes` under idempotency key `key`, then flush them as one
+    atomic spreadsheet.batch_update (retried with backoff).
+    Returns "applied", or "duplicate" when the key was already done.
+    On failure the op stays pending and is rolled forward later.
+    A pending key re-submitted with different writes raises JournalConflict.
+    The lock only covers the journal bookkeeping, never the Sheets calls.
+    """
+    journal = get_journal()
+    digest = writes_digest(writes)
+    # pre-image of the cells this op overwrites (read once, when the op is first journaled)
+    before = read_cells(writes) if key not in journal["ops"] else None
+
+    with journal["lock"]:
+        op = journal["ops"].get(key)
+        if op and op.get("status") == "done":
+            return "duplicate"
+        if op and op.get("status") == "held":
+            raise RuntimeError("this save is held for review by an admin")
+
+        if op is None:
+            journal_write(journal, {
+                "key": key,
+                "status": "pending",
+                "digest": digest,
+                "created": dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "writes": json.loads(json.dumps(writes, default=_plain)),
+                "before": before,
+            })
+        elif op.get("digest", digest) != digest:
+            raise JournalConflict(key)
+
+        if key in journal["flushing"]:
+            raise RuntimeError("this save is already being written")
+        journal["flushing"].add(key)
+        op = journal["ops"][key]
+
+    try:
+        flush_op(op)
+    except Exception as e:
+        with journal["lock"]:
+            journal["flushing"].discard(key)
+            journal_write(journal, {"key": key, "attempts": op.get("attempts", 0) + 1, "error": str(e)})
+        raise
+
+    with journal["lock"]:
+        journal["flushing"].discard(key)
+        journal_write(journal, {"key": key, "status": "done"})
+    return "applied"
+
+def roll_forward_journal():
+    """
+    Replay ops left pending by a previous process. An op that overwrites
+    cells is only replayed while those cells still hold its pre-image;
+    if anything wrote them since, the op is held for an admin instead of
+    clobbering the newer values.
+    """
+    journal = get_journal()
+    for key, op in list(journal["ops"].items()):
+        if op.get("status") != "pending":
+            continue
+        try:
+            if any(w["kind"] == "update" for w in op["writes"]):
+                if op_applied(op["writes"]):
+                    with journal["lock"]:
+                        journal_write(journal, {"key": key, "status": "done"})
+                    continue
+                if op.get("before") is None or read_cells(op["writes"]) != op["before"]:
+                    with journal["lock"]:
+                        journal_write(journal, {"key": key, "status": "held", "error": "cells changed since the save"})
+                    continue
+            run_journaled(key, op["writes"])
+        except Exception:
+            pass  # stays pending; next start or the user's retry replays it
+
+def held_ops():
+    """Ops roll_forward_journal would not replay, oldest first."""
+    journal = get_journal()
+    with journal["lock"]:
+        ops = [dict(op) for op in journal["ops"].values() if op.get("status") == "held"]
+    return sorted(ops, key=lambda op: op.get("created", ""))
+
+def resolve_held_op(key, apply):
+    """Admin decision on a held op: write it as journaled, or drop it."""
+    journal = get_journal()
+    with journal["lock"]:
+        journal_write(journal, {"key": key, "status": "pending" if apply else "discarded"})
+        writes = journal["ops"][key]["writes"]
+    if apply:
+        run_journaled(key, writes)
+
+def save_journaled(form, writes):
+    """
+    run_journaled for a form submit; stops the script with an error if the
+    flush fails. Returns the writes that actually landed: a retry after a
+    failed save replays the first journaled payload, so IDs generated on
+    this rerun may not be the ones in the sheet (see landed_id).
+    """
+    key = op_key(form)
+    try:
+        run_journaled(key, writes)
+    except JournalConflict:
+        # the earlier, different submit was promised a retry: write it, never swap in the new values
+        try:
+            run_journaled(key, get_journal()["ops"][key]["writes"])
+        except Exception:
+            st.error("❌ An earlier save of this form is still waiting for Google Sheets, so these values were not saved. Try again in a moment.")
+            st.stop()
+        clear_op_key(form)
+        st.warning("⚠️ Your earlier save of this form (from the failed attempt) has now been written. These new values were NOT saved — check the records and submit again if needed.")
+        st.stop()
+    except Exception:
+        st.error("❌ Google Sheets did not accept the save. It is journaled and will be retried — press save again to retry now.")
+        st.stop()
+    clear_op_key(form)
+    return get_journal()["ops"][key]["writes"]
+
+def landed_id(writes, tab):
+    """ID (first cell) of the first row appended to `tab` by `writes`."""
+    return next(w["rows"][0][0] for w in writes if w["kind"] == "append" and w["tab"] == tab)
+
+@st.cache_resource
+def journal_rolled_forward():
+    roll_forward_journal()
+    return True
+
+journal_rolled_forward()
+
+# ============================================================
+# INCREMENTAL STORES (APPEND-ONLY SHEETS)
+# ============================================================
+def prefix_unchanged(df, seen, version):
+    """True when the first `seen` rows of df are the rows `version` was taken of."""
+    return (
+        len(df) >= seen
+        and frame_version(df)[1] == version[1]
+        and prefix_checksum(df, seen) == version[2]
+    )
+
+def refresh_incremental(store, df, init, fold):
+    """
+    Fold rows appended since the previous call into store["state"].
+    Sheet tabs are append-only, so only df.iloc[store["rows"]:] is read.
+    The rows seen before are checked against the checksum stored with
+    them (O(new rows), derived from the loader's content version); any
+    edit or delete in the sheet rebuilds the state from scratch.
+    """
+    version = frame_version(df)
+    with store["lock"]:
+        if store["state"] is not None and store["version"] == version:
+            return store["state"]
+
+        seen = store["rows"]
+        if store["state"] is None or (seen and not prefix_unchanged(df, seen, store["version"])):
+            store["state"] = init()
+            seen = 0
+
+        if len(df) > seen:
+            fold(store["state"], df.iloc[seen:])
+        store["rows"] = len(df)
+        store["version"] = version
+
+        return store["state"]
+
+# ---------- ROLLUP TABLES (MILKING / BITRAN) ----------
+@st.cache_resource
+def get_rollup_store(tab: str):
+    return {"lock": threading.Lock(), "rows": 0, "version": None, "state": None}
+
+def empty_rollups():
+    date_shift = pd.MultiIndex.from_arrays(
+        [pd.DatetimeIndex([]), pd.Index([], dtype=object)], names=["Date", "Shift"]
+    )
+    date_id = pd.MultiIndex.from_arrays(
+        [pd.DatetimeIndex([]), pd.Index([], dtype=object)], names=["Date", "ID"]
+    )
+    month_id = date_id.set_names(["Month", "ID"])
+
+    return {
+        "total": 0.0,
+        "dates": set(),
+        "pairs": set(),
+        "complete": set(),
+        "last_complete": None,
+        "day_shift": pd.DataFrame({"Qty": [], "Rows": []}, index=date_shift),
+        "day": pd.Series(dtype=float, index=pd.DatetimeIndex([], name="Date")),
+        "day_id": pd.Series(dtype=float, index=date_id),
+        "month": pd.DataFrame({"Qty": [], "Days": []}, index=pd.DatetimeIndex([], name="Month")),
+        "month_id": pd.DataFrame({"Qty": [], "Days": []}, index=month_id),
+        "id_total": pd.Series(dtype=float, index=pd.Index([], name="ID")),
+        "id_last": pd.DataFrame(
+            {
+                "LastDate": pd.Series(dtype="datetime64[ns]"),
+                "LastDayQty": pd.Series(dtype=float),
+                "LastTimestamp": pd.Series(dtype=object),
+            },
+            index=pd.Index([], name="ID"),
+        ),
+    }
+
+def fold_rollups(state, rows, id_col, qty_col):
+    d = pd.DataFrame({
+        "Date": pd.to_datetime(rows["Date"], errors="coerce").dt.normalize(),
+        "Shift": rows["Shift"].astype(str).str.strip(),
+        "ID": rows[id_col].astype(str).str.strip(),
+        "Qty": pd.to_numeric(rows[qty_col], errors="coerce").fillna(0),
+        "Timestamp": rows["Timestamp"].astype(str) if "Timestamp" in rows else "",
+    }).dropna(subset=["Date"])
+
+    if d.empty:
+        return
+
+    d["Month"] = d["Date"].dt.to_period("M").dt.to_timestamp()
+
+    # ---- new calendar days / (day, id) pairs (O(delta) set lookups) ----
+    touched_dates = pd.DatetimeIndex(d["Date"].unique())
+    fresh_dates = [x for x in touched_dates if x not in state["dates"]]
+    state["dates"].update(fresh_dates)
+
+    pairs = d[["Date", "ID", "Month"]].drop_duplicates(["Date", "ID"])
+    fresh_pairs = pairs[[
+        (x, i) not in state["pairs"] for x, i in zip(pairs["Date"], pairs["ID"])
+    ]]
+    state["pairs"].update(zip(fresh_pairs["Date"], fresh_pairs["ID"]))
+
+    # ---- additive tables ----
+    state["total"] += float(d["Qty"].sum())
+
+    state["day_shift"] = state["day_shift"].add(
+        d.groupby(["Date", "Shift"]).agg(Qty=("Qty", "sum"), Rows=("Qty", "size")),
+        fill_value=0,
+    ).sort_index()
+
+    state["day"] = state["day"].add(
+        d.groupby("Date")["Qty"].sum(), fill_value=0
+    ).sort_index()
+
+    state["day_id"] = state["day_id"].add(
+        d.groupby(["Date", "ID"])["Qty"].sum(), fill_value=0
+    ).sort_index()
+
+    month_days = pd.Series(
+        pd.DatetimeIndex(fresh_dates).to_period("M").to_timestamp(), dtype="datetime64[ns]"
+    ).value_counts()
+    state["month"] = state["month"].add(
+        pd.DataFrame({
+            "Qty": d.groupby("Month")["Qty"].sum(),
+            "Days": month_days,
+        }).fillna(0),
+        fill_value=0,
+    ).sort_index()
+
+    state["month_id"] = state["month_id"].add(
+        pd.DataFrame({
+            "Qty": d.groupby(["Month", "ID"])["Qty"].sum(),
+            "Days": fresh_pairs.groupby(["Month", "ID"]).size(),
+        }).fillna(0),
+        fill_value=0,
+    ).sort_index()
+
+    state["id_total"] = state["id_total"].add(
+        d.groupby("ID")["Qty"].sum(), fill_value=0
+    )
+
+    # ---- last delivery / milking day per ID ----
+    cand = d.groupby("ID").agg(LastDate=("Date", "max"), LastTimestamp=("Timestamp", "max"))
+    prev = state["id_last"].reindex(cand.index)
+    cand["LastDate"] = pd.concat([prev["LastDate"], cand["LastDate"]], axis=1).max(axis=1)
+    cand["LastTimestamp"] = [
+        max(str(a) if pd.notna(a) else "", b)
+        for a, b in zip(prev["LastTimestamp"], cand["LastTimestamp"])
+    ]
+    cand["LastDayQty"] = state["day_id"].reindex(
+        pd.MultiIndex.from_arrays([cand["LastDate"], cand.index])
+    ).to_numpy()
+    state["id_last"] = pd.concat([
+        state["id_last"].drop(index=cand.index, errors="ignore"),
+        cand[["LastDate", "LastDayQty", "LastTimestamp"]],
+    ])
+
+    # ---- days with both Morning and Evening recorded ----
+    for day in touched_dates:
+        if (day, "Morning") in state["day_shift"].index and (day, "Evening") in state["day_shift"].index:
+            state["complete"].add(day)
+    state["last_complete"] = max(state["complete"]) if state["complete"] else None
+
+def refresh_rollups(tab, df, id_col, qty_col):
+    return refresh_incremental(
+        get_rollup_store(tab),
+        df,
+        empty_rollups,
+        lambda state, rows: fold_rollups(state, rows, id_col, qty_col),
+    )
+
+def get_milking_rollups():
+    return refresh_rollups(MILKING_TAB, load_milking_data(), "CowID", "MilkQuantity")
+
+def get_bitran_rollups():
+    return refresh_rollups(BITRAN_TAB, load_bitran_data(), "CustomerID", "MilkDelivered")
+
+def rollup_month(state, month_start):
+    """(total, recorded days) for the month containing month_start."""
+    key = pd.Timestamp(month_start).to_period("M").to_timestamp()
+    if key not in state["month"].index:
+        return 0.0, 0
+    row = state["month"].loc[key]
+    return float(row["Qty"]), int(row["Days"])
+
+def rollup_month_by_id(state, month_start):
+    """Qty and Days per ID for the month containing month_start."""
+    key = pd.Timestamp(month_start).to_period("M").to_timestamp()
+    if key not in state["month_id"].index.get_level_values("Month"):
+        return pd.DataFrame(columns=["Qty", "Days"])
+    return state["month_id"].xs(key, level="Month")
+
+def rollup_day_total(state, day):
+    if day is None or day not in state["day"].index:
+        return 0.0
+    return float(state["day"].loc[day])
+
+def rollup_delivery_snapshot(state, month_start):
+    daily = (
+        state["day_id"]
+        .rename("MilkDelivered")
+        .reset_index()
+        .rename(columns={"ID": "CustomerID"})
+    )
+    return summarize_customer_days(daily, month_start)
+
+def pending_milking_shifts(state, today):
+    """(date, shift) slots from the first recorded day to `today` with no milking entry."""
+    if not state["dates"]:
+        return []
+    recorded = state["day_shift"].index
+    return [
+        (d.date(), shift)
+        for d in pd.date_range(start=min(state["dates"]), end=today, freq="D")
+        for shift in ["Morning", "Evening"]
+        if (d, shift) not in recorded
+    ]
+
+def pending_bitran_shifts(milk_state, bitran_state):
+    """Milked (date, shift) slots with milk but no distribution saved yet."""
+    delivered = bitran_state["day_shift"].index
+    return [
+        {"Date": date.date(), "Shift": shift, "MilkTotal": float(qty or 0)}
+        for (date, shift), qty in milk_state["day_shift"]["Qty"].items()
+        if float(qty or 0) > 0 and (date, shift) not in delivered
+    ]
+
+def rollup_day_shift_window(state, start=None, end=None):
+    """Day×shift totals between start and end (inclusive) from the sorted rollup."""
+    ds = state["day_shift"]
+    if start is not None or end is not None:
+        ds = ds.loc[
+            pd.Timestamp(start) if start is not None else None:
+            pd.Timestamp(end) if end is not None else None
+        ]
+    return ds
+
+# ---------- LACTATION CURVES (WOOD'S MODEL) ----------
+LACTATION_GAP_DAYS = 30      # a break in milking this long starts a new lactation
+LACTATION_MIN_DAYS = 7       # cows with fewer recorded days are not fitted
+LACTATION_ALERT_RATIO = 0.8  # last week below 80% of the curve is flagged
+
+@st.cache_resource
+def get_lactation_store():
+    return {"lock": threading.Lock(), "fits": {}}
+
+def lactation_points(state):
+    """
+    Daily yield per cow in its current lactation, from the milking rollup.
+    Only complete days (both shifts recorded) are used. DIM (days in milk)
+    counts from the first recorded day of the lactation, so a cow that was
+    already milking when records began starts at DIM 1.
+    """
+    d = state["day_id"].rename("Qty").reset_index()
+    d = d[d["Date"].isin(list(state["complete"])) & (d["Qty"] > 0)].sort_values(["ID", "Date"])
+    if d.empty:
+        return d.assign(DIM=pd.Series(dtype=float))
+
+    gap = d.groupby("ID")["Date"].diff().dt.days
+    lactation = (gap.isna() | (gap >= LACTATION_GAP_DAYS)).astype(int).groupby(d["ID"]).cumsum()
+    d = d[lactation == lactation.groupby(d["ID"]).transform("max")]
+
+    d["DIM"] = (d["Date"] - d.groupby("ID")["Date"].transform("min")).dt.days + 1
+    return d
+
+def fit_wood(points):
+    """
+    Fit y = a * t^b * e^(-c t) for every cow at once as the linear model
+    ln y = ln a + b ln t - c t. The 3x3 normal equations of all cows are
+    summed in one groupby and solved as a stacked batch.
+    """
+    t = points["DIM"].to_numpy(float)
+    X = np.column_stack([np.ones_like(t), np.log(t), t])
+    y = np.log(points["Qty"].to_numpy(float))
+
+    terms = {}
+    for i in range(3):
+        terms[f"y{i}"] = X[:, i] * y
+        for j in range(i, 3):
+            terms[f"x{i}{j}"] = X[:, i] * X[:, j]
+
+    g = pd.DataFrame(terms, index=points.index).groupby(points["ID"])
+    sums = g.sum()[g.size() >= LACTATION_MIN_DAYS]
+    if sums.empty:
+        return pd.DataFrame(columns=["a", "b", "c"])
+
+    xtx = np.empty((len(sums), 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            xtx[:, i, j] = xtx[:, j, i] = sums[f"x{i}{j}"]
+
+    # pinv keeps near-flat or very short curves from blowing up the solve
+    coef = np.einsum("nij,nj->ni", np.linalg.pinv(xtx), sums[["y0", "y1", "y2"]].to_numpy())
+    return pd.DataFrame(
+        {"a": np.exp(coef[:, 0]), "b": coef[:, 1], "c": -coef[:, 2]},
+        index=sums.index,
+    )
+
+def wood_yield(a, b, c, t):
+    return a * np.power(t, b) * np.exp(-c * t)
+
+def load_lactation(state, today=None):
+    """
+    Per-cow lactation fit and forecast. Fits are kept in a cache_resource
+    store keyed by each cow's (days, last date, total) signature, so only
+    cows with new milking rows are refitted. Lactations with no milking in
+    the last LACTATION_GAP_DAYS have ended and are left out.
+    Returns one row per fitted cow: LactationStart, DIM, a, b, c, PeakDIM,
+    Next7, Next30, Last7Actual, Last7Curve, CurveRatio, BelowCurve.
+    Next7 / Next30 are NaN when the fit is not a lactation curve (c <= 0
+    or b < 0 would grow without bound).
+    """
+    today = pd.Timestamp(today or dt.date.today()).normalize()
+    points = lactation_points(state)
+    if not points.empty:
+        last = points.groupby("ID")["Date"].transform("max")
+        points = points[last > today - pd.Timedelta(days=LACTATION_GAP_DAYS)]
+    if points.empty:
+        return pd.DataFrame()
+
+    g = points.groupby("ID")
+    sig = pd.DataFrame({
+        "Start": g["Date"].min(),
+        "Last": g["Date"].max(),
+        "Days": g.size(),
+        "Qty": g["Qty"].sum(),
+    })
+    signature = dict(zip(sig.index, sig[["Last", "Days", "Qty"]].itertuples(index=False, name=None)))
+
+    store = get_lactation_store()
+    with store["lock"]:
+        fits = store["fits"]
+        stale = [cid for cid, s in signature.items() if cid not in fits or fits[cid][0] != s]
+        if stale:
+            fresh = fit_wood(points[points["ID"].isin(stale)])
+            for cid in stale:
+                fits[cid] = (signature[cid], fresh.loc[cid] if cid in fresh.index else None)
+        for cid in set(fits) - set(signature):
+            del fits[cid]
+        params = pd.DataFrame({cid: f for cid, (_, f) in fits.items() if f is not None}).T
+
+    if params.empty:
+        return pd.DataFrame()
+
+    out = sig.loc[params.index, ["Start"]].rename(columns={"Start": "LactationStart"})
+    out[["a", "b", "c"]] = params[["a", "b", "c"]].astype(float)
+
+    out["DIM"] = (today - out["LactationStart"]).dt.days + 1
+    valid = (out["b"] >= 0) & (out["c"] > 0)
+    out["PeakDIM"] = (out["b"] / out["c"]).where(valid & (out["b"] > 0))
+
+    a, b, c = (out[k].to_numpy()[:, None] for k in ("a", "b", "c"))
+    ahead = out["DIM"].to_numpy()[:, None] + np.arange(1, 31)
+    with np.errstate(over="ignore"):
+        daily = wood_yield(a, b, c, ahead)
+    out["Next7"] = pd.Series(daily[:, :7].sum(axis=1), index=out.index).where(valid)
+    out["Next30"] = pd.Series(daily.sum(axis=1), index=out.index).where(valid)
+
+    recent = points[
+        points["ID"].isin(out.index[valid])
+        & (points["Date"] > today - pd.Timedelta(days=7))
+    ]
+    p = out.loc[recent["ID"]]
+    recent = recent.assign(Curve=wood_yield(p["a"].to_numpy(), p["b"].to_numpy(), p["c"].to_numpy(), recent["DIM"].to_numpy(float)))
+    last7 = recent.groupby("ID")[["Qty", "Curve"]].sum()
+    out["Last7Actual"] = last7["Qty"]
+    out["Last7Curve"] = last7["Curve"]
+    out["CurveRatio"] = out["Last7Actual"] / out["Last7Curve"].where(out["Last7Curve"] > 0)
+    out["BelowCurve"] = out["CurveRatio"] < LACTATION_ALERT_RATIO
+    return out
+
+# ---------- YIELD ANOMALIES (ROLLING Z-SCORE) ----------
+ANOMALY_WINDOW = 14       # previous entries per cow & shift forming the baseline
+ANOMALY_MIN_PERIODS = 5   # no score until a cow & shift has this many entries
+ANOMALY_Z = -2.5          # z-score at or below this is a sudden drop
+ANOMALY_MED_DAYS = 7      # medication given this many days either side is linked
+
+@st.cache_resource
+def get_anomaly_store():
+    return {"lock": threading.Lock(), "rows": 0, "version": None, "state": None}
+
+def empty_anomalies():
+    base = {
+        "Date": pd.Series(dtype="datetime64[ns]"),
+        "Shift": pd.Series(dtype=object),
+        "ID": pd.Series(dtype=object),
+        "Qty": pd.Series(dtype=float),
+    }
+    return {
+        "window": pd.DataFrame(base),
+        "scores": pd.DataFrame({
+            **base,
+            "Mean": pd.Series(dtype=float),
+            "Std": pd.Series(dtype=float),
+            "Z": pd.Series(dtype=float),
+        }),
+    }
+
+def fold_anomalies(state, rows):
+    """
+    Score appended milking rows against the previous ANOMALY_WINDOW entries
+    of the same cow and shift. Only that trailing window is kept per key,
+    so a save scores the new shift without touching the herd's history.
+    """
+    new = pd.DataFrame({
+        "Date": pd.to_datetime(rows["Date"], errors="coerce").dt.normalize(),
+        "Shift": rows["Shift"].astype(str).str.strip(),
+        "ID": rows["CowID"].astype(str).str.strip(),
+        "Qty": pd.to_numeric(rows["MilkQuantity"], errors="coerce").fillna(0),
+    }).dropna(subset=["Date"])
+
+    if new.empty:
+        return
+
+    d = pd.concat(
+        [state["window"].assign(New=False), new.assign(New=True)],
+        ignore_index=True,
+    ).sort_values(["ID", "Shift", "Date"], kind="stable").reset_index(drop=True)
+
+    keys = [d["ID"], d["Shift"]]
+    roll = d.groupby(keys)["Qty"].rolling(ANOMALY_WINDOW, min_periods=ANOMALY_MIN_PERIODS)
+
+    # baseline of each entry = window ending at the previous entry
+    mean = roll.mean().droplevel([0, 1]).sort_index().groupby(keys).shift(1)
+    std = roll.std().droplevel([0, 1]).sort_index().groupby(keys).shift(1)
+
+    # floor the spread so a perfectly steady cow doesn't divide by ~0
+    std = np.maximum(std, np.maximum(0.05 * mean, 0.1))
+
+    d["Mean"], d["Std"] = mean, std
+    d["Z"] = (d["Qty"] - mean) / std
+
+    scored = d.loc[d["New"], list(state["scores"].columns)]
+    state["scores"] = pd.concat([state["scores"], scored], ignore_index=True)
+    state["window"] = d.groupby(keys).tail(ANOMALY_WINDOW)[list(state["window"].columns)]
+
+def get_milking_anomalies():
+    """Z-score of every milking entry (Date, Shift, ID, Qty, Mean, Std, Z)."""
+    return refresh_incremental(
+        get_anomaly_store(), load_milking_data(), empty_anomalies, fold_anomalies
+    )["scores"]
+
+def latest_z_by_cow(scores):
+    """Lowest z-score on each cow's latest milking date."""
+    if scores.empty:
+        return pd.Series(dtype=float)
+    last = scores["Date"] == scores.groupby("ID")["Date"].transform("max")
+    return scores[last].groupby("ID")["Z"].min()
+
+def link_medications(drops, med_logs, cows):
+    """
+    Add a Medications column to drops: medicines given to the cow within
+    ANOMALY_MED_DAYS of the drop. Medication_Log stores the TagNumber.
+    """
+    drops = drops.reset_index(drop=True).assign(Medications="")
+    if drops.empty or med_logs.empty:
+        return drops
+
+    tag_to_id = dict(zip(cows["TagNumber"].astype(str).str.strip(), cows["CowID"].astype(str).str.strip()))
+    logs = pd.DataFrame({
+        "ID": med_logs["CowID"].astype(str).str.strip().map(lambda t: tag_to_id.get(t, t)),
+        "GivenOn": pd.to_datetime(med_logs["GivenOn"], errors="coerce").dt.normalize(),
+        "MedicineName": med_logs["MedicineName"].astype(str),
+    }).dropna(subset=["GivenOn"])
+
+    m = drops.rename_axis("_row").reset_index().merge(logs, on="ID")
+    m = m[(m["GivenOn"] - m["Date"]).dt.days.abs() <= ANOMALY_MED_DAYS]
+    if m.empty:
+        return drops
+
+    m = m.sort_values("GivenOn")
+    names = m.groupby("_row").apply(
+        lambda g: ", ".join(f"{n} ({d:%d-%b})" for n, d in zip(g["MedicineName"], g["GivenOn"]))
+    )
+    drops.loc[names.index, "Medications"] = names
+    return drops
+
+# ---------- DUE-DOSE SCHEDULE (MEDICATION_LOG) ----------
+DUE_SOON_DAYS = 7
+
+@st.cache_resource
+def get_dose_store():
+    return {"lock": threading.Lock(), "rows": 0, "version": None, "state": None}
+
+def empty_schedule():
+    # latest: (CowID, MedicineID) -> (GivenOn, LogID, NextDueDate | None, MedicineName)
+    # heap:   (NextDueDate, LogID, CowID, MedicineID); an entry whose LogID is no
+    #         longer its pair's latest has been superseded and is dropped when reached
+    return {"latest": {}, "heap": []}
+
+def fold_schedule(state, rows):
+    latest, heap = state["latest"], state["heap"]
+    given = pd.to_datetime(rows["GivenOn"], errors="coerce").dt.normalize()
+    due = pd.to_datetime(rows["NextDueDate"], errors="coerce").dt.normalize()
+
+    for cow, med, name, log_id, g, d in zip(
+        rows["CowID"].astype(str).str.strip(),
+        rows["MedicineID"].astype(str).str.strip(),
+        rows["MedicineName"],
+        rows["LogID"].astype(str),
+        given,
+        due,
+    ):
+        if pd.isna(g):
+            continue
+        prev = latest.get((cow, med))
+        if prev is not None and (prev[0], prev[1]) > (g, log_id):
+            continue  # back-dated entry; a later dose already set the schedule
+
+        latest[(cow, med)] = (g, log_id, None if pd.isna(d) else d, name)
+        if pd.notna(d):
+            heapq.heappush(heap, (d, log_id, cow, med))
+
+def pop_due(state, until):
+    """
+    Live heap entries due on or before `until`, earliest first. Superseded
+    entries met on the way are discarded for good; live ones are pushed back.
+    Caller holds the store lock.
+    """
+    latest, heap = state["latest"], state["heap"]
+    live = []
+    while heap and heap[0][0] <= until:
+        entry = heapq.heappop(heap)
+        cur = latest.get((entry[2], entry[3]))
+        if cur is not None and cur[1] == entry[1]:
+            live.append(entry)
+    for entry in live:
+        heapq.heappush(heap, entry)
+    return live
+
+def load_due_doses(today=None, days=DUE_SOON_DAYS):
+    """
+    Overdue, due-today and upcoming (next `days`) doses, one per cow and
+    medicine, from the incrementally maintained Medication_Log schedule.
+    """
+    store = get_dose_store()
+    state = refresh_incremental(store, load_med_logs(), empty_schedule, fold_schedule)
+    today = pd.Timestamp(today or dt.date.today()).normalize()
+
+    with store["lock"]:
+        entries = pop_due(state, today + pd.Timedelta(days=days))
+        latest = state["latest"]
+        rows = [
+            {
+                "NextDueDate": d,
+                "CowID": cow,
+                "MedicineID": med,
+                "MedicineName": latest[(cow, med)][3],
+                "LastGiven": latest[(cow, med)][0],
+                "LogID": log_id,
+            }
+            for d, log_id, cow, med in entries
+        ]
+
+    out = pd.DataFrame(rows, columns=["NextDueDate", "CowID", "MedicineID", "MedicineName", "LastGiven", "LogID"])
+    out["NextDueDate"] = pd.to_datetime(out["NextDueDate"])
+    out["LastGiven"] = pd.to_datetime(out["LastGiven"])
+    days_left = (out["NextDueDate"] - today).dt.days
+    out["DaysLeft"] = days_left
+    out["Status"] = np.select([days_left < 0, days_left == 0], ["Overdue", "Due Today"], "Upcoming")
+    return out
+
+# ---------- WALLET BALANCES (PER USER) ----------
+WALLET_KEY_COLS = ["TxnID", "UserID", "Amount", "TxnType"]
+
+@st.cache_resource
+def get_wallet_store():
+    return {
+        "lock": threading.Lock(),
+        "rows": 0,
+        "version": None,
+        "keys": 0,      # body checksum of WALLET_KEY_COLS over the folded rows
+        "users": np.array([], dtype=object),
+        "status": np.array([], dtype=object),
+        "contrib": np.zeros((0, 3)),
+        "balances": {},
+        "names": {},
+    }
+
+def wallet_contrib(rows):
+    """Per-row (credit, debit, blocked) contribution to the owner's balance."""
+    amount = pd.to_numeric(rows["Amount"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    ttype = rows["TxnType"].to_numpy()
+    status = rows["TxnStatus"].to_numpy()
+    return np.column_stack([
+        np.where((ttype == "CREDIT") & (status == "COMPLETED"), amount, 0.0),
+        np.where((ttype == "DEBIT") & (status == "COMPLETED"), amount, 0.0),
+        np.where((ttype == "DEBIT") & (status == "PENDING"), amount, 0.0),
+    ])
+
+def apply_wallet_delta(balances, users, delta):
+    if not len(users):
+        return
+    sums = pd.DataFrame(delta, columns=["credit", "debit", "blocked"]).groupby(users).sum()
+    for uid, r in sums.iterrows():
+        b = balances.setdefault(uid, {"credit": 0.0, "debit": 0.0, "blocked": 0.0})
+        b["credit"] += float(r["credit"])
+        b["debit"] += float(r["debit"])
+        b["blocked"] += float(r["blocked"])
+
+def refresh_wallet_balances(df):
+    """
+    Keep the per-user balance table in step with the wallet sheet.
+    Appended rows are folded in; rows already seen are only revisited
+    when the sheet changed: a TxnStatus change is applied as a delta, an
+    edit to TxnID / UserID / Amount / TxnType (or a deleted row) rebuilds.
+    Rows are tracked by position because both legs of a transfer share
+    one TxnID.
+    """
+    store = get_wallet_store()
+    version = frame_version(df)
+
+    with store["lock"]:
+        if store["version"] == version:
+            return store
+
+        seen = store["rows"]
+        edited = bool(seen) and not prefix_unchanged(df, seen, store["version"])
+
+        if edited and (
+            len(df) < seen
+            or int(row_hashes(df.iloc[:seen][WALLET_KEY_COLS]).sum()) != store["keys"]
+        ):
+            store.update(
+                rows=0, version=None, keys=0,
+                users=np.array([], dtype=object), status=np.array([], dtype=object),
+                contrib=np.zeros((0, 3)), balances={}, names={},
+            )
+            seen, edited = 0, False
+
+        # ---- status changes on rows already folded ----
+        if edited:
+            new_status = df["TxnStatus"].to_numpy()[:seen]
+            changed = np.flatnonzero(new_status != store["status"])
+            if len(changed):
+                new_contrib = wallet_contrib(df.iloc[changed])
+                apply_wallet_delta(
+                    store["balances"], store["users"][changed],
+                    new_contrib - store["contrib"][changed],
+                )
+                store["contrib"][changed] = new_contrib
+                store["status"][changed] = new_status[changed]
+
+        # ---- appended rows ----
+        if len(df) > seen:
+            rows = df.iloc[seen:]
+            users = rows["UserID"].astype(str).str.strip().to_numpy(dtype=object)
+            contrib = wallet_contrib(rows)
+            apply_wallet_delta(store["balances"], users, contrib)
+
+            for uid, name in zip(users, rows["Name"]):
+                store["names"].setdefault(uid, name)
+
+            store["users"] = np.concatenate([store["users"], users])
+            store["status"] = np.concatenate([store["status"], rows["TxnStatus"].to_numpy(dtype=object)])
+            store["contrib"] = np.vstack([store["contrib"], contrib])
+            store["keys"] = (store["keys"] + int(row_hashes(rows[WALLET_KEY_COLS], seen).sum())) % 2**64
+            store["rows"] = len(df)
+
+        store["version"] = version
+        return store
+
+def _balance_view(b):
+    total = b["credit"] - b["debit"]
+    return {"available": total - b["blocked"], "blocked": b["blocked"], "total": total}
+
+def get_wallet_balance(user_id, store=None):
+    """Available / blocked / total for one user (O(1) lookup)."""
+    store = store or refresh_wallet_balances(load_wallet_df())
+    with store["lock"]:
+        b = dict(store["balances"].get(str(user_id).strip(), {"credit": 0.0, "debit": 0.0, "blocked": 0.0}))
+    return _balance_view(b)
+
+def wallet_overview(store, exclude=None):
+    """
+    (UserID, Name, balance) for every wallet user, copied under the store
+    lock so a concurrent refresh cannot resize the dict mid-iteration.
+    """
+    with store["lock"]:
+        snapshot = [
+            (uid, store["names"].get(uid, uid), dict(b))
+            for uid, b in store["balances"].items()
+            if uid != exclude
+        ]
+    return [(uid, name, _balance_view(b)) for uid, name, b in snapshot]
+
+# ---------- DATE-INDEXED FRAMES (WINDOW QUERIES) ----------
+WINDOW_OPTIONS = ["Last", "1 W", "1 M", "3 M", "All"]
+
+def build_date_index(df, date_col, numeric=()):
+    """Sorted copy of df with a normalized DatetimeIndex; rows without a date are dropped."""
+    out = df.copy()
+    for col in numeric:
+        if col in out:
+            out[col] = pd.to_numeric(out[col], errors="coerce").fillna(0)
+
+    dates = pd.to_datetime(out[date_col], errors="coerce") if date_col in out else pd.Series(pd.NaT, index=out.index)
+    out[date_col] = dates
+    out = out[dates.notna()]
+    out.index = pd.DatetimeIndex(dates[dates.notna()].dt.normalize(), name="_Date")
+    return out.sort_index(kind="stable")
+
+@st.cache_resource(max_entries=16)
+def _date_indexed(tab, date_col, numeric, version, _df):
+    """
+    build_date_index of _df, built once per sheet version and shared
+    across reruns. Do not mutate the result.
+    """
+    # the result lives in this cache, so it can carry the source's version
+    return _remember_version(build_date_index(_df, date_col, numeric), version)
+
+def date_indexed(tab, df, date_col, numeric=()):
+    return _date_indexed(tab, date_col, tuple(numeric), frame_version(df), df)
+
+def date_window(frame, start=None, end=None):
+    """Binary-search slice [start, end] (inclusive days) of a date-indexed frame."""
+    if frame.empty:
+        return frame
+    return frame.loc[
+        pd.Timestamp(start).normalize() if start is not None else None:
+        pd.Timestamp(end).normalize() if end is not None else None
+    ]
+
+def month_window(frame, day=None):
+    start = pd.Timestamp(day or dt.date.today()).normalize().replace(day=1)
+    return date_window(frame, start, start + pd.offsets.MonthEnd(0))
+
+def window_start(option, last=None):
+    """Start date for a WINDOW_OPTIONS radio; "Last" starts at `last` (default today)."""
+    today = pd.Timestamp.today().normalize()
+    if option == "Last":
+        return pd.Timestamp(last) if last is not None else today
+    if option == "1 W":
+        return today - pd.Timedelta(days=7)
+    if option == "1 M":
+        return today - pd.DateOffset(months=1)
+    if option == "3 M":
+        return today - pd.DateOffset(months=3)
+    return None
+
+def expenses_by_date():
+    return date_indexed(EXPENSE_TAB, load_expenses(), "Date", ["Amount"])
+
+def payments_by_date():
+    return date_indexed(BILLING_TAB, load_bills(), "PaidDate", ["PaidAmount"])
+
+# ---------- RECEIVABLES (AGING / OUTSTANDING) ----------
+AGING_BUCKETS = ["0-7", "8-30", "31-60", "60+"]
+
+def build_receivables(bills_df, as_of):
+    """
+    One vectorised pass over open bills (BalanceAmount > 0).
+    bills: open bills with DaysPastDue (0 until DueDate passes) and Bucket.
+    customers: per-customer Outstanding, OpenBills, bucket totals,
+    MaxDaysPastDue and the oldest unpaid bill.
+    totals: outstanding per bucket.
+    """
+    empty_customers = pd.DataFrame(columns=[
+        "CustomerID", "CustomerName", "Outstanding", "OpenBills", "MaxDaysPastDue",
+        *AGING_BUCKETS, "OldestBillID", "OldestDueDate",
+    ])
+    empty = {
+        "bills": pd.DataFrame(columns=["BillID", "CustomerID", "CustomerName", "FromDate", "DueDate", "Balance", "DaysPastDue", "Bucket"]),
+        "customers": empty_customers,
+        "totals": pd.Series(0.0, index=AGING_BUCKETS),
+    }
+    if bills_df.empty:
+        return empty
+
+    b = pd.DataFrame({
+        "BillID": bills_df["BillID"],
+        "CustomerID": bills_df["CustomerID"].astype(str).str.strip(),
+        "CustomerName": bills_df["CustomerName"],
+        "FromDate": pd.to_datetime(bills_df["FromDate"], errors="coerce"),
+        "DueDate": pd.to_datetime(bills_df["DueDate"], errors="coerce"),
+        "Balance": pd.to_numeric(bills_df["BalanceAmount"], errors="coerce").fillna(0),
+    })
+    b = b[b["Balance"] > 0]
+    if b.empty:
+        return empty
+
+    days = (pd.Timestamp(as_of) - b["DueDate"]).dt.days.fillna(0).clip(lower=0)
+    b["DaysPastDue"] = days.astype(int)
+    b["Bucket"] = pd.cut(days, bins=[-1, 7, 30, 60, np.inf], labels=AGING_BUCKETS)
+
+    buckets = (
+        b.pivot_table(index="CustomerID", columns="Bucket", values="Balance",
+                      aggfunc="sum", fill_value=0, observed=False)
+        .reindex(columns=AGING_BUCKETS, fill_value=0)
+    )
+    buckets.columns = list(AGING_BUCKETS)
+
+    oldest = (
+        b.sort_values(["DueDate", "FromDate"], na_position="last")
+        .groupby("CustomerID")
+        .head(1)
+        .set_index("CustomerID")[["BillID", "DueDate"]]
+        .rename(columns={"BillID": "OldestBillID", "DueDate": "OldestDueDate"})
+    )
+
+    customers = (
+        b.groupby("CustomerID")
+        .agg(
+            CustomerName=("CustomerName", "first"),
+            Outstanding=("Balance", "sum"),
+            OpenBills=("Balance", "size"),
+            MaxDaysPastDue=("DaysPastDue", "max"),
+        )
+        .join(buckets)
+        .join(oldest)
+        .sort_values(["MaxDaysPastDue", "Outstanding"], ascending=False)
+        .reset_index()
+    )
+
+    return {"bills": b, "customers": customers, "totals": buckets.sum()}
+
+def allocate_fifo(bills_df, customer_id, amount):
+    """
+    Spread `amount` over the customer's open bills oldest-first
+    (DueDate, then FromDate). Returns the bills that receive money with
+    Applied, NewPaid, NewBalance, NewStatus and SheetRow; the index is
+    bills_df's, so SheetRow = index + 2.
+    """
+    b = bills_df[
+        (bills_df["CustomerID"].astype(str).str.strip() == str(customer_id).strip())
+    ].copy()
+    for col in ["BillAmount", "PaidAmount", "BalanceAmount"]:
+        b[col] = pd.to_numeric(b[col], errors="coerce").fillna(0)
+    b = b[b["BalanceAmount"] > 0]
+    b["_due"] = pd.to_datetime(b["DueDate"], errors="coerce")
+    b["_from"] = pd.to_datetime(b["FromDate"], errors="coerce")
+    b = b.sort_values(["_due", "_from"], kind="mergesort", na_position="last")
+
+    balance = b["BalanceAmount"].to_numpy()
+    before = np.concatenate([[0.0], np.cumsum(balance)[:-1]])
+    b["Applied"] = np.clip(amount - before, 0, balance).round(2)
+    b = b[b["Applied"] > 0]
+
+    b["NewPaid"] = (b["PaidAmount"] + b["Applied"]).round(2)
+    b["NewBalance"] = (b["BalanceAmount"] - b["Applied"]).clip(lower=0).round(2)
+    b["NewStatus"] = np.where(b["NewBalance"] <= 0, "Paid", "Partially Paid")
+    b["SheetRow"] = b.index + 2
+    return b.drop(columns=["_due", "_from"])
+
+@st.cache_resource
+def get_billing_write_lock():
+    """Serializes read-allocate-write of customer payments across sessions."""
+    return threading.Lock()
+
+def read_bills_now():
+    """Billing straight from the sheet, bypassing the 30 s cache (K:O are written as absolute values)."""
+    rows = open_billing_sheet().get_all_values()
+    if len(rows) <= 1:
+        return pd.DataFrame(columns=BILLING_HEADER)
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+def payment_writes(alloc, payment_mode, remarks, user_id, user_name, now):
+    """Billing K:O updates, one Payment row and one wallet credit per allocated bill."""
+    stamp = now.strftime("%Y%m%d%H%M%S%f")
+    due = pd.to_datetime(alloc["DueDate"], errors="coerce")
+    due = due.dt.strftime("%Y-%m-%d").where(due.notna(), "")
+    updates = [
+        sheet_update(BILLING_TAB, f"K{r.SheetRow}:O{r.SheetRow}", [[
+            r.NewPaid,
+            r.NewBalance,
+            r.NewStatus,
+            d,
+            now.strftime("%Y-%m-%d"),
+        ]])
+        for r, d in zip(alloc.itertuples(), due)
+    ]
+    payments = [
+        [
+            f"PAY{stamp}{i:02d}",
+            r.BillID,
+            r.CustomerID,
+            r.CustomerName,
+            r.Applied,
+            payment_mode,
+            user_name,
+            now.strftime("%Y-%m-%d %H:%M:%S"),
+            remarks,
+        ]
+        for i, r in enumerate(alloc.itertuples())
+    ]
+    wallet = [
+        [
+            f"WTXN{stamp}{i:02d}",
+            user_id,
+            user_name,
+            r.Applied,
+            "CREDIT",
+            r.BillID,
+            f"Payment received from {r.CustomerName}",
+            now.strftime("%Y-%m-%d %H:%M:%S"),
+            "COMPLETED",
+        ]
+        for i, r in enumerate(alloc.itertuples())
+    ]
+    return [
+        sheet_append(PAYMENT_TAB, payments),
+        *updates,
+        sheet_append(WALLET_TRANSACTION_TAB, wallet),
+    ]
+
+@st.cache_data(max_entries=8)
+def _receivables(bills_version, as_of, _bills_df):
+    return build_receivables(_bills_df, as_of)
+
+def load_receivables(as_of=None):
+    """Receivables for the current Billing sheet version (payments update bills in place)."""
+    bills_df = load_bills()
+    as_of = pd.Timestamp(as_of or dt.date.today()).normalize()
+    return _receivables(frame_version(bills_df), as_of, bills_df)
+
+# ---------- REPORTS (MONTHLY P&L / CASH FLOW) ----------
+REPORT_SOURCES = ["bills", "payments", "expenses", "meds", "bank", "wallet"]
+
+@st.cache_resource
+def get_report_store():
+    # sigs: month -> (content signature per source..., cost-per-dose signature)
+    return {"lock": threading.Lock(), "pnl": {}, "cash": {}, "sigs": {}}
+
+def report_sources():
+    """Date-indexed (sorted) frames feeding the statements."""
+    return {
+        "bills": date_indexed(BILLING_TAB, load_bills(), "FromDate", ["BillAmount"]),
+        "payments": date_indexed(PAYMENT_TAB, load_payments(), "ReceivedOn", ["PaidAmount"]),
+        "expenses": expenses_by_date(),
+        "meds": date_indexed(MEDICATION_LOG_TAB, load_med_logs(), "GivenOn", ["DoseGiven"]),
+        "bank": load_bank_ledger()["rows"],
+        "wallet": date_indexed(WALLET_TRANSACTION_TAB, load_wallet_df(), "TxnDate", ["Amount"]),
+    }
+
+def report_sheets():
+    """Sheet frames behind each source, with the date column(s) that place a row in a month."""
+    return {
+        "bills": (load_bills(), ["FromDate"]),
+        "payments": (load_payments(), ["ReceivedOn"]),
+        "expenses": (load_expenses(), ["Date"]),
+        "meds": (load_med_logs(), ["GivenOn"]),
+        "bank": (load_bank_transactions(), ["TransactionDate", "Timestamp"]),
+        "wallet": (load_wallet_df(), ["TxnDate"]),
+    }
+
+@st.cache_resource
+def get_month_sig_store(source):
+    # state: month start -> sum of the hashes of that month's rows (mod 2**64)
+    return {"lock": threading.Lock(), "rows": 0, "version": None, "state": None}
+
+def fold_month_signatures(state, rows, date_cols):
+    dates = pd.Series(pd.NaT, index=rows.index, dtype="datetime64[ns]")
+    for col in date_cols:
+        if col in rows:
+            dates = dates.fillna(pd.to_datetime(rows[col], errors="coerce"))
+    dated = dates.notna().to_numpy()
+    if not dated.any():
+        return
+
+    h = pd.util.hash_pandas_object(rows[dated], index=False).to_numpy()
+    month = dates[dated].dt.to_period("M").dt.to_timestamp().to_numpy()
+    for m in np.unique(month):
+        state[m] = (state.get(m, 0) + int(h[month == m].sum())) % 2**64
+
+def month_signatures(source, df, date_cols, months):
+    """
+    Per-month content signature of a sheet; any edit to a month's rows
+    changes it. Kept incrementally: only appended rows are hashed, and an
+    edit or delete anywhere rebuilds (refresh_incremental).
+    """
+    store = get_month_sig_store(source)
+    state = refresh_incremental(
+        store, df, dict,
+        lambda state, rows: fold_month_signatures(state, rows, date_cols),
+    )
+    with store["lock"]:
+        sig = pd.Series({pd.Timestamp(m): v for m, v in state.items()}, dtype="uint64")
+    return sig.reindex(months, fill_value=0).to_numpy()
+
+def _by_month(values, frame):
+    return values.groupby(frame.index.to_period("M").to_timestamp()).sum()
+
+def cost_per_dose_map(meds):
+    """MedicineID -> CostPerDose from Medication_Master."""
+    if meds.empty:
+        return pd.Series(dtype=float)
+    return pd.to_numeric(meds["CostPerDose"], errors="coerce").fillna(0).groupby(meds["MedicineID"]).last()
+
+def build_pnl(src, cost_per_dose):
+    bills, payments, expenses, meds = src["bills"], src["payments"], src["expenses"], src["meds"]
+
+    # medicine purchases are counted when doses are given (below), not when bought
+    expenses = expenses[expenses["Category"] != "Medicine"] if not expenses.empty else expenses
+    by_cat = (
+        expenses.groupby([expenses.index.to_period("M").to_timestamp(), "Category"])["Amount"]
+        .sum()
+        .unstack(fill_value=0)
+        .add_prefix("Exp: ")
+        if not expenses.empty else pd.DataFrame()
+    )
+
+    med_cost = (
+        _by_month(meds["DoseGiven"] * meds["MedicineID"].map(cost_per_dose).fillna(0), meds)
+        if not meds.empty else pd.Series(dtype=float)
+    )
+
+    out = pd.DataFrame({
+        "Billed": _by_month(bills["BillAmount"], bills) if not bills.empty else pd.Series(dtype=float),
+        "Collected": _by_month(payments["PaidAmount"], payments) if not payments.empty else pd.Series(dtype=float),
+        "MedicationCost": med_cost,
+    }).join(by_cat, how="outer").fillna(0)
+
+    out["Expenses"] = out.filter(like="Exp: ").sum(axis=1) + out["MedicationCost"]
+    out["Profit"] = out["Billed"] - out["Expenses"]
+    return out
+
+def build_cash_flow(src):
+    bank, wallet = src["bank"], src["wallet"]
+
+    if not bank.empty:
+        credit = bank["TransactionType"] == "CREDIT"
+        bank_in = _by_month(bank["Amount"].where(credit, 0), bank)
+        bank_out = _by_month(bank["Amount"].where(~credit, 0), bank)
+    else:
+        bank_in = bank_out = pd.Series(dtype=float)
+
+    if not wallet.empty:
+        # user-to-user transfers (REF…) move money inside the business, not in or out of it
+        w = wallet[
+            (wallet["TxnStatus"] == "COMPLETED")
+            & ~wallet["RefID"].astype(str).str.startswith("REF")
+        ]
+        wallet_in = _by_month(w["Amount"].where(w["TxnType"] == "CREDIT", 0), w)
+        wallet_out = _by_month(w["Amount"].where(w["TxnType"] == "DEBIT", 0), w)
+    else:
+        wallet_in = wallet_out = pd.Series(dtype=float)
+
+    out = pd.DataFrame({
+        "BankIn": bank_in, "BankOut": bank_out,
+        "WalletIn": wallet_in, "WalletOut": wallet_out,
+    }).fillna(0)
+    out["BankNet"] = out["BankIn"] - out["BankOut"]
+    out["WalletNet"] = out["WalletIn"] - out["WalletOut"]
+    return out
+
+def load_reports():
+    """
+    Monthly P&L and cash-flow statements. Closed months are materialized
+    once in a cache_resource store and reused while each source's content
+    signature for that month and the CostPerDose table are unchanged; only
+    the open month (and any closed month whose rows were added, removed or
+    edited) is sliced out of the date indexes and recomputed.
+    """
+    src = report_sources()
+    store = get_report_store()
+
+    starts = [f.index[0] for f in src.values() if not f.empty]
+    current = pd.Timestamp.today().normalize().replace(day=1)
+    if not starts:
+        return pd.DataFrame(), pd.DataFrame()
+
+    months = pd.date_range(min(starts).replace(day=1), current, freq="MS")
+    cost_per_dose = cost_per_dose_map(load_med_master())
+    cost_sig = int(pd.util.hash_pandas_object(cost_per_dose).sum()) if not cost_per_dose.empty else 0
+    sigs = pd.DataFrame(
+        {k: month_signatures(k, df, cols, months) for k, (df, cols) in report_sheets().items()},
+        index=months,
+    )
+    sigs["cost"] = cost_sig
+
+    with store["lock"]:
+        stale = [
+            m for m in months
+            if m == current or store["sigs"].get(m) != tuple(sigs.loc[m])
+        ]
+
+        if stale:
+            first = min(stale)
+            part = {k: date_window(f, first) for k, f in src.items()}
+
+            pnl = build_pnl(part, cost_per_dose)
+            cash = build_cash_flow(part)
+
+            for m in stale:
+                store["pnl"][m] = pnl.loc[m] if m in pnl.index else pd.Series(dtype=float)
+                store["cash"][m] = cash.loc[m] if m in cash.index else pd.Series(dtype=float)
+                if m != current:
+                    store["sigs"][m] = tuple(sigs.loc[m])
+
+        pnl = pd.DataFrame({m: store["pnl"][m] for m in months}).T.fillna(0)
+        cash = pd.DataFrame({m: store["cash"][m] for m in months}).T.fillna(0)
+
+    cash = cash.reindex(
+        columns=["BankIn", "BankOut", "BankNet", "WalletIn", "WalletOut", "WalletNet"],
+        fill_value=0,
+    )
+
+    # closing bank balance comes from the ledger's month-end checkpoints
+    checkpoints = load_bank_ledger()["checkpoints"]
+    cash["BankClosing"] = (
+        checkpoints.set_axis(checkpoints.index.to_period("M").to_timestamp())
+        .reindex(cash.index).ffill().fillna(0)
+        if not checkpoints.empty else 0.0
+    )
+
+    pnl = pnl.reindex(
+        columns=["Billed", "Collected"]
+        + sorted(c for c in pnl if c.startswith("Exp: "))
+        + ["MedicationCost", "Expenses", "Profit"],
+        fill_value=0,
+    )
+
+    pnl.index.name = cash.index.name = "Month"
+    return pnl, cash
+
+# ---------- RECONCILIATION (PAYMENTS / WALLET / BANK) ----------
+RECONCILE_EVERY = 30 * 60  # seconds
+WALLET_BANK_CATEGORIES = ["USER_WALLET_CREDIT", "USER_WALLET_DEBIT", "CAPITAL_WITHDRAWAL", "PROFIT_WITHDRAWAL"]
+
+def _amount(col):
+    return pd.to_numeric(col, errors="coerce").fillna(0)
+
+def _compare(left, right, key, left_name, right_name, tol=0.01):
+    """Outer-merge two per-key totals; split into mismatches and orphans on either side."""
+    both = left.rename(left_name).to_frame().join(right.rename(right_name), how="outer")
+    both.index.name = key
+    both = both.reset_index()
+    missing_left = both[left_name].isna()
+    missing_right = both[right_name].isna()
+    mismatch = both[~missing_left & ~missing_right & (both[left_name] - both[right_name]).abs().gt(tol)]
+    return mismatch, both[missing_right], both[missing_left]
+
+def reconcile_ledgers(bills_df, payments_df, wallet_df, bank_df):
+    """
+    Cross-check Billing, Payment, Wallet_Transaction and Bank_Transaction
+    on their reference IDs. Returns {check: DataFrame of offending rows}.
+    """
+    bills = bills_df.assign(PaidAmount=_amount(bills_df["PaidAmount"]))
+    pay = payments_df.assign(PaidAmount=_amount(payments_df["PaidAmount"]))
+    wal = wallet_df.assign(Amount=_amount(wallet_df["Amount"]))
+    bank = bank_df.assign(Amount=_amount(bank_df["Amount"]))
+
+    # ---- Billing.PaidAmount vs Σ Payment.PaidAmount per BillID ----
+    billed_paid = bills.groupby("BillID")["PaidAmount"].sum()
+    paid_by_bill = pay.groupby("BillID")["PaidAmount"].sum()
+    bill_vs_pay, bills_no_payment, payment_orphans = _compare(
+        billed_paid, paid_by_bill, "BillID", "BillingPaid", "PaymentsTotal"
+    )
+    # a bill marked paid with no Payment rows at all is a mismatch too
+    bill_vs_pay = pd.concat([
+        bill_vs_pay,
+        bills_no_payment[bills_no_payment["BillingPaid"].gt(0.01)].fillna({"PaymentsTotal": 0}),
+    ])
+
+    # ---- Σ Payment per BillID vs wallet CREDITs keyed by BillID ----
+    wallet_bills = wal[(wal["TxnType"] == "CREDIT") & wal["RefID"].astype(str).str.startswith("BILL")]
+    pay_vs_wallet, payments_no_wallet, wallet_no_payment = _compare(
+        paid_by_bill, wallet_bills.groupby("RefID")["Amount"].sum(),
+        "BillID", "PaymentsTotal", "WalletCredits"
+    )
+
+    # ---- bank rows that must have a wallet leg (wallet RefID = bank TransactionID) ----
+    bank_wallet = bank[bank["Category"].isin(WALLET_BANK_CATEGORIES)]
+    wallet_bank = wal[wal["RefID"].astype(str).str.startswith("BANKTXN")]
+    bank_vs_wallet, bank_no_wallet, wallet_no_bank = _compare(
+        bank_wallet.groupby("TransactionID")["Amount"].sum(),
+        wallet_bank.groupby("RefID")["Amount"].sum(),
+        "TransactionID", "BankAmount", "WalletAmount"
+    )
+
+    return {
+        "Billing vs payments": bill_vs_pay,
+        "Payments with unknown BillID": payment_orphans,
+        "Payments vs wallet credits": pay_vs_wallet,
+        "Payments without wallet credit": payments_no_wallet,
+        "Wallet credits without payment": wallet_no_payment,
+        "Bank vs wallet": bank_vs_wallet,
+        "Bank rows without wallet entry": bank_no_wallet,
+        "Wallet entries without bank row": wallet_no_bank,
+        "Duplicate BillID": bills[bills.duplicated("BillID", keep=False)],
+        "Duplicate PaymentID": pay[pay.duplicated("PaymentID", keep=False)],
+        "Duplicate bank TransactionID": bank[bank.duplicated("TransactionID", keep=False)],
+        # transfer legs share a TxnID, so a duplicate is the same TxnID for the same user and side
+        "Duplicate wallet entries": wal[wal.duplicated(["TxnID", "UserID", "TxnType"], keep=False)],
+    }
+
+def fetch_tab(sh, tab, header):
+    rows = sh.worksheet(tab).get_all_values()
+    if len(rows) <= 1:
+        return pd.DataFrame(columns=header)
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+def run_reconciliation(job, client):
+    sh = client.open_by_key(MAIN_SHEET_ID)
+    result = reconcile_ledgers(
+        fetch_tab(sh, BILLING_TAB, BILLING_HEADER),
+        fetch_tab(sh, PAYMENT_TAB, PAYMENT_HEADER),
+        fetch_tab(sh, WALLET_TRANSACTION_TAB, WALLET_HEADER),
+        fetch_tab(sh, BANK_TRANSACTION_TAB, BANK_TRANSACTION_HEADER),
+    )
+    with job["lock"]:
+        job["result"] = result
+        job["ran_at"] = dt.datetime.now()
+        job["error"] = None
+
+def reconciliation_worker(job, creds_dict):
+    """
+    One reconciliation every RECONCILE_EVERY seconds. Any failure, auth
+    included, is recorded in job["error"] for the page and the loop goes
+    on; the client is re-created on the next cycle.
+    """
+    client = None
+    while True:
+        try:
+            client = client or init_gsheets(creds_dict)
+            run_reconciliation(job, client)
+        except Exception as e:
+            client = None
+            with job["lock"]:
+                job["error"] = f"{type(e).__name__}: {e}"
+                job["failed_at"] = dt.datetime.now()
+        job["wake"].wait(RECONCILE_EVERY)
+        job["wake"].clear()
+
+def start_reconciliation_worker(job):
+    job["thread"] = threading.Thread(
+        target=reconciliation_worker,
+        args=(job, job["creds"]),
+        name="reconciliation",
+        daemon=True,
+    )
+    job["thread"].start()
+
+@st.cache_resource
+def get_reconciliation_job():
+    """Background reconciliation, once per process, with its own gspread client."""
+    job = {
+        "lock": threading.Lock(),
+        "result": None,
+        "ran_at": None,
+        "error": None,
+        "failed_at": None,
+        "wake": threading.Event(),
+        "creds": dict(st.secrets["gcp_service_account"]),  # read here, not in the worker thread
+    }
+    start_reconciliation_worker(job)
+    return job
+
+get_reconciliation_job()
+
 # =======================
 # 🐄 Cow Sheet Helpers
 # =======================
@@ -526,7 +3239,7 @@ def open_cow_sheet():
     return open_sheet(MAIN_SHEET_ID, COW_PROFILE_TAB)
 
 
-@st.cache_data(ttl=60)
+@sheet_loader(ttl=60)
 def load_cows():
     ws = open_cow_sheet()
     rows = ws.get_all_values()
@@ -536,6 +3249,618 @@ def load_cows():
 
     return pd.DataFrame(rows[1:], columns=rows[0])
 
+# ---------- COW P&L (PER-COW PROFITABILITY) ----------
+def _num(df, col):
+    if col not in df:
+        return pd.Series(0.0, index=df.index)
+    return pd.to_numeric(df[col], errors="coerce").fillna(0)
+
+def build_cow_pnl(cows, milk, bills, expenses, med_logs, cost_per_dose):
+    """
+    Lifetime P&L per cow in one vectorised pass.
+    Milk revenue uses the herd's realized rate (billed amount / billed litres).
+    Expense and Medication_Log rows store the TagNumber in CowID, so they are
+    mapped back to CowID; "All COW" expenses are shared and returned apart.
+    Medicine expenses are skipped because doses are costed via CostPerDose.
+    Returns {"cows", "rate", "shared"}.
+    """
+    cows = cows.assign(CowID=cows["CowID"].astype(str).str.strip()).drop_duplicates("CowID").set_index("CowID")
+    tag_to_id = pd.Series(cows.index, index=cows["TagNumber"].astype(str).str.strip())
+    tag_to_id = tag_to_id[~tag_to_id.index.duplicated()]
+
+    def cow_key(col):
+        key = col.astype(str).str.strip()
+        return key.map(tag_to_id).fillna(key)
+
+    litres_billed = _num(bills, "TotalMilk").sum()
+    rate = _num(bills, "BillAmount").sum() / litres_billed if litres_billed else 0.0
+
+    litres = _num(milk, "MilkQuantity").groupby(cow_key(milk["CowID"])).sum() if not milk.empty else pd.Series(dtype=float)
+
+    if not expenses.empty:
+        exp = expenses[expenses["Category"] != "Medicine"]
+        # bank-paid expenses were written as "All_COW"
+        shared = exp["CowID"].astype(str).str.strip().str.replace("_", " ").str.upper() == "ALL COW"
+        direct = _num(exp, "Amount")[~shared].groupby(cow_key(exp.loc[~shared, "CowID"])).sum()
+        shared_total = float(_num(exp, "Amount")[shared].sum())
+    else:
+        direct, shared_total = pd.Series(dtype=float), 0.0
+
+    med_cost = (
+        (_num(med_logs, "DoseGiven") * med_logs["MedicineID"].map(cost_per_dose).fillna(0))
+        .groupby(cow_key(med_logs["CowID"])).sum()
+        if not med_logs.empty else pd.Series(dtype=float)
+    )
+
+    out = pd.DataFrame({
+        "TagNumber": cows["TagNumber"],
+        "Status": cows["Status"],
+        "Litres": litres.reindex(cows.index).fillna(0),
+        "DirectExpense": direct.reindex(cows.index).fillna(0),
+        "MedicationCost": med_cost.reindex(cows.index).fillna(0),
+        "PurchasePrice": _num(cows, "PurchasePrice"),
+        "SoldPrice": _num(cows, "SoldPrice"),
+    })
+    out["MilkRevenue"] = out["Litres"] * rate
+    out["Profit"] = (
+        out["MilkRevenue"] + out["SoldPrice"]
+        - out["DirectExpense"] - out["MedicationCost"] - out["PurchasePrice"]
+    )
+    return {
+        "cows": out.sort_values("Profit", ascending=False),
+        "rate": rate,
+        "shared": shared_total,
+    }
+
+@st.cache_data(max_entries=8)
+def _cow_pnl(versions, _cows, _milk, _bills, _expenses, _med_logs, _med_master):
+    return build_cow_pnl(_cows, _milk, _bills, _expenses, _med_logs, cost_per_dose_map(_med_master))
+
+def load_cow_pnl():
+    """Cow P&L for the current version of every source sheet."""
+    frames = (load_cows(), load_milking_data(), load_bills(), load_expenses(), load_med_logs(), load_med_master())
+    return _cow_pnl(tuple(frame_version(f) for f in frames), *frames)
+
+# ============================================================
+# SYNTHETIC DATA + BENCHMARKS
+# ============================================================
+BENCH_SCALES = {
+    "S": {"cows": 10, "customers": 40, "days": 365, "wallet_txns": 5_000},
+    "M": {"cows": 25, "customers": 150, "days": 730, "wallet_txns": 30_000},
+    "L": {"cows": 50, "customers": 300, "days": 1095, "wallet_txns": 100_000},
+}
+BENCH_REPEAT = 3
+BENCH_REPORT_FILE = "benchmark_report.csv"
+BENCH_REPORT_COLUMNS = ["RunAt", "Scale", "Page", "Step", "Rows", "BestMs", "MedianMs"]
+BENCH_USERS = [("U001", "Govind"), ("U002", "Ramesh"), ("U003", "Suresh"), ("U004", "Mahesh")]
+BENCH_EXPENSES = {  # category -> (min, max) amount
+    "Feed": (800, 6000),
+    "Labour": (500, 3000),
+    "Electricity": (300, 2500),
+    "Maintenance": (200, 4000),
+    "Medicine": (150, 1500),
+    "Other": (100, 1000),
+}
+
+def _sheet_frame(columns, header):
+    """All-string frame in header order, like get_all_values() returns."""
+    return pd.DataFrame(columns)[header].astype(str)
+
+def _ids(prefix, stamps, start=0):
+    """prefix + yyyymmdd of each stamp + running number, unique within one call."""
+    days = pd.DatetimeIndex(stamps).strftime("%Y%m%d")
+    return [f"{prefix}{d}{i:06d}" for i, d in enumerate(days, start)]
+
+def synthetic_tabs(cows, customers, days, wallet_txns, seed=0, end=None):
+    """
+    Realistic, mutually consistent sheet data ending at `end` (default
+    today), keyed by tab name and matching the *_HEADER constants:
+    Wood-curve milking with dry periods, skipped shifts and sudden drops,
+    per-customer deliveries, monthly bills (recent ones left open),
+    payments with their wallet credits, bank rows with wallet legs,
+    user-to-user transfers, expenses and medication doses.
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end or dt.date.today()).normalize()
+    dates = pd.date_range(end=end, periods=days, freq="D")
+    date_str = dates.strftime("%Y-%m-%d").to_numpy()
+    shifts = np.array(["Morning", "Evening"])
+    hours = pd.to_timedelta([6, 18], unit="h")
+    users = np.array([u for u, _ in BENCH_USERS])
+    names = dict(BENCH_USERS)
+
+    # ---- cows ----
+    cow_ids = np.array([f"COW{i:04d}" for i in range(1, cows + 1)])
+    tags = np.array([f"TAG-{i:04d}" for i in range(1, cows + 1)])
+    cow_df = _sheet_frame({
+        "CowID": cow_ids,
+        "ParentCowID": "",
+        "TagNumber": tags,
+        "Gender": "Female",
+        "Breed": rng.choice(["Gir", "Sahiwal", "HF Cross", "Jersey"], cows),
+        "AgeYears": rng.integers(3, 9, cows),
+        "PurchaseDate": (dates[0] - pd.to_timedelta(rng.integers(0, 700, cows), unit="D")).strftime("%Y-%m-%d"),
+        "PurchasePrice": rng.integers(40, 90, cows) * 1000,
+        "SoldPrice": "",
+        "SoldDate": "",
+        "Status": "Active",
+        "MilkingStatus": "Milking",
+        "Notes": "",
+        "BirthYear": end.year - rng.integers(3, 9, cows),
+        "Timestamp": f"{date_str[0]} 09:00:00",
+    }, COW_HEADER)
+
+    # ---- milking: day x shift x cow, 60 dry days per 365-day cycle ----
+    day_i = np.repeat(np.arange(days), 2 * cows)
+    shift_i = np.tile(np.repeat([0, 1], cows), days)
+    cow_i = np.tile(np.arange(cows), 2 * days)
+    dim = (day_i + rng.integers(0, 365, cows)[cow_i]) % 365 + 1
+    qty = wood_yield(5.0, 0.2, 0.004, dim) * rng.uniform(0.7, 1.3, cows)[cow_i] * rng.normal(1, 0.08, len(dim))
+    qty = np.where(rng.random(len(qty)) < 0.002, qty * 0.4, qty)  # sudden drops
+    skipped = rng.random(2 * days) < 0.005                          # shifts never recorded
+    skipped[-2:] = True                                             # today is still open
+    keep = (dim <= 305) & ~skipped[day_i * 2 + shift_i]
+    day_i, shift_i, cow_i, qty = day_i[keep], shift_i[keep], cow_i[keep], qty[keep]
+    milk_df = _sheet_frame({
+        "Date": date_str[day_i],
+        "Shift": shifts[shift_i],
+        "CowID": cow_ids[cow_i],
+        "TagNumber": tags[cow_i],
+        "MilkQuantity": np.maximum(qty, 0).round(1),
+        "Timestamp": (dates[day_i] + hours[shift_i]).strftime("%Y-%m-%d %H:%M:%S"),
+    }, MILKING_HEADER)
+
+    # ---- milk distribution: (customer, shift) pairs per day ----
+    cust_ids = np.array([f"CU{i:06d}" for i in range(1, customers + 1)])
+    cust_names = np.array([f"Customer {i}" for i in range(1, customers + 1)])
+    both = rng.random(customers) < 0.3
+    pair_cust = np.concatenate([np.arange(customers), np.flatnonzero(both)])
+    pair_shift = np.concatenate([rng.integers(0, 2, customers), 1 - rng.integers(0, 2, customers)[both]])
+    pair_qty = rng.choice([0.5, 1.0, 1.5, 2.0, 3.0], len(pair_cust))
+    n_pairs = len(pair_cust)
+    day_i = np.repeat(np.arange(days), n_pairs)
+    pair_i = np.tile(np.arange(n_pairs), days)
+    milked = ~skipped
+    milked[-4:] = False  # the latest milked shifts are not distributed yet
+    keep = milked[day_i * 2 + pair_shift[pair_i]] & (rng.random(len(day_i)) > 0.03)
+    day_i, pair_i = day_i[keep], pair_i[keep]
+    delivered = (pair_qty[pair_i] * rng.normal(1, 0.05, len(pair_i)) * 4).round() / 4
+    bitran_df = _sheet_frame({
+        "Date": date_str[day_i],
+        "Shift": shifts[pair_shift[pair_i]],
+        "CustomerID": cust_ids[pair_cust[pair_i]],
+        "CustomerName": cust_names[pair_cust[pair_i]],
+        "MilkDelivered": delivered,
+        "Timestamp": (dates[day_i] + hours[pair_shift[pair_i]]).strftime("%Y-%m-%d %H:%M:%S"),
+    }, BITRAN_HEADER)
+
+    # ---- billing: one bill per customer per closed month ----
+    d = pd.DataFrame({
+        "Cust": pair_cust[pair_i],
+        "Day": day_i,
+        "Month": dates[day_i].to_period("M"),
+        "Morning": np.where(pair_shift[pair_i] == 0, delivered, 0.0),
+        "Evening": np.where(pair_shift[pair_i] == 1, delivered, 0.0),
+    })
+    d = d[d["Month"] < end.to_period("M")]
+    g = d.groupby(["Cust", "Month"])
+    bills = g[["Morning", "Evening"]].sum().reset_index()
+
+    got = np.zeros((customers, days), dtype=bool)
+    got[d["Cust"].to_numpy(), d["Day"].to_numpy()] = True
+    month_of_day = dates.to_period("M")
+    missing = []
+    for c, m in zip(bills["Cust"], bills["Month"]):
+        in_month = month_of_day == m
+        missing.append(",".join(str(x.day) for x in dates[in_month & ~got[c]]))
+
+    rate = rng.choice([50, 55, 60], customers)[bills["Cust"]]
+    total = (bills["Morning"] + bills["Evening"]).round(2)
+    amount = (total * rate).round()
+    from_d = bills["Month"].dt.start_time
+    to_d = bills["Month"].dt.end_time.dt.normalize()
+    due = to_d + pd.Timedelta(days=7)
+    age = (end.to_period("M") - bills["Month"]).apply(lambda x: x.n)
+    u = rng.random(len(bills))
+    paid_share = np.where(age > 2, 1.0, np.where(u < 0.6, 0.0, np.where(u < 0.7, 0.5, 1.0)))
+    paid = (amount * paid_share).round()
+    status = np.select([paid >= amount, paid > 0], ["Paid", "Partially Paid"], "Payment Pending")
+    generated = to_d + pd.Timedelta(days=1, hours=10)
+    paid_on = (generated.dt.normalize() + pd.to_timedelta(rng.integers(0, 12, len(bills)), unit="D")).clip(upper=end)
+    bill_ids = _ids("BILL", generated)
+    bill_df = _sheet_frame({
+        "BillID": bill_ids,
+        "CustomerID": cust_ids[bills["Cust"]],
+        "CustomerName": cust_names[bills["Cust"]],
+        "FromDate": from_d.dt.strftime("%Y-%m-%d"),
+        "ToDate": to_d.dt.strftime("%Y-%m-%d"),
+        "MorningMilk": bills["Morning"].round(2),
+        "EveningMilk": bills["Evening"].round(2),
+        "TotalMilk": total,
+        "RatePerLitre": rate,
+        "BillAmount": amount,
+        "PaidAmount": paid,
+        "BalanceAmount": amount - paid,
+        "BillStatus": status,
+        "DueDate": due.dt.strftime("%Y-%m-%d"),
+        "PaidDate": np.where(paid > 0, paid_on.dt.strftime("%Y-%m-%d"), ""),
+        "DailyMilkPattern": missing,
+        "GeneratedBy": names["U001"],
+        "GeneratedOn": generated.dt.strftime("%Y-%m-%d %H:%M:%S"),
+    }, BILLING_HEADER)
+
+    # ---- payments + their wallet credits ----
+    p = bill_df[paid > 0]
+    pay_on = pd.to_datetime(p["PaidDate"]) + pd.Timedelta(hours=11)
+    receiver = rng.choice(users, len(p))
+    payment_df = _sheet_frame({
+        "PaymentID": _ids("PAY", pay_on),
+        "BillID": p["BillID"],
+        "CustomerID": p["CustomerID"],
+        "CustomerName": p["CustomerName"],
+        "PaidAmount": p["PaidAmount"],
+        "PaymentMode": rng.choice(["Cash", "UPI", "Bank Transfer"], len(p)),
+        "ReceivedBy": [names[r] for r in receiver],
+        "ReceivedOn": pay_on.dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "Remarks": "",
+    }, PAYMENT_HEADER)
+
+    wallet = [pd.DataFrame({
+        "TxnID": _ids("WTXN", pay_on),
+        "UserID": receiver,
+        "Name": [names[r] for r in receiver],
+        "Amount": p["PaidAmount"].to_numpy(),
+        "TxnType": "CREDIT",
+        "RefID": p["BillID"].to_numpy(),
+        "Description": "Payment received from " + p["CustomerName"].to_numpy(),
+        "TxnDate": pay_on.dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy(),
+        "TxnStatus": "COMPLETED",
+        "CounterpartyUserID": "",
+        "TransferID": "",
+    })]
+
+    # ---- expenses, a fifth of them paid from the bank ----
+    n_exp = 2 * days
+    exp_on = dates[rng.integers(0, days, n_exp)].sort_values() + pd.Timedelta(hours=15)
+    cats = rng.choice(list(BENCH_EXPENSES), n_exp)
+    lo, hi = np.array([BENCH_EXPENSES[c] for c in cats]).T
+    exp_amount = rng.integers(lo, hi)
+    by_bank = rng.random(n_exp) < 0.2
+    exp_ids = _ids("EXP", exp_on)
+    expense_df = _sheet_frame({
+        "ExpenseID": exp_ids,
+        "Date": exp_on.strftime("%Y-%m-%d"),
+        "Category": cats,
+        "CowID": np.where(rng.random(n_exp) < 0.6, "All COW", tags[rng.integers(0, cows, n_exp)]),
+        "Amount": exp_amount,
+        "PaymentMode": np.where(by_bank, "BANK ONLINE", rng.choice(["Cash", "UPI"], n_exp)),
+        "ExpenseBy": np.where(by_bank, "BANK ACCOUNT", rng.choice(list(names.values()), n_exp)),
+        "FileURL": "",
+        "Notes": "",
+        "Timestamp": exp_on.strftime("%Y-%m-%d %H:%M:%S"),
+    }, EXPENSE_HEADER)
+
+    # ---- bank: wallet deposits (with wallet legs) + bank-paid expenses ----
+    left = max(wallet_txns - len(p), 0)
+    n_dep = left // 4
+    dep_on = dates[rng.integers(0, days, n_dep)] + pd.Timedelta(hours=17)
+    dep_user = rng.choice(users, n_dep)
+    # deposits move about 80% of the collected cash into the bank
+    dep_amount = (rng.uniform(0.5, 1.5, n_dep) * 0.8 * p["PaidAmount"].astype(float).sum() / max(n_dep, 1) / 100).round() * 100
+    bank = pd.DataFrame({
+        "When": np.concatenate([dep_on.to_numpy(), exp_on[by_bank].to_numpy()]),
+        "TransactionType": ["CREDIT"] * n_dep + ["DEBIT"] * int(by_bank.sum()),
+        "Category": ["USER_WALLET_CREDIT"] * n_dep + ["EXPENSE"] * int(by_bank.sum()),
+        "Amount": np.concatenate([dep_amount, exp_amount[by_bank]]),
+        "FromAccount": [names[u] for u in dep_user] + ["BANK ACCOUNT"] * int(by_bank.sum()),
+        "ToAccount": ["BANK ACCOUNT"] * n_dep + ["EXPENSE"] * int(by_bank.sum()),
+        "RelatedEntityType": ["USER Wallet"] * n_dep + ["EXPENSE"] * int(by_bank.sum()),
+        "ReferenceID": _ids("WTXN", dep_on, start=len(p)) + list(np.array(exp_ids)[by_bank]),
+        "User": list(dep_user) + ["U001"] * int(by_bank.sum()),
+    }).sort_values("When", kind="stable").reset_index(drop=True)
+    signed = np.where(bank["TransactionType"] == "CREDIT", bank["Amount"], -bank["Amount"])
+    closing = 50_000 + np.cumsum(signed)
+    bank["TransactionID"] = _ids("BANKTXN", bank["When"])
+    bank_df = _sheet_frame({
+        **{c: bank[c] for c in ["TransactionID", "TransactionType", "Category", "Amount", "FromAccount",
+                                "ToAccount", "RelatedEntityType", "ReferenceID"]},
+        "TransactionDate": bank["When"].dt.strftime("%Y-%m-%d"),
+        "Notes": "",
+        "OpeningBalance": closing - signed,
+        "ClosingBalance": closing,
+        "CreatedBy": [names[u] for u in bank["User"]],
+        "Timestamp": bank["When"].dt.strftime("%Y-%m-%d %H:%M:%S"),
+    }, BANK_TRANSACTION_HEADER)
+
+    dep = bank[bank["Category"] == "USER_WALLET_CREDIT"]
+    wallet.append(pd.DataFrame({
+        "TxnID": dep["ReferenceID"].to_numpy(),
+        "UserID": dep["User"].to_numpy(),
+        "Name": [names[u] for u in dep["User"]],
+        "Amount": dep["Amount"].to_numpy(),
+        "TxnType": "DEBIT",
+        "RefID": dep["TransactionID"].to_numpy(),
+        "Description": "Amount to BANK ACCOUNT",
+        "TxnDate": dep["When"].dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy(),
+        "TxnStatus": "COMPLETED",
+        "CounterpartyUserID": "",
+        "TransferID": "",
+    }))
+
+    # ---- user-to-user transfers: DEBIT + CREDIT legs sharing a REF id ----
+    n_tr = (left - n_dep) // 2
+    tr_on = dates[rng.integers(0, days, n_tr)] + pd.Timedelta(hours=19)
+    sender = rng.integers(0, len(users), n_tr)
+    to = users[(sender + rng.integers(1, len(users), n_tr)) % len(users)]
+    sender = users[sender]
+    tr_amount = rng.integers(1, 50, n_tr) * 100
+    tr_status = np.where(rng.random(n_tr) < 0.03, "PENDING", "COMPLETED")
+    refs = _ids("REF", tr_on)
+    txn_ids = _ids("WTXN", tr_on, start=len(p) + n_dep)
+    when = tr_on.strftime("%Y-%m-%d %H:%M:%S")
+    for uid, other, ttype, word in [(sender, to, "DEBIT", "to"), (to, sender, "CREDIT", "from")]:
+        wallet.append(pd.DataFrame({
+            "TxnID": txn_ids,
+            "UserID": uid,
+            "Name": [names[u] for u in uid],
+            "Amount": tr_amount,
+            "TxnType": ttype,
+            "RefID": refs,
+            "Description": [f"Transfer {word} {names[o]}" for o in other],
+            "TxnDate": when,
+            "TxnStatus": tr_status,
+            "CounterpartyUserID": other,
+            "TransferID": "",
+        }))
+    wallet_df = _sheet_frame(
+        pd.concat(wallet, ignore_index=True).sort_values("TxnDate", kind="stable").reset_index(drop=True),
+        WALLET_HEADER,
+    )
+
+    # ---- medicines + a dose per cow roughly every 45 days ----
+    med_names = ["Calcium", "Dewormer", "Mineral Mix", "Antibiotic", "Liver Tonic", "FMD Vaccine"]
+    every = np.array([30, 90, 15, 0, 30, 180])
+    med_ids = np.array([f"MED{i:03d}" for i in range(1, len(med_names) + 1)])
+    med_master = _sheet_frame({
+        "MedicineID": med_ids,
+        "MedicineName": med_names,
+        "MedicineType": "General",
+        "ApplicableFor": "Cow",
+        "DefaultDose": 1,
+        "DoseUnit": "ml",
+        "FrequencyType": np.where(every > 0, "Recurring", "One Time"),
+        "FrequencyValue": every,
+        "FrequencyUnit": "Days",
+        "TotalCost": 1000,
+        "TotalUnits": 100,
+        "CostPerDose": rng.integers(5, 80, len(med_ids)),
+        "StockAvailable": 100,
+        "Status": "Active",
+        "MedicineImageURL": "",
+        "Notes": "",
+        "CreatedBy": names["U001"],
+        "CreatedOn": f"{date_str[0]} 09:00:00",
+    }, MEDECINE_HEADER)
+
+    n_doses = cows * days // 45
+    med_i = rng.integers(0, len(med_ids), n_doses)
+    given = dates[rng.integers(0, days, n_doses)].sort_values()
+    next_due = given + pd.to_timedelta(every[med_i], unit="D")
+    med_log = _sheet_frame({
+        "LogID": _ids("LOG", given),
+        "CowID": tags[rng.integers(0, cows, n_doses)],
+        "MedicineID": med_ids[med_i],
+        "MedicineName": np.array(med_names)[med_i],
+        "DoseGiven": rng.integers(1, 4, n_doses),
+        "DoseUnit": "ml",
+        "GivenOn": given.strftime("%Y-%m-%d"),
+        "GivenBy": rng.choice(list(names.values()), n_doses),
+        "FrequencyType": np.where(every[med_i] > 0, "Recurring", "One Time"),
+        "FrequencyValue": every[med_i],
+        "FrequencyUnit": "Days",
+        "Notes": "",
+        "NextDueDate": np.where(every[med_i] > 0, next_due.strftime("%Y-%m-%d"), ""),
+    }, MEDICATION_LOG_HEADER)
+
+    return {
+        COW_PROFILE_TAB: cow_df,
+        MILKING_TAB: milk_df,
+        BITRAN_TAB: bitran_df,
+        BILLING_TAB: bill_df,
+        PAYMENT_TAB: payment_df,
+        EXPENSE_TAB: expense_df,
+        BANK_TRANSACTION_TAB: bank_df,
+        WALLET_TRANSACTION_TAB: wallet_df,
+        MEDICATION_MASTER_TAB: med_master,
+        MEDICATION_LOG_TAB: med_log,
+    }
+
+def time_call(run, setup=None, repeat=BENCH_REPEAT):
+    """(best, median) wall time in ms of run(*setup()); setup is not timed."""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        t0 = time.perf_counter()
+        run(*args)
+        times.append((time.perf_counter() - t0) * 1000)
+    return min(times), float(np.median(times))
+
+def benchmark_cases(tabs, today):
+    """
+    (page, step, input rows, setup, run) for each page's data prep, on
+    frames typed the way the loaders return them. Caches and the
+    process-wide stores are bypassed: every run rebuilds from scratch
+    unless the step says otherwise.
+    """
+    milk = tabs[MILKING_TAB].assign(
+        MilkQuantity=pd.to_numeric(tabs[MILKING_TAB]["MilkQuantity"]),
+        Date=pd.to_datetime(tabs[MILKING_TAB]["Date"]).dt.date,
+    )
+    bitran = tabs[BITRAN_TAB]
+    bitran_typed = bitran.assign(
+        MilkDelivered=pd.to_numeric(bitran["MilkDelivered"]),
+        Date=pd.to_datetime(bitran["Date"]),
+    )
+    bills, payments = tabs[BILLING_TAB], tabs[PAYMENT_TAB]
+    wallet, bank = tabs[WALLET_TRANSACTION_TAB], tabs[BANK_TRANSACTION_TAB]
+    expenses, med_logs = tabs[EXPENSE_TAB], tabs[MEDICATION_LOG_TAB]
+    cows = tabs[COW_PROFILE_TAB]
+    cost_per_dose = cost_per_dose_map(tabs[MEDICATION_MASTER_TAB])
+
+    milk_state = empty_rollups()
+    fold_rollups(milk_state, milk, "CowID", "MilkQuantity")
+    bitran_state = empty_rollups()
+    fold_rollups(bitran_state, bitran, "CustomerID", "MilkDelivered")
+
+    last_slot = milk["Timestamp"] == milk["Timestamp"].max()
+    month_start = today.replace(day=1)
+    last_month = month_start - pd.DateOffset(months=1)
+    customers = bitran["CustomerID"].unique()
+    top_customer = bills["CustomerID"].value_counts().index[0] if not bills.empty else ""
+
+    src = {
+        "bills": build_date_index(bills, "FromDate", ["BillAmount"]),
+        "payments": build_date_index(payments, "ReceivedOn", ["PaidAmount"]),
+        "expenses": build_date_index(expenses, "Date", ["Amount"]),
+        "meds": build_date_index(med_logs, "GivenOn", ["DoseGiven"]),
+        "bank": build_bank_ledger(bank)["rows"],
+        "wallet": build_date_index(wallet, "TxnDate", ["Amount"]),
+    }
+
+    def rollups_before_last_shift():
+        state = empty_rollups()
+        fold_rollups(state, milk[~last_slot], "CowID", "MilkQuantity")
+        return (state,)
+
+    def due_doses():
+        state = empty_schedule()
+        fold_schedule(state, med_logs)
+        return pop_due(state, today + pd.Timedelta(days=DUE_SOON_DAYS))
+
+    def drops_with_medication():
+        scores = empty_anomalies()
+        fold_anomalies(scores, milk)
+        drops = scores["scores"][scores["scores"]["Z"] <= ANOMALY_Z]
+        return link_medications(drops, med_logs, cows)
+
+    def wallet_balances():
+        balances = {}
+        apply_wallet_delta(balances, wallet["UserID"].to_numpy(dtype=object), wallet_contrib(wallet))
+        return balances
+
+    return [
+        ("Milking", "Rollups (full rebuild)", len(milk), None,
+         lambda: fold_rollups(empty_rollups(), milk, "CowID", "MilkQuantity")),
+        ("Milking", "Rollups (append last shift)", int(last_slot.sum()), rollups_before_last_shift,
+         lambda state: fold_rollups(state, milk[last_slot], "CowID", "MilkQuantity")),
+        ("Milking", "Pending shifts", len(milk_state["day_shift"]), None,
+         lambda: pending_milking_shifts(milk_state, today)),
+        ("Milking", "Lactation curve fit", len(milk_state["day_id"]), None,
+         lambda: fit_wood(lactation_points(milk_state))),
+        ("Milking", "Yield drops + medications", len(milk), None, drops_with_medication),
+        ("Milk Bitran", "Rollups (full rebuild)", len(bitran), None,
+         lambda: fold_rollups(empty_rollups(), bitran, "CustomerID", "MilkDelivered")),
+        ("Milk Bitran", "Delivery snapshot", len(bitran_state["day_id"]), None,
+         lambda: rollup_delivery_snapshot(bitran_state, month_start)),
+        ("Milk Bitran", "Pending shifts", len(milk_state["day_shift"]), None,
+         lambda: pending_bitran_shifts(milk_state, bitran_state)),
+        ("Billing", "Bill preview (all customers, last month)", len(bitran), None,
+         lambda: [calculate_milk(bitran_typed, c, last_month, month_start - pd.Timedelta(days=1)) for c in customers]),
+        ("Payment", "Receivables + aging", len(bills), None,
+         lambda: build_receivables(bills, today)),
+        ("Payment", "FIFO allocation", len(bills), None,
+         lambda: allocate_fifo(bills, top_customer, 5_000)),
+        ("Bank Account", "Ledger + running balance", len(bank), None,
+         lambda: build_bank_ledger(bank)),
+        ("My Wallet", "Balances (full rebuild)", len(wallet), None, wallet_balances),
+        ("Medication", "Due doses", len(med_logs), None, due_doses),
+        ("Cow Profile", "Cow P&L", len(milk) + len(bills) + len(expenses) + len(med_logs), None,
+         lambda: build_cow_pnl(cows, milk, bills, expenses, med_logs, cost_per_dose)),
+        ("Reports", "P&L + cash flow", sum(len(f) for f in src.values()), None,
+         lambda: (build_pnl(src, cost_per_dose), build_cash_flow(src))),
+        ("Reports", "Reconciliation", len(bills) + len(payments) + len(wallet) + len(bank), None,
+         lambda: reconcile_ledgers(bills, payments, wallet, bank)),
+    ]
+
+def run_benchmarks(scales, repeat=BENCH_REPEAT, today=None, progress=None):
+    """
+    Generate each scale's data and time every benchmark case on it.
+    Returns one BENCH_REPORT_COLUMNS row per (scale, step); the generator
+    itself is reported as page "Synthetic data".
+    `progress(fraction, text)` is called before each scale.
+    """
+    today = pd.Timestamp(today or dt.date.today()).normalize()
+    run_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+
+    for n, scale in enumerate(scales):
+        if progress:
+            progress(n / len(scales), f"Scale {scale}")
+
+        t0 = time.perf_counter()
+        tabs = synthetic_tabs(**BENCH_SCALES[scale], end=today)
+        gen_ms = (time.perf_counter() - t0) * 1000
+        rows.append([run_at, scale, "Synthetic data", "Generate all tabs",
+                     sum(len(df) for df in tabs.values()), gen_ms, gen_ms])
+
+        for page, step, n_rows, setup, run in benchmark_cases(tabs, today):
+            best, median = time_call(run, setup, repeat)
+            rows.append([run_at, scale, page, step, n_rows, best, median])
+
+    if progress:
+        progress(1.0, "Done")
+    return pd.DataFrame(rows, columns=BENCH_REPORT_COLUMNS).round({"BestMs": 2, "MedianMs": 2})
+
+def save_benchmark_report(report):
+    """
+    Append to this session's run history. Nothing is written next to the
+    app; the history is offered as a CSV download and an earlier download
+    can be loaded back to compare code versions.
+    """
+    st.session_state.bench_history = pd.concat(
+        [load_benchmark_history(), report], ignore_index=True
+    )
+
+def load_benchmark_history():
+    history = st.session_state.get("bench_history")
+    return history if history is not None else pd.DataFrame(columns=BENCH_REPORT_COLUMNS)
+
+def import_benchmark_report(file):
+    """Merge a previously downloaded report CSV into this session's history."""
+    old = pd.read_csv(file)
+    missing = set(BENCH_REPORT_COLUMNS) - set(old.columns)
+    if missing:
+        raise ValueError(f"Not a benchmark report (missing {', '.join(sorted(missing))})")
+    st.session_state.bench_history = (
+        pd.concat([old[BENCH_REPORT_COLUMNS], load_benchmark_history()], ignore_index=True)
+        .drop_duplicates(["RunAt", "Scale", "Page", "Step"], keep="last")
+        .reset_index(drop=True)
+    )
+
+def compare_benchmarks(history):
+    """Latest run with each step's BestMs from the previous run of the same scale."""
+    if history.empty:
+        return history.assign(PrevBestMs=pd.Series(dtype=float), ChangePct=pd.Series(dtype=float))
+
+    keys = ["Scale", "Page", "Step"]
+    latest = history[history["RunAt"] == history["RunAt"].max()]
+    older = history[history["RunAt"] < history["RunAt"].max()]
+    prev = (
+        older.sort_values("RunAt").groupby(keys).tail(1)[keys + ["BestMs"]]
+        .rename(columns={"BestMs": "PrevBestMs"})
+    )
+    out = latest.merge(prev, on=keys, how="left")
+    out["ChangePct"] = ((out["BestMs"] / out["PrevBestMs"] - 1) * 100).round(1)
+    return out
+
+def synthetic_zip(tabs):
+    """One CSV per tab, zipped, for loading into a scratch spreadsheet."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        for tab, df in tabs.items():
+            z.writestr(f"{tab}.csv", df.to_csv(index=False))
+    return buf.getvalue()
+
 # ============================================================
 # QUERY PARAM (SAFE)
 # ============================================================
@@ -558,17 +3883,18 @@ if not st.session_state.authenticated:
 
             if st.button("Send OTP"):
 
-                user = auth_df[auth_df["username"] == username_input]
+                throttled(("otp_user", username_input), ("otp_client", client_key()))
+                user = find_user(username=username_input)
 
-                if user.empty:
+                if user is None:
                     st.error("❌ Username not found")
                     st.stop()
 
-                registered_email = user.iloc[0]["email"]
+                registered_email = user["email"]
 
                 otp = generate_otp()
 
-                st.session_state.reset_userid = user.iloc[0]["userid"]
+                st.session_state.reset_userid = user["userid"]
                 st.session_state.otp = otp
                 st.session_state.otp_expiry = datetime.now() + timedelta(minutes=5)
 
@@ -578,22 +3904,36 @@ if not st.session_state.authenticated:
                 # 👉 clear username field
                 st.session_state.pop("reset_username", None)
 
-                send_otp_email(registered_email, otp)
-
-                st.success(
-                    f"✅ OTP sent to your registered email ({registered_email}). "
-                    "Please check your inbox."
-                )
+                st.session_state.otp_mail = (send_otp_email(registered_email, otp), registered_email)
 
                 st.rerun()
 
         # STEP 2 — VERIFY OTP
         elif st.session_state.reset_step == "otp":
 
+            mail_id, registered_email = st.session_state.get("otp_mail", ("", ""))
+            state, error = mail_status(mail_id)
+            if state == "sent":
+                st.success(
+                    f"✅ OTP sent to your registered email ({registered_email}). "
+                    "Please check your inbox."
+                )
+            elif state == "queued":
+                st.info(f"📨 Sending OTP to {registered_email}...")
+                if st.button("🔄 Check again"):
+                    st.rerun()
+            else:
+                st.error(f"❌ The OTP email could not be sent ({error}). Please try again later.")
+                if st.button("⬅️ Start over"):
+                    st.session_state.reset_step = "username"
+                    st.rerun()
+                st.stop()
+
             entered_otp = st.text_input("Enter OTP", key="reset_otp")
 
             if st.button("Verify OTP"):
 
+                throttled(("verify_user", st.session_state.reset_userid), ("login_client", client_key()))
                 if entered_otp != st.session_state.otp:
                     st.error("❌ Invalid OTP")
                     st.stop()
@@ -625,18 +3965,24 @@ if not st.session_state.authenticated:
 
                 hashed = hash_password(new_pass)
 
-                row_idx = auth_df[auth_df["userid"] == st.session_state.reset_userid].index[0] + 2
-                password_col = get_col_index(auth_df, "passwordhash")
-                date_col = get_col_index(auth_df, "lastpasswordchange")
+                row_idx = find_user(userid=st.session_state.reset_userid)["_row"]
+                password_col = user_col("passwordhash")
+                date_col = user_col("lastpasswordchange")
+                changed_on = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
                 AUTH_SHEET.update_cell(row_idx, password_col, hashed)
                 AUTH_SHEET.update_cell(
                     row_idx,
                     date_col,
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    changed_on
                 )
 
-                load_auth_data.clear()
+                revoke_user_sessions(st.session_state.reset_userid)
+                upsert_user(
+                    st.session_state.reset_userid,
+                    passwordhash=hashed,
+                    lastpasswordchange=changed_on,
+                )
 
                 st.success("✅ Password updated successfully")
 
@@ -645,11 +3991,11 @@ if not st.session_state.authenticated:
                     "reset_step",
                     "reset_userid",
                     "otp",
-                    "otp_expiry"
+                    "otp_expiry",
+                    "otp_mail"
                 ]:
                     st.session_state.pop(k, None)
 
-                load_auth_data.clear()
                 st.query_params.clear()
                 st.rerun()
 
@@ -664,14 +4010,13 @@ if not st.session_state.authenticated:
     password = st.text_input("🔑 Password", type="password")
 
     if st.button("Login"):
-        user = auth_df[auth_df["username"] == username]
+        throttled(("login_user", username), ("login_client", client_key()))
+        row = find_user(username=username)
 
-        if user.empty:
+        if row is None:
             st.error("❌ User not found")
             st.stop()
 
-        row = user.iloc[0]
-
         if row["status"] != "Active":
             st.error("❌ Account inactive")
             st.stop()
@@ -687,6 +4032,7 @@ if not st.session_state.authenticated:
         st.session_state.user_name = row["name"]
         st.session_state.user_role = row["role"]
         st.session_state.user_accesslevel = row["accesslevel"]
+        st.session_state.session_token = issue_session_token(session_profile())
 
         st.success(f"✅ Welcome, {row['name']}")
         st.rerun()
@@ -702,7 +4048,16 @@ if not st.session_state.authenticated:
 # DASHBOARD
 # ============================================================
 else:
+    # the cookie is written on a normal run; a save right before st.rerun() can be lost
+    if "session_token" in st.session_state and cookies.get(SESSION_COOKIE) != st.session_state.session_token:
+        cookies[SESSION_COOKIE] = st.session_state.session_token
+        cookies.save()
+
     if st.sidebar.button("🚪 Logout"):
+        revoke_session_token(st.session_state.get("session_token"))
+        if SESSION_COOKIE in cookies:
+            del cookies[SESSION_COOKIE]
+            cookies.save()
         for k in list(st.session_state.keys()):
             st.session_state.pop(k)
         st.query_params.clear()
@@ -754,12 +4109,13 @@ else:
             "Medication",
             "Investment",
             "Bank Account",
+            "Reports",
             "My Wallet",
             "My Profile",
             "Chatbot"
 
             
-        ],
+        ] + (["Benchmark"] if st.session_state.user_role == "Admin" else []),
     )
 
     # ============================================================
@@ -875,13 +4231,13 @@ else:
             total_investment = invest_df["Amount"].sum()
             total_expense = expense_df["Amount"].sum()
             total_payment = bills_df["PaidAmount"].sum()
-            bank_balance = get_current_bank_balance(bank_df)
+            current_bank_balance = get_current_bank_balance()
 
             c = st.columns(4)
             c[0].markdown(f'<div class="kpi"><div class="kpi-title">Investment</div><div class="kpi-value">₹ {total_investment:,.0f}</div></div>', unsafe_allow_html=True)
             c[1].markdown(f'<div class="kpi"><div class="kpi-title">Expense</div><div class="kpi-value">₹ {total_expense:,.0f}</div></div>', unsafe_allow_html=True)
             c[2].markdown(f'<div class="kpi"><div class="kpi-title">Payments</div><div class="kpi-value">₹ {total_payment:,.0f}</div></div>', unsafe_allow_html=True)
-            c[3].markdown(f'<div class="kpi"><div class="kpi-title">Bank Balance</div><div class="kpi-value">₹ {bank_balance:,.0f}</div></div>', unsafe_allow_html=True)
+            c[3].markdown(f'<div class="kpi"><div class="kpi-title">Bank Balance</div><div class="kpi-value">₹ {current_bank_balance:,.0f}</div></div>', unsafe_allow_html=True)
 
             st.markdown('</div>', unsafe_allow_html=True)
 
@@ -896,27 +4252,13 @@ else:
             month_start = today.replace(day=1)
             month_start = pd.to_datetime(month_start)
 
-            def filter_this_month(df, date_col):
-                if df.empty or date_col not in df:
-                    return df.iloc[0:0]
-
-                df = df.copy()
-                df[date_col] = pd.to_datetime(df[date_col], errors="coerce")
-
-                month_start = pd.Timestamp.today().replace(day=1).normalize()
+            # Filter monthly data (binary-search slices of the date index)
+            m_expense = month_window(expenses_by_date(), month_start)
+            m_payment = month_window(payments_by_date(), month_start)
 
-                return df[df[date_col] >= month_start]
-
-
-            # Filter monthly data
-            m_milking = filter_this_month(milking_df, "Date")
-            m_bitran = filter_this_month(bitran_df, "Date")
-            m_expense = filter_this_month(expense_df, "Date")
-            m_payment = filter_this_month(bills_df, "PaidDate")
-
-            # Monthly totals
-            month_produced = m_milking["MilkQuantity"].sum()
-            month_delivered = m_bitran["MilkDelivered"].sum()
+            # Monthly totals (milk from rollups)
+            month_produced, _ = rollup_month(get_milking_rollups(), month_start)
+            month_delivered, _ = rollup_month(get_bitran_rollups(), month_start)
             month_expense = m_expense["Amount"].sum()
             month_payment = m_payment["PaidAmount"].sum()
 
@@ -976,13 +4318,11 @@ else:
             st.markdown('<div class="section">', unsafe_allow_html=True)
             st.subheader("👛 My Wallet")
 
-            my_wallet = wallet_df[wallet_df["UserID"] == st.session_state.user_id]
+            my_balance = get_wallet_balance(st.session_state.user_id)
 
-            credit = my_wallet[(my_wallet["TxnType"]=="CREDIT") & (my_wallet["TxnStatus"]=="COMPLETED")]["Amount"].sum()
-            debit = my_wallet[(my_wallet["TxnType"]=="DEBIT") & (my_wallet["TxnStatus"]=="COMPLETED")]["Amount"].sum()
-            blocked = my_wallet[(my_wallet["TxnType"]=="DEBIT") & (my_wallet["TxnStatus"]=="PENDING")]["Amount"].sum()
-            total_balance=credit - debit
-            available = total_balance - blocked
+            blocked = my_balance["blocked"]
+            total_balance = my_balance["total"]
+            available = my_balance["available"]
 
             c = st.columns(3)
             c[0].markdown(f'<div class="kpi"><div class="kpi-title">Available</div><div class="kpi-value">₹ {available:,.0f}</div></div>', unsafe_allow_html=True)
@@ -1038,26 +4378,15 @@ else:
         # ⏳ PENDING MILKING (VIEW ONLY)
         # ===============================
 
-        df_milk = load_milking_data()
+        milk_rollups = get_milking_rollups()
 
         pending_milking = []
 
-        if not df_milk.empty and {"Date", "Shift"}.issubset(df_milk.columns):
-
-            df_milk["Date"] = pd.to_datetime(df_milk["Date"], errors="coerce")
-
-            day_shift = (
-                df_milk
-                .groupby(["Date", "Shift"])
-                .size()
-                .unstack(fill_value=0)
-            )
-
-            for date, row in day_shift.iterrows():
-                if row.get("Morning", 0) == 0:
-                    pending_milking.append((date.date(), "Morning"))
-                if row.get("Evening", 0) == 0:
-                    pending_milking.append((date.date(), "Evening"))
+        recorded = milk_rollups["day_shift"].index
+        for date in sorted(milk_rollups["dates"]):
+            for shift in ["Morning", "Evening"]:
+                if (date, shift) not in recorded:
+                    pending_milking.append((date.date(), shift))
 
         # ---- UI (ONLY IF EXISTS) ----
         if pending_milking:
@@ -1081,30 +4410,40 @@ else:
         # 💰 PENDING PAYMENTS (VIEW ONLY)
         # ===============================
 
-        # --- FIX numeric columns (SAFE) ---
-        for col in ["BillAmount", "PaidAmount", "BalanceAmount"]:
-            if col in bills_df.columns:
-                bills_df[col] = pd.to_numeric(
-                    bills_df[col], errors="coerce"
-                ).fillna(0)
-
-        pending_bills = bills_df[bills_df["BalanceAmount"] > 0]
+        receivables = load_receivables()
+        pending_customers = receivables["customers"]
 
         # ---- UI (ONLY IF EXISTS) ----
-        if not pending_bills.empty:
+        if not pending_customers.empty:
 
             st.subheader("💰 Pending Payments")
 
+            # ---- aging buckets (days past due) ----
+            cols = st.columns(len(AGING_BUCKETS))
+            for col, bucket in zip(cols, AGING_BUCKETS):
+                with col:
+                    st.markdown(
+                        f"""
+                        <div class="mini-card">
+                            ⏳ {bucket} days<br>
+                            💵 ₹ {receivables["totals"][bucket]:,.0f}
+                        </div>
+                        """,
+                        unsafe_allow_html=True
+                    )
+
+            # ---- one card per customer ----
             cols = st.columns(4)
 
-            for i, (_, r) in enumerate(pending_bills.iterrows()):
+            for i, (_, r) in enumerate(pending_customers.iterrows()):
                 short_id = f"{r['CustomerID'][:2]}**{r['CustomerID'][-4:]}"
                 with cols[i % 4]:
                     st.markdown(
                         f"""
                         <div class="mini-card">
                             👤 {r['CustomerName']} ({short_id})<br>
-                            💵 ₹ {r['BalanceAmount']:,.0f}
+                            💵 ₹ {r['Outstanding']:,.0f} • {r['OpenBills']} bill(s)<br>
+                            🕒 oldest {r['OldestBillID']} • {r['MaxDaysPastDue']}d overdue
                         </div>
                         """,
                         unsafe_allow_html=True
@@ -1124,9 +4463,6 @@ else:
         # ================== SHEET HELPERS ==================
         
     
-        # ================== SUMMARY CARDS ==================
-        df_milk = load_milking_data()
-
         # ==================================================
         # 📌 MILKING KPIs (MONTH + LAST COMPLETE DAY)
         # ==================================================
@@ -1135,45 +4471,18 @@ else:
         st.subheader("📌 Milking Overview")
 
         # --- Prepare data ---
-        df_milk["MilkQuantity"] = pd.to_numeric(
-            df_milk["MilkQuantity"], errors="coerce"
-        ).fillna(0)
-
-        df_milk["Date"] = pd.to_datetime(
-            df_milk["Date"], errors="coerce"
-        ).dt.date
+        milk_rollups = get_milking_rollups()
 
         today = dt.date.today()
         month_start = today.replace(day=1)
 
         # --- This month ---
-        month_df = df_milk[df_milk["Date"] >= month_start]
-
-        month_total = month_df["MilkQuantity"].sum()
-        month_days = month_df["Date"].nunique()
+        month_total, month_days = rollup_month(milk_rollups, month_start)
         month_avg = month_total / month_days if month_days > 0 else 0
 
         # --- Last complete day (Morning + Evening) ---
-        complete_days = (
-            df_milk
-            .groupby(["Date", "Shift"])
-            .size()
-            .unstack(fill_value=0)
-            .reindex(columns=["Morning", "Evening"], fill_value=0)
-        )
-
-        complete_days = complete_days[
-            (complete_days["Morning"] > 0) &
-            (complete_days["Evening"] > 0)
-        ]
-
-
-        last_complete_date = complete_days.index.max() if not complete_days.empty else None
-
-        last_day_total = (
-            df_milk[df_milk["Date"] == last_complete_date]["MilkQuantity"].sum()
-            if last_complete_date else 0
-        )
+        last_complete_date = milk_rollups["last_complete"]
+        last_day_total = rollup_day_total(milk_rollups, last_complete_date)
 
         # --- KPI UI ---
         k1, k2, k3 = st.columns(3)
@@ -1224,33 +4533,7 @@ else:
         # ⏳ PENDING MILKING (VIEW ONLY)
         # ===============================
 
-        df_milk = load_milking_data()
-        pending_milking = []
-
-        if not df_milk.empty and {"Date", "Shift"}.issubset(df_milk.columns):
-
-            df_milk["Date"] = pd.to_datetime(df_milk["Date"], errors="coerce")
-
-            start_date = df_milk["Date"].min().date()
-            today = dt.date.today()
-
-            all_dates = pd.date_range(start=start_date, end=today, freq="D")
-
-            # 👇 CRITICAL FIX: normalize index to DATE
-            done = (
-                df_milk
-                .groupby(["Date", "Shift"])
-                .size()
-                .unstack(fill_value=0)
-            )
-            done.index = done.index.date   # ✅ FIX
-
-            for d in all_dates:
-                d = d.date()
-
-                for shift in ["Morning", "Evening"]:
-                    if d not in done.index or done.loc[d].get(shift, 0) == 0:
-                        pending_milking.append((d, shift))
+        pending_milking = pending_milking_shifts(milk_rollups, dt.date.today())
 
 
 
@@ -1322,22 +4605,18 @@ else:
                     date_str = date.strftime("%Y-%m-%d")
                     ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-                    df_existing = load_milking_data()
+                    existing_keys = load_milking_keys()
                     rows_to_insert = []
                     has_error = False
-    
+
                     for cow, qty in entries:
                         if not qty.strip():
                             st.error(f"Milk quantity required for {cow['TagNumber']}")
                             has_error = True
                             break
-    
+
                         # ❌ Duplicate check
-                        if (
-                            (df_existing["Date"] == date_str) &
-                            (df_existing["Shift"] == shift) &
-                            (df_existing["CowID"] == cow["CowID"])
-                        ).any():
+                        if entry_key(date_str, shift, cow["CowID"]) in existing_keys:
                             st.error(f"Duplicate entry found for {cow['TagNumber']}")
                             has_error = True
                             break
@@ -1352,7 +4631,16 @@ else:
                         ])
     
                     if not has_error:
-                        append_milking_rows(rows_to_insert)
+                        clashes = append_milking_rows(rows_to_insert)
+                        if clashes:
+                            st.error(
+                                f"❌ {len(clashes)} entry(s) for {date_str} {shift} "
+                                "were just saved by another user. Nothing was written."
+                            )
+                            load_milking_data.clear()
+                            load_milking_keys.clear()
+                            st.stop()
+
                         st.success("Milking data saved successfully ✅")
                         st.session_state.show_milking_form = None
                         st.cache_data.clear()
@@ -1364,13 +4652,8 @@ else:
         st.subheader("🐄 Cow-wise Milking Summary")
 
         cows_df = load_cows()
-        df_milk["CowID"] = df_milk["CowID"].astype(str).str.strip()
         cows_df["CowID"] = cows_df["CowID"].astype(str).str.strip()
 
-        df_milk["MilkQuantity"] = pd.to_numeric(
-            df_milk["MilkQuantity"], errors="coerce"
-        ).fillna(0)
-
 
         def safe_float(val):
             try:
@@ -1383,42 +4666,17 @@ else:
         if cows_df.empty:
             st.info("No active milking cows.")
         else:
-            # ---------- Aggregations ----------
-            lifetime = (
-                df_milk
-                .groupby("CowID", as_index=True)["MilkQuantity"]
-                .sum()
-            )
-
-            if not month_df.empty:
-                month_total = month_df.groupby("CowID")["MilkQuantity"].sum()
-                month_avg = (
-                    month_df
-                    .groupby(["CowID", "Date"])["MilkQuantity"]
-                    .sum()
-                    .groupby("CowID")
-                    .mean()
-                )
-            else:
-                month_total = pd.Series(dtype=float)
-                month_avg = pd.Series(dtype=float)
-
+            # ---------- Aggregations (from rollups) ----------
+            lifetime = milk_rollups["id_total"]
 
+            month_by_cow = rollup_month_by_id(milk_rollups, month_start)
+            month_total = month_by_cow["Qty"]
+            month_avg = month_total / month_by_cow["Days"].where(month_by_cow["Days"] > 0)
 
-            month_avg = (
-                month_df
-                .groupby(["CowID", "Date"])["MilkQuantity"]
-                .sum()
-                .groupby("CowID")
-                .mean()
-            )
             # ---------------- SHOW ONLY COWS WITH MILK THIS MONTH ----------------
-            if not month_df.empty:
-                valid_cows = set(
-                    month_total[month_total > 0].index.astype(str)
-                )
-            else:
-                valid_cows = set()
+            valid_cows = set(
+                month_total[month_total > 0].index.astype(str)
+            )
 
             # Filter cows based on data, NOT status
             cows_df = cows_df[cows_df["CowID"].isin(valid_cows)]
@@ -1431,22 +4689,16 @@ else:
 
 
 
-            last_day_map = {}
-
-            for cid, g in df_milk.groupby("CowID"):
-                last_date = g["Date"].max()
-                last_day_map[cid] = (
-                    g[g["Date"] == last_date]["MilkQuantity"].sum()
-                )
-
+            last_day_map = milk_rollups["id_last"]["LastDayQty"].to_dict()
 
             last_update_map = (
-                df_milk.groupby("CowID")["Timestamp"]
-                .max()
+                milk_rollups["id_last"]["LastTimestamp"]
                 .apply(lambda x: x.split(" ")[0] if isinstance(x, str) else "")
                 .to_dict()
             )
 
+            last_z = latest_z_by_cow(get_milking_anomalies())
+
             cols = st.columns(4)
             i = 0
 
@@ -1459,13 +4711,13 @@ else:
                 month_val = safe_float(month_total.get(cid))
                 avg_val = safe_float(month_avg.get(cid))
                 last_day_val = safe_float(last_day_map.get(cid))
-                is_below_avg = last_day_val < avg_val
+                is_anomaly = last_z.get(cid, 0) <= ANOMALY_Z
 
 
 
                 gradient = (
                     "linear-gradient(135deg,#92400e,#78350f)"  # warning
-                    if is_below_avg
+                    if is_anomaly
                     else "linear-gradient(135deg,#64748b,#334155)"  # normal
                 )
 
@@ -1528,47 +4780,98 @@ else:
         
     
 
+        # ================== Sudden Yield Drops ==================
+        st.divider()
+        st.subheader("🚨 Sudden Yield Drops")
+
+        scores = get_milking_anomalies()
+        recent_from = pd.Timestamp(today) - pd.Timedelta(days=14)
+        drops = scores[(scores["Z"] <= ANOMALY_Z) & (scores["Date"] >= recent_from)]
+
+        if drops.empty:
+            st.success("No sudden drops in the last 14 days.")
+        else:
+            cows_all = load_cows()
+            tag_map = dict(zip(cows_all["CowID"].astype(str).str.strip(), cows_all["TagNumber"]))
+            drops = link_medications(
+                drops.sort_values("Date", ascending=False), load_med_logs(), cows_all
+            )
+
+            st.dataframe(
+                pd.DataFrame({
+                    "Date": drops["Date"].dt.date,
+                    "Shift": drops["Shift"],
+                    "Cow": [tag_map.get(cid, cid) for cid in drops["ID"]],
+                    "Milk (L)": drops["Qty"].round(2),
+                    "Usual (L)": drops["Mean"].round(2),
+                    "Z": drops["Z"].round(1),
+                    f"Medication ±{ANOMALY_MED_DAYS}d": drops["Medications"],
+                }),
+                use_container_width=True,
+                hide_index=True,
+            )
+
+        # ================== Lactation Forecast ==================
+        st.divider()
+        st.subheader("📈 Lactation Curve & Forecast")
+
+        lactation = load_lactation(milk_rollups)
+
+        if lactation.empty:
+            st.info(f"Need at least {LACTATION_MIN_DAYS} complete milking days per cow to fit a curve.")
+        else:
+            cows_all = load_cows()
+            tag_map = dict(zip(cows_all["CowID"].astype(str).str.strip(), cows_all["TagNumber"]))
+
+            f1, f2, f3 = st.columns(3)
+            with f1:
+                milking_kpi("Forecast Next 7 Days", f"{lactation['Next7'].sum():.1f} L")
+            with f2:
+                milking_kpi("Forecast Next 30 Days", f"{lactation['Next30'].sum():.1f} L")
+            with f3:
+                milking_kpi("Below Curve", f"{int(lactation['BelowCurve'].sum())} cow(s)")
+
+            below = lactation[lactation["BelowCurve"]]
+            for cid, r in below.iterrows():
+                st.warning(
+                    f"🐄 {tag_map.get(cid, cid)}: last 7 days {r['Last7Actual']:.1f} L "
+                    f"vs {r['Last7Curve']:.1f} L expected ({r['CurveRatio']:.0%} of curve)"
+                )
+
+            view = lactation.assign(
+                TagNumber=[tag_map.get(cid, cid) for cid in lactation.index],
+                LactationStart=lactation["LactationStart"].dt.date,
+            )[["TagNumber", "LactationStart", "DIM", "PeakDIM", "Next7", "Next30", "CurveRatio", "BelowCurve"]]
+
+            st.dataframe(
+                view.sort_values("CurveRatio").round(2),
+                use_container_width=True,
+                hide_index=True,
+            )
+
         st.divider()
         #------------- Daily Milk Summary-----------
         st.subheader("📊 Daily Milking Summary")
         filter_option = st.radio(
             "Show data for",
-            ["Last", "1 W", "1 M", "3 M", "All"],
+            WINDOW_OPTIONS,
             index=1,  # ✅ default = 1 Week
             horizontal=True
         )
 
-        today = pd.Timestamp.today().normalize()
-
-        if filter_option == "Last":
-            latest_date = df_milk["Date"].max()
-            df_milk = df_milk[df_milk["Date"] == latest_date]
-
-        elif filter_option == "1 W":
-            df_milk = df_milk[df_milk["Date"] >= today - pd.Timedelta(days=7)]
-
-        elif filter_option == "1 M":
-            df_milk = df_milk[df_milk["Date"] >= today - pd.DateOffset(months=1)]
-
-        elif filter_option == "3 M":
-            df_milk = df_milk[df_milk["Date"] >= today - pd.DateOffset(months=3)]
-
-        # "All" → no filter needed
-
+        latest_date = max(milk_rollups["dates"]) if milk_rollups["dates"] else None
+        start_date = window_start(filter_option, last=latest_date)
+        window = rollup_day_shift_window(
+            milk_rollups, start_date, latest_date if filter_option == "Last" else None
+        )
 
-        if not df_milk.empty:
-            df_milk["MilkQuantity"] = pd.to_numeric(
-                df_milk["MilkQuantity"], errors="coerce"
-            ).fillna(0)
 
-            df_milk["Date"] = pd.to_datetime(df_milk["Date"], errors="coerce")
+        if not window.empty:
             shift_order = {"Morning": 1, "Evening": 2}
 
-    
             summary = (
-                df_milk
-                .groupby(["Date", "Shift"])["MilkQuantity"]
-                .sum()
+                window["Qty"]
+                .rename("MilkQuantity")
                 .reset_index()
             )
 
@@ -1577,7 +4880,7 @@ else:
             summary = summary.sort_values(
                 by=["Date", "ShiftOrder"],
                 ascending=[False, False]   # latest date first, Evening after Morning
-            )
+            ).reset_index(drop=True)
 
             summary = summary.drop(columns=["ShiftOrder"])
 
@@ -1623,6 +4926,7 @@ else:
     elif page == "Expense":
 
         st.title("💸 Expense Management")
+        upload_failure_notice(EXPENSE_TAB)
         
     
         # ================= CLOUDINARY =================
@@ -1641,10 +4945,7 @@ else:
     
         # ================= KPI CALCULATIONS =================
         today = pd.Timestamp.today()
-        month_df = expense_df[
-            (expense_df["Date"].dt.month == today.month) &
-            (expense_df["Date"].dt.year == today.year)
-        ] if not expense_df.empty else pd.DataFrame()
+        month_df = month_window(expenses_by_date(), today)
     
         total_overall = expense_df["Amount"].sum() if not expense_df.empty else 0
         total_month = month_df["Amount"].sum() if not month_df.empty else 0
@@ -1759,15 +5060,11 @@ else:
                     st.error("❌ All fields are mandatory except bill upload")
                     st.stop()
     
-                file_url = ""
-                if file:
-                    with st.spinner("Uploading bill..."):
-                        file_url = upload_to_cloudinary(file,folder)
-    
-                expense_id = f"EXP{dt.datetime.now().strftime('%Y%m%d%H%M%S')}"
+                file_url = ""  # filled in by the upload worker
+                expense_id = f"EXP{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}"
     
-                open_expense_sheet().append_row(
-                    [
+                landed = save_journaled("expense", [
+                    sheet_append(EXPENSE_TAB, [[
                         expense_id,
                         date.strftime("%Y-%m-%d"),
                         category,
@@ -1778,25 +5075,24 @@ else:
                         file_url,
                         notes,
                         dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    ],
-                    value_input_option="USER_ENTERED"
-                )
+                    ]]),
 
-                # ---- WALLET TXN ----
-                open_wallet_sheet().append_row(
-                        [
-                            f"WTXN{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}",
-                            st.session_state.user_id,
-                            st.session_state.user_name,
-                            amount,
-                            "DEBIT",
-                            expense_id,
-                            f"Amount used for  {category}",
-                            dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "COMPLETED"
-                        ],
-                        value_input_option="USER_ENTERED"
-                    )
+                    # ---- WALLET TXN ----
+                    sheet_append(WALLET_TRANSACTION_TAB, [[
+                        f"WTXN{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}",
+                        st.session_state.user_id,
+                        st.session_state.user_name,
+                        amount,
+                        "DEBIT",
+                        expense_id,
+                        f"Amount used for  {category}",
+                        dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        "COMPLETED"
+                    ]]),
+                ])
+
+                if file:
+                    queue_upload(file, folder, [(EXPENSE_TAB, landed_id(landed, EXPENSE_TAB))])
     
                 st.success("✅ Expense saved successfully")
                 st.session_state.show_expense_form = False
@@ -1817,13 +5113,9 @@ else:
                 if i % 5 == 0:   # 5 cards per row
                     cols = st.columns(5)
         
-                bill_html = ""
-                if row["FileURL"]:
-                    bill_html = (
-                        f"<a href='{row['FileURL']}' target='_blank' "
-                        "style='text-decoration:none;color:#475569;"
-                        "font-size:11px;'>📎</a>"
-                    )
+                bill_html = attachment_html(
+                    row["FileURL"], "📎", px=22, style="color:#475569;font-size:11px;"
+                )
 
                 #---Card Html
                 card_html = f"""
@@ -1903,6 +5195,7 @@ else:
     elif page == "Investment":
 
         st.title("💼 Investment")
+        upload_failure_notice(INVESTMENT_TAB)
         
     
         # =========================================================
@@ -1939,17 +5232,9 @@ else:
         # =========================================================
         # DAIRY USERS (SAFE)
         # =========================================================
-        dairy_users_df = auth_df[
-            auth_df["accesslevel"]
-            .fillna("")
-            .str.contains(r"\bdairy\b", case=False)
-        ][["userid", "name"]]
-
         # userid -> display label
-        user_label_map = {
-            row["userid"]: f"{row['name']}"
-            for _, row in dairy_users_df.iterrows()
-        }
+        dairy_df = dairy_users_df()
+        user_label_map = dict(zip(dairy_df["userid"], dairy_df["name"]))
 
         # =========================================================
         # KPI SECTION
@@ -1996,7 +5281,7 @@ else:
 
         # --- Overall + Per User Cards (hide zero users) ---
         visible_users = []
-        for u in dairy_users_df:
+        for u in user_label_map.values():
             if investment_df[investment_df["InvestedBy"] == u]["Amount"].sum() > 0:
                 visible_users.append(u)
     
@@ -2064,9 +5349,7 @@ else:
 
                 if destination != "Company Account":
                     wallet_user_id = destination
-                    wallet_user_name = auth_df.loc[
-                        auth_df["userid"] == destination, "name"
-                    ].iloc[0]
+                    wallet_user_name = user_name(destination)
 
 
     
@@ -2091,9 +5374,7 @@ else:
                 wallet_user_name = ""
 
                 if destination != "Company Account" and wallet_user_id:
-                    wallet_user_name = auth_df.loc[
-                        auth_df["userid"] == wallet_user_id, "name"
-                    ].iloc[0]
+                    wallet_user_name = user_name(wallet_user_id)
 
                 final_destination = (
                     f"User Wallet: {wallet_user_name}"
@@ -2102,11 +5383,11 @@ else:
                 )
 
     
-                file_url = upload_to_cloudinary(proof,folder) if proof else ""
-                InvestmentID=f"INV{dt.datetime.now().strftime('%Y%m%d%H%M%S')}"
+                file_url = ""  # filled in by the upload worker
+                InvestmentID=f"INV{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}"
     
-                open_investment_sheet().append_row(
-                    [
+                landed = save_journaled("investment", [
+                    sheet_append(INVESTMENT_TAB, [[
                         InvestmentID,
                         dt.date.today().strftime("%Y-%m-%d"),
                         st.session_state.user_name,
@@ -2116,25 +5397,24 @@ else:
                         file_url,
                         notes,
                         dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    ],
-                    value_input_option="USER_ENTERED",
-                )
+                    ]]),
 
-                # ---- WALLET TXN ----
-                open_wallet_sheet().append_row(
-                        [
-                            f"WTXN{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}",
-                            wallet_user_id,
-                            wallet_user_name,
-                            amount,
-                            "CREDIT",
-                            InvestmentID,
-                            f"Investment Amount From {st.session_state.user_name}",
-                            dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "COMPLETED"
-                        ],
-                        value_input_option="USER_ENTERED"
-                    )
+                    # ---- WALLET TXN ----
+                    sheet_append(WALLET_TRANSACTION_TAB, [[
+                        f"WTXN{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}",
+                        wallet_user_id,
+                        wallet_user_name,
+                        amount,
+                        "CREDIT",
+                        InvestmentID,
+                        f"Investment Amount From {st.session_state.user_name}",
+                        dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        "COMPLETED"
+                    ]]),
+                ])
+
+                if proof:
+                    queue_upload(proof, folder, [(INVESTMENT_TAB, landed_id(landed, INVESTMENT_TAB))])
     
                 st.success("Investment added successfully ✅")
                 st.session_state.show_add_investment = False
@@ -2217,7 +5497,7 @@ else:
                 color:#475569;
             ">
                 <span>{row['InvestedBy']}</span>
-                {f"<a href='{row['FileURL']}' target='_blank' style='text-decoration:none;'>📎</a>" if row['FileURL'] else "<span></span>"}
+                {attachment_html(row['FileURL'], "📎", px=22) or "<span></span>"}
             </div>
         
         </div>
@@ -2236,24 +5516,6 @@ else:
         st.title("💳 Payments")
         
 
-        # ======================================================
-        # HELPERS
-        # ======================================================
-        def open_payment_sheet():
-            return open_sheet(MAIN_SHEET_ID, PAYMENT_TAB)
-
-
-        @st.cache_data(ttl=30)
-        def load_payments():
-            ws = open_payment_sheet()
-            rows = ws.get_all_values()
-            if len(rows) <= 1:
-                return pd.DataFrame(columns=[
-                    "PaymentID","BillID","CustomerID","CustomerName",
-                    "PaidAmount","PaymentMode","ReceivedBy","ReceivedOn","Remarks"
-                ])
-            return pd.DataFrame(rows[1:], columns=rows[0])
-
         payments_df = load_payments()
         bills_df = load_bills()
         # ================= CLEAN TYPES (STEP 4) =================
@@ -2344,6 +5606,98 @@ else:
                             st.rerun()
 
 
+        # ======================================================
+        # RECEIVE BY CUSTOMER (OLDEST BILL FIRST)
+        # ======================================================
+        if "show_customer_payment" not in st.session_state:
+            st.session_state.show_customer_payment = False
+
+        if not pending_bills.empty and st.button("👥 Receive by Customer"):
+            st.session_state.show_customer_payment = not st.session_state.show_customer_payment
+
+        if st.session_state.show_customer_payment:
+
+            st.subheader("💰 Receive Payment – Customer")
+            st.caption("The amount is applied to the customer's open bills, oldest first.")
+
+            owing = load_receivables()["customers"]
+
+            if owing.empty:
+                st.info("No customer has an outstanding balance.")
+            else:
+                labels = dict(zip(
+                    owing["CustomerID"],
+                    owing["CustomerName"] + " (₹ " + owing["Outstanding"].map("{:,.0f}".format) + ")"
+                ))
+                cust_id = st.selectbox("Customer", list(labels), format_func=labels.get)
+                outstanding = float(owing.loc[owing["CustomerID"] == cust_id, "Outstanding"].iloc[0])
+
+                fifo_amt = st.number_input(
+                    "Received Amount *",
+                    value=None,
+                    placeholder=f"Enter amount (Max ₹ {outstanding:,.0f})",
+                    step=1.0,
+                    key="fifo_amount"
+                )
+                fifo_mode = st.selectbox("Payment Mode", ["Cash", "UPI", "Bank Transfer"], key="fifo_mode")
+                fifo_remarks = st.text_input("Remarks (optional)", key="fifo_remarks")
+
+                if fifo_amt and 0 < fifo_amt <= outstanding + 0.005:
+                    preview = allocate_fifo(bills_df, cust_id, fifo_amt)
+                    st.dataframe(
+                        preview[["BillID", "BalanceAmount", "Applied", "NewBalance", "NewStatus"]],
+                        use_container_width=True,
+                        hide_index=True
+                    )
+
+                col1, col2 = st.columns(2)
+
+                with col1:
+                    if st.button("✅ Collect Payment", key="fifo_collect"):
+                        if fifo_amt is None:
+                            st.error("❌ Please enter received amount")
+                            st.stop()
+
+                        if fifo_amt <= 0:
+                            st.error("❌ Amount must be greater than 0")
+                            st.stop()
+
+                        if fifo_amt > outstanding + 0.005:
+                            st.error(f"❌ Amount exceeds total outstanding (₹ {outstanding:,.2f})")
+                            st.stop()
+
+                        # allocate on the sheet as it is now, not the cached copy, so two
+                        # payments close together cannot overwrite each other's K:O values
+                        with get_billing_write_lock():
+                            alloc = allocate_fifo(read_bills_now(), cust_id, fifo_amt)
+                            if alloc["Applied"].sum() < fifo_amt - 0.005:
+                                st.error(
+                                    f"❌ The customer's bills changed meanwhile; outstanding is now "
+                                    f"₹ {alloc['Applied'].sum():,.2f}. Check the amount and try again."
+                                )
+                                st.cache_data.clear()
+                                st.stop()
+
+                            # every bill row, payment row and wallet credit in one batch
+                            save_journaled("customer_payment", payment_writes(
+                                alloc,
+                                fifo_mode,
+                                fifo_remarks,
+                                st.session_state.user_id,
+                                st.session_state.user_name,
+                                dt.datetime.now()
+                            ))
+
+                        st.success(f"✅ Payment applied to {len(alloc)} bill(s)")
+                        st.cache_data.clear()
+                        st.session_state.show_customer_payment = False
+                        st.rerun()
+
+                with col2:
+                    if st.button("❌ Cancel", key="fifo_cancel"):
+                        st.session_state.show_customer_payment = False
+                        st.rerun()
+
         # ======================================================
         # TOGGLE RECEIVE PAYMENT WINDOW
         # ======================================================
@@ -2407,22 +5761,6 @@ else:
                     now = dt.datetime.now()
 
 
-                    # ---- INSERT PAYMENT ----
-                    open_payment_sheet().append_row(
-                        [
-                            f"PAY{now.strftime('%Y%m%d%H%M%S%f')}",
-                            bill["BillID"],
-                            bill["CustomerID"],
-                            bill["CustomerName"],
-                            received_amt,
-                            payment_mode,
-                            st.session_state.user_name,
-                            now.strftime("%Y-%m-%d %H:%M:%S"),
-                            remarks
-                        ],
-                        value_input_option="USER_ENTERED"
-                    )
-
                     # ---- UPDATE BILL ----
                     new_paid = bill["PaidAmount"] + received_amt
                     new_balance = bill["BillAmount"] - new_paid
@@ -2436,25 +5774,32 @@ else:
                         paid_date = now.strftime("%Y-%m-%d")
 
 
-                    ws = open_billing_sheet()
                     bill_row = bills_df.index[bills_df["BillID"] == bill["BillID"]][0] + 2
 
-                    ws.update(
-                        f"K{bill_row}:O{bill_row}",
-                        [[
+                    save_journaled("payment", [
+                        # ---- INSERT PAYMENT ----
+                        sheet_append(PAYMENT_TAB, [[
+                            f"PAY{now.strftime('%Y%m%d%H%M%S%f')}",
+                            bill["BillID"],
+                            bill["CustomerID"],
+                            bill["CustomerName"],
+                            received_amt,
+                            payment_mode,
+                            st.session_state.user_name,
+                            now.strftime("%Y-%m-%d %H:%M:%S"),
+                            remarks
+                        ]]),
+
+                        sheet_update(BILLING_TAB, f"K{bill_row}:O{bill_row}", [[
                             new_paid,
                             new_balance,
                             status,
                             bill["DueDate"].strftime("%Y-%m-%d"),
                             paid_date
-                        ]]
-                    )
-
+                        ]]),
 
-
-                    # ---- WALLET TXN ----
-                    open_wallet_sheet().append_row(
-                        [
+                        # ---- WALLET TXN ----
+                        sheet_append(WALLET_TRANSACTION_TAB, [[
                             f"WTXN{now.strftime('%Y%m%d%H%M%S%f')}",
                             st.session_state.user_id,
                             st.session_state.user_name,
@@ -2464,9 +5809,8 @@ else:
                             f"Payment received from {bill['CustomerName']}",
                             now.strftime("%Y-%m-%d %H:%M:%S"),
                             "COMPLETED"
-                        ],
-                        value_input_option="USER_ENTERED"
-                    )
+                        ]]),
+                    ])
 
                     st.success("✅ Payment recorded successfully")
                     st.cache_data.clear()
@@ -2617,43 +5961,6 @@ else:
                 return float(val)
             return str(val)
 
-        # ======================================================
-        # MILK CALCULATION + MISSING DATES
-        # ======================================================
-        def calculate_milk(bitran_df, customer_id, from_date, to_date):
-            if bitran_df.empty:
-                return 0, 0, 0, [], []
-
-            df = bitran_df[
-                (bitran_df["CustomerID"] == customer_id) &
-                (bitran_df["Date"] >= pd.to_datetime(from_date)) &
-                (bitran_df["Date"] <= pd.to_datetime(to_date))
-            ]
-
-            df["day"] = df["Date"].dt.date
-
-            morning = df[df["Shift"] == "Morning"]["MilkDelivered"].sum()
-            evening = df[df["Shift"] == "Evening"]["MilkDelivered"].sum()
-            total = morning + evening
-
-            # ---- DAILY PATTERN LOGIC ----
-            all_dates = pd.date_range(from_date, to_date)
-            daily_pattern = []
-            missing_dates = []
-
-            for d in all_dates:
-                day_total = df[df["day"] == d.date()]["MilkDelivered"].sum()
-                daily_pattern.append(round(day_total, 2))
-                if day_total == 0:
-                    missing_dates.append(d.day)
-
-            return (
-                round(morning, 2),
-                round(evening, 2),
-                round(total, 2),
-                missing_dates,
-                daily_pattern
-            )
         def fmt_date(d):
             return pd.to_datetime(d).strftime("%d-%m-%Y")
 
@@ -2767,8 +6074,8 @@ else:
         # ======================================================
         st.subheader("📊 Billing Summary")
 
-        pending_df = bills_df[bills_df["BillStatus"] != "Paid"] if not bills_df.empty else pd.DataFrame()
-        total_pending_amt = pending_df["BalanceAmount"].astype(float).sum() if not pending_df.empty else 0
+        receivables = load_receivables()
+        total_pending_amt = receivables["customers"]["Outstanding"].sum()
 
         last_month = (dt.date.today().replace(day=1) - dt.timedelta(days=1)).strftime("%Y-%m")
         last_month_df = bills_df[bills_df["FromDate"].dt.strftime("%Y-%m") == last_month] if not bills_df.empty else pd.DataFrame()
@@ -2787,11 +6094,18 @@ else:
                 unsafe_allow_html=True
             )
 
-        with k1: kpi("Pending Bills", len(pending_df))
+        with k1: kpi("Pending Bills", len(receivables["bills"]))
         with k2: kpi("Pending Amount", total_pending_amt)
         with k3: kpi("Last Month Billed", last_month_df["BillAmount"].astype(float).sum() if not last_month_df.empty else 0)
         with k4: kpi("Last Month Received", last_month_df["PaidAmount"].astype(float).sum() if not last_month_df.empty else 0)
 
+        if total_pending_amt > 0:
+            st.caption(
+                "Overdue by days past due: " + " • ".join(
+                    f"{b}: ₹ {receivables['totals'][b]:,.0f}" for b in AGING_BUCKETS
+                )
+            )
+
         st.divider()
 
         # ======================================================
@@ -3448,6 +6762,25 @@ else:
                 st.query_params.clear()
                 st.rerun()
     
+        # ======================================================
+        # COW P&L
+        # ======================================================
+        with st.expander("💹 Cow P&L (lifetime)"):
+            cow_pnl = load_cow_pnl()
+            herd = cow_pnl["cows"]
+
+            m1, m2, m3 = st.columns(3)
+            m1.metric("Realized Rate", f"₹ {cow_pnl['rate']:.2f} / L")
+            m2.metric("Herd Profit", f"₹ {herd['Profit'].sum():,.0f}")
+            m3.metric("Shared Expenses (All COW)", f"₹ {cow_pnl['shared']:,.0f}")
+
+            st.dataframe(
+                herd.round(2),
+                use_container_width=True,
+                hide_index=True,
+            )
+            st.caption("Shared expenses are not allocated to individual cows.")
+
         # ======================================================
         # LIST + EDIT
         # ======================================================
@@ -3945,53 +7278,36 @@ else:
         # ==================================================
 
         def append_bitran_rows(rows):
+            """
+            Batch-append bitran rows after re-checking the live sheet.
+            Returns True when the Date & Shift was already saved (nothing written).
+            """
             ws = open_sheet(MAIN_SHEET_ID, BITRAN_TAB)
-            for r in rows:
-                ws.append_row(r, value_input_option="USER_ENTERED")
+            live_shifts = {k[:2] for k in fetch_live_entry_keys(ws)}
 
-        df_bitran = load_bitran_data()
-        if not df_bitran.empty:
-            df_bitran["Date"] = pd.to_datetime(df_bitran["Date"], errors="coerce")
+            if any(entry_key(r[0], r[1], r[2])[:2] in live_shifts for r in rows):
+                return True
 
+            ws.append_rows(rows, value_input_option="USER_ENTERED")
+            return False
 
-        if not df_bitran.empty:
-            df_bitran["MilkDelivered"] = pd.to_numeric(
-                df_bitran["MilkDelivered"], errors="coerce"
-            ).fillna(0)
+        bitran_rollups = get_bitran_rollups()
+        milk_rollups = get_milking_rollups()
 
-            df_bitran["Date"] = pd.to_datetime(df_bitran["Date"])
+        today = pd.Timestamp.today().normalize()
+        month_start = today.replace(day=1)
 
-            today = pd.Timestamp.today().normalize()
-            month_start = today.replace(day=1)
+        if bitran_rollups["dates"]:
 
             # ---- Lifetime ----
-            total_delivered = df_bitran["MilkDelivered"].sum()
+            total_delivered = bitran_rollups["total"]
 
             # ---- This month ----
-            m_df = df_bitran[df_bitran["Date"] >= month_start]
-            month_total = m_df["MilkDelivered"].sum()
-            month_days = m_df["Date"].dt.date.nunique()
+            month_total, month_days = rollup_month(bitran_rollups, month_start)
             month_avg = round(month_total / month_days, 2) if month_days else 0
 
             # ---- Last complete day (Morning + Evening both) ----
-            last_complete_day = (
-                df_bitran.groupby(["Date", "Shift"])
-                .size()
-                .unstack(fill_value=0)
-            )
-
-            valid_days = last_complete_day[
-                (last_complete_day.get("Morning", 0) > 0)
-                & (last_complete_day.get("Evening", 0) > 0)
-            ].index
-
-            if len(valid_days) > 0:
-                last_day = valid_days.max()
-                last_day_total = df_bitran[
-                    df_bitran["Date"] == last_day
-                ]["MilkDelivered"].sum()
-            else:
-                last_day_total = 0
+            last_day_total = rollup_day_total(bitran_rollups, bitran_rollups["last_complete"])
 
             st.subheader("📊 Milk Bitran Overview")
 
@@ -4028,55 +7344,8 @@ else:
         # ⏳ FIND PENDING MILK BITRAN
         # ===============================
 
-        pending_tasks = []
-        df_milk = load_milking_data()
-
-        # Force clean Date and Shift in both datasets
-        df_milk["Date"] = pd.to_datetime(df_milk["Date"]).dt.date
-        df_milk["Shift"] = df_milk["Shift"].str.strip()
-
-        df_bitran["Date"] = pd.to_datetime(df_bitran["Date"]).dt.date
-        df_bitran["Shift"] = df_bitran["Shift"].str.strip()
-
-
-        # total milking per day + shift
-        milk_grp = (
-            df_milk
-            .groupby(["Date", "Shift"])["MilkQuantity"]
-            .sum()
-            .reset_index()
-        )
-
-        # total bitran per day + shift
-        bitran_grp = (
-            df_bitran
-            .groupby(["Date", "Shift"])["MilkDelivered"]
-            .sum()
-            .reset_index()
-        )
-
-
-        for _, row in milk_grp.iterrows():
-            date = row["Date"]
-            shift = row["Shift"]
-
-            milk_total = float(row["MilkQuantity"] or 0)
-
-            # 🚫 SKIP if no milk produced
-            if milk_total <= 0:
-                continue
-
-            delivered = bitran_grp[
-                (bitran_grp["Date"] == date) &
-                (bitran_grp["Shift"] == shift)
-            ]
-
-            if delivered.empty:
-                pending_tasks.append({
-                    "Date": date,
-                    "Shift": shift,
-                    "MilkTotal": milk_total
-                })
+        # milking day + shift totals vs. bitran day + shift already saved
+        pending_tasks = pending_bitran_shifts(milk_rollups, bitran_rollups)
 
         
         # ===============================
@@ -4186,12 +7455,7 @@ else:
                     st.stop()
 
                 # 🛑 DUPLICATE CHECK
-                existing = df_bitran[
-                    (df_bitran["Date"] == date) &
-                    (df_bitran["Shift"] == shift)
-                ]
-
-                if not existing.empty:
+                if entry_key(date, shift, "")[:2] in load_bitran_shift_keys():
                     st.warning("⚠️ Bitran already saved for this Date & Shift")
                     st.session_state.bitran_saved = False
                     st.stop()
@@ -4210,7 +7474,13 @@ else:
                             ts
                         ])
 
-                append_bitran_rows(rows)
+                if append_bitran_rows(rows):
+                    st.warning("⚠️ Bitran was just saved by another user for this Date & Shift")
+                    st.session_state.bitran_saved = False
+                    load_bitran_data.clear()
+                    load_bitran_keys.clear()
+                    load_bitran_shift_keys.clear()
+                    st.stop()
 
                 st.success("✅ Milk Bitran saved successfully")
 
@@ -4236,71 +7506,35 @@ else:
 
         customers_df = load_customers()
 
-        if not customers_df.empty and not df_bitran.empty:
+        if not customers_df.empty and bitran_rollups["dates"]:
 
             st.subheader("👥 Active Customers – Delivery Snapshot")
 
             cards_per_row = 5
             valid_cards = []
 
-            for _, c in customers_df.iterrows():
-
-                # Filter customer bitran
-                c_df = df_bitran[df_bitran["CustomerID"] == c["CustomerID"]]
-                if c_df.empty:
-                    continue
-
-                # ---- Monthly stats (CURRENT MONTH ONLY) ----
-                c_df["Date"] = pd.to_datetime(c_df["Date"], errors="coerce")
-                month_start = pd.to_datetime(month_start)
-
-                m_df = c_df[c_df["Date"] >= month_start]
-                m_total = m_df["MilkDelivered"].sum()
-
-                # 🚫 SKIP if no delivery this month
-                if m_total <= 0:
-                    continue
-
-                m_days = m_df["Date"].dt.date.nunique()
-                m_avg = round(m_total / m_days, 2) if m_days else 0
-
-                # ---- Last complete day ----
-                cd = (
-                    c_df
-                    .groupby(["Date", "Shift"])
-                    .size()
-                    .unstack(fill_value=0)
-                )
-
-                valid_days = cd[
-                    (cd.get("Morning", 0) > 0) | (cd.get("Evening", 0) > 0)
-                ].index
-
-                last_day = valid_days.max() if len(valid_days) else None
+            snapshot = rollup_delivery_snapshot(bitran_rollups, month_start)
 
-                last_day_total = (
-                    c_df[c_df["Date"] == last_day]["MilkDelivered"].sum()
-                    if last_day else 0
-                )
+            active = customers_df.merge(
+                snapshot, on="CustomerID", how="inner"
+            )
+            active = active[active["MonthTotal"] > 0]
 
-                last_updated = (
-                    c_df["Date"].max().strftime("%d %b")
-                    if not c_df.empty else "-"
-                )
+            for _, c in active.iterrows():
 
                 # ---- Conditional gradient ----
                 gradient = (
                     "linear-gradient(135deg,#fde68a,#f59e0b)"
-                    if last_day_total < m_avg
+                    if c["LastDayTotal"] < c["MonthAvg"]
                     else "linear-gradient(135deg,#bbf7d0,#22c55e)"
                 )
 
                 valid_cards.append({
                     "name": c["Name"],
-                    "month": m_total,
-                    "avg": m_avg,
-                    "last": last_day_total,
-                    "updated": last_updated,
+                    "month": c["MonthTotal"],
+                    "avg": c["MonthAvg"],
+                    "last": c["LastDayTotal"],
+                    "updated": c["LastUpdate"].strftime("%d %b"),
                     "gradient": gradient
                 })
 
@@ -4348,55 +7582,26 @@ else:
 
 
         # ===================== SUMMARY CARDS =====================
-        df_bitran = load_bitran_data()
-
-        if not df_bitran.empty:
-            df_bitran["Date"] = pd.to_datetime(df_bitran["Date"], errors="coerce")
-
-        
-        if not df_bitran.empty and "MilkDelivered" in df_bitran.columns:
+        if bitran_rollups["dates"]:
 
             st.subheader("📊 Daily Summary")
-            df_bitran["Date"] = pd.to_datetime(df_bitran["Date"], errors="coerce")
 
             filter_option = st.radio(
                 "Filter",
-                ["Last", "1 W", "1 M", "3 M", "All"],
+                WINDOW_OPTIONS,
                 horizontal=True,
                 index=1  # default = 1 Week
             )
 
-            today = pd.Timestamp.today().normalize()
+            start_date = window_start(filter_option)  # "Last" → today
 
-            if filter_option == "Last":
-                start_date = today
-            elif filter_option == "1 W":
-                start_date = today - pd.Timedelta(days=7)
-            elif filter_option == "1 M":
-                start_date = today - pd.DateOffset(months=1)
-            elif filter_option == "3 M":
-                start_date = today - pd.DateOffset(months=3)
-            else:  # All
-                start_date = None
+            window = rollup_day_shift_window(bitran_rollups, start_date)
 
-            if start_date is not None:
-                df_bitran = df_bitran[df_bitran["Date"] >= start_date]
-
-
-        
-            df_bitran["MilkDelivered"] = (
-                pd.to_numeric(df_bitran["MilkDelivered"], errors="coerce")
-                .fillna(0)
-            )
-            
-
-        
             shift_order = {"Morning": 1, "Evening": 2}
 
             summary = (
-                df_bitran
-                .groupby(["Date", "Shift"])["MilkDelivered"]
-                .sum()
+                window["Qty"]
+                .rename("MilkDelivered")
                 .reset_index()
             )
 
@@ -4405,7 +7610,7 @@ else:
             summary = summary.sort_values(
                 by=["Date", "ShiftOrder"],
                 ascending=[False, False]  # latest date first, Evening after Morning
-            )
+            ).reset_index(drop=True)
 
             summary = summary.drop(columns=["ShiftOrder"])
             summary["MilkDelivered"] = summary["MilkDelivered"].round(2)
@@ -4451,6 +7656,7 @@ else:
     elif page == "Medicine":
 
         st.title("🧪 Medicine Master")
+        upload_failure_notice(MEDICATION_MASTER_TAB)
         
 
         if "medicine_view_mode" not in st.session_state:
@@ -4498,7 +7704,7 @@ else:
             medicine_df["TotalCost"] = pd.to_numeric(medicine_df["TotalCost"], errors="coerce").fillna(0)
             medicine_df["TotalUnits"] = pd.to_numeric(medicine_df["TotalUnits"], errors="coerce").fillna(0)
             medicine_df["CostPerDose"] = pd.to_numeric(medicine_df["CostPerDose"], errors="coerce").fillna(0)
-            medicine_df["StockAvailable"] = pd.to_numeric(medicine_df["StockAvailable"], errors="coerce").fillna(0)
+            medicine_df["StockAvailable"] = medicine_df["MedicineID"].map(load_medicine_stock()).fillna(0)
 
         # ======================================================
         # KPI SECTION
@@ -4617,14 +7823,13 @@ else:
                 now = dt.datetime.now()
                 med_id = f"MED{now.strftime('%Y%m%d%H%M%S%f')}"
 
-                image_url = ""
-                if image_file:
-                    image_url = upload_to_cloudinary(image_file,folder)
+                image_url = ""  # filled in by the upload worker
 
 
-                open_medicine_sheet().append_row(
-                    [
-                        f"MED{now.strftime('%Y%m%d%H%M%S%f')}",
+                # opening stock 0; the bought units go in as a PURCHASE movement
+                landed = save_journaled("medicine", [
+                    sheet_append(MEDICATION_MASTER_TAB, [[
+                        med_id,
                         name,
                         mtype,
                         applicable,
@@ -4636,15 +7841,21 @@ else:
                         total_cost,
                         total_units,
                         cost_per_dose,
-                        total_units,
+                        0,
                         "Active",
                         image_url,
                         notes,
                         st.session_state.user_name,
                         now.strftime("%Y-%m-%d %H:%M:%S")
-                    ],
-                    value_input_option="USER_ENTERED"
-                )
+                    ]]),
+                    *(
+                        [stock_movement(med_id, "PURCHASE", total_units, notes="Initial purchase")]
+                        if total_units else []
+                    ),
+                ])
+
+                if image_file:
+                    queue_upload(image_file, folder, [(MEDICATION_MASTER_TAB, landed_id(landed, MEDICATION_MASTER_TAB))])
 
                 st.cache_data.clear()
                 st.success("✅ Medicine added successfully")
@@ -4682,6 +7893,13 @@ else:
                         step=1.0
                     )
 
+                    purchased = st.number_input(
+                        "Units Purchased (restock)",
+                        min_value=0.0,
+                        value=0.0,
+                        step=1.0
+                    )
+
                 with col2:
                     total_cost = st.number_input(
                         "Total Cost (₹)",
@@ -4720,23 +7938,23 @@ else:
             if save:
                 cost_per_dose = round(total_cost / total_units, 2) if total_units else 0
 
-                ws = open_medicine_sheet()
                 row_idx = medicine_df.index[
                     medicine_df["MedicineID"] == med["MedicineID"]
                 ][0] + 2
 
-                ws.update(
-                    f"L{row_idx}:J{row_idx}",
-                    [[total_cost, total_units, cost_per_dose]]
-                )
-                ws.update(
-                    f"O{row_idx}:M{row_idx}",
-                    [[stock, status]]
-                )
-                ws.update(
-                    f"H{row_idx}:I{row_idx}",
-                    [[freq_value, freq_unit]]
-                )
+                # stock is never overwritten: a changed count is an ADJUSTMENT
+                adjustment = round(stock - float(med["StockAvailable"]), 4)
+                movements = []
+                if adjustment:
+                    movements.append(stock_movement(med["MedicineID"], "ADJUSTMENT", adjustment, notes="Stock count corrected"))
+                if purchased:
+                    movements.append(stock_movement(med["MedicineID"], "PURCHASE", purchased, notes="Restock"))
+
+                save_journaled("medicine_edit", movements + [
+                    sheet_update(MEDICATION_MASTER_TAB, f"J{row_idx}", [[total_cost, total_units, cost_per_dose]]),
+                    sheet_update(MEDICATION_MASTER_TAB, f"N{row_idx}", [[status]]),
+                    sheet_update(MEDICATION_MASTER_TAB, f"H{row_idx}", [[freq_value, freq_unit]]),
+                ])
 
                 st.cache_data.clear()
                 st.success("✅ Medicine updated")
@@ -4837,9 +8055,7 @@ else:
                 ">
                     <span>{status_badge}</span>
 
-                    {"<a href='" + r['MedicineImageURL'] + "' target='_blank' "
-                    "style='color:white;text-decoration:none;font-size:15px;'>📄</a>"
-                    if r.get("MedicineImageURL") else ""}
+                    {attachment_html(r.get("MedicineImageURL"), "📄", px=28, style="color:white;font-size:15px;")}
                 </div>
 
 
@@ -4870,39 +8086,6 @@ else:
         # ======================================================
         # HELPERS
         # ======================================================
-        def open_med_master():
-            return open_sheet(MAIN_SHEET_ID, MEDICATION_MASTER_TAB)
-
-        def open_med_log():
-            return open_sheet(MAIN_SHEET_ID, MEDICATION_LOG_TAB)
-
-        @st.cache_data(ttl=30)
-        def load_med_master():
-            ws = open_med_master()
-            rows = ws.get_all_values()
-            if len(rows) <= 1:
-                return pd.DataFrame()
-            return pd.DataFrame(rows[1:], columns=rows[0])
-
-        @st.cache_data(ttl=30)
-        def load_med_logs():
-            ws = open_med_log()
-            rows = ws.get_all_values()
-
-            # Sheet empty → initialize header
-            if not rows:
-                ws.insert_row(MEDICATION_LOG_HEADER, 1)
-                return pd.DataFrame(columns=MEDICATION_LOG_HEADER)
-
-            # Header exists but no data
-            if len(rows) == 1:
-                return pd.DataFrame(columns=rows[0])
-
-
-
-            return pd.DataFrame(rows[1:], columns=rows[0])
-
-
         @st.cache_data(ttl=60)
         def get_cows_df():
             """
@@ -4937,6 +8120,21 @@ else:
 
             return df
 
+        def next_due_date(med_row, base):
+            """NextDueDate for a dose of med_row given at `base` ("" unless Recurring)."""
+            if med_row["FrequencyType"] != "Recurring":
+                return ""
+            unit = med_row["FrequencyUnit"]
+            value = int(float(med_row["FrequencyValue"]))
+
+            if unit == "Days":
+                return base + pd.Timedelta(days=value)
+            elif unit == "Weeks":
+                return base + pd.Timedelta(weeks=value)
+            elif unit == "Months":
+                return base + pd.DateOffset(months=value)
+            return ""
+
         # ======================================================
         # LOAD DATA
         # ======================================================
@@ -4951,9 +8149,7 @@ else:
 
         # ---- clean numeric ----
         if not meds_df.empty:
-            meds_df["StockAvailable"] = pd.to_numeric(
-                meds_df["StockAvailable"], errors="coerce"
-            ).fillna(0)
+            meds_df["StockAvailable"] = meds_df["MedicineID"].map(load_medicine_stock()).fillna(0)
 
         if not logs_df.empty:
             logs_df["GivenOn"] = pd.to_datetime(logs_df["GivenOn"], errors="coerce")
@@ -4965,12 +8161,10 @@ else:
         st.subheader("📊 Overview")
 
         total_logs = len(logs_df)
-        pending_due = (
-            len(logs_df[logs_df["NextDueDate"] >= pd.Timestamp.today()])
-            if not logs_df.empty else 0
-        )
+        due_df = load_due_doses()
+        status_counts = due_df["Status"].value_counts()
 
-        k1, k2 = st.columns(2)
+        k1, k2, k3, k4 = st.columns(4)
 
         def kpi(title, value):
             st.markdown(
@@ -4985,13 +8179,23 @@ else:
             )
 
         with k1: kpi("Total Medications Given", total_logs)
-        with k2: kpi("Upcoming Doses", pending_due)
+        with k2: kpi("Overdue", int(status_counts.get("Overdue", 0)))
+        with k3: kpi("Due Today", int(status_counts.get("Due Today", 0)))
+        with k4: kpi(f"Upcoming ({DUE_SOON_DAYS}d)", int(status_counts.get("Upcoming", 0)))
 
         st.divider()
         if "show_give_medication" not in st.session_state:
             st.session_state.show_give_medication = False
-        if st.button("💉 Give Medication"):
+        if "show_batch_treatment" not in st.session_state:
+            st.session_state.show_batch_treatment = False
+
+        b1, b2 = st.columns(2)
+        if b1.button("💉 Give Medication", use_container_width=True):
             st.session_state.show_give_medication = not st.session_state.show_give_medication
+            st.session_state.show_batch_treatment = False
+        if b2.button("🐄🐄 Batch Treatment", use_container_width=True):
+            st.session_state.show_batch_treatment = not st.session_state.show_batch_treatment
+            st.session_state.show_give_medication = False
 
 
         # ======================================================
@@ -5118,17 +8322,7 @@ else:
                 now = pd.Timestamp.now()
 
                 # ---- NEXT DUE DATE ----
-                next_due = ""
-                if med_row["FrequencyType"] == "Recurring":
-                    unit = med_row["FrequencyUnit"]
-                    value = int(med_row["FrequencyValue"])
-
-                    if unit == "Days":
-                        next_due = now + pd.Timedelta(days=value)
-                    elif unit == "Weeks":
-                        next_due = now + pd.Timedelta(weeks=value)
-                    elif unit == "Months":
-                        next_due = now + pd.DateOffset(months=value)
+                next_due = next_due_date(med_row, now)
 
 
                 # --- SAFE DATE CONVERSION ---
@@ -5144,10 +8338,12 @@ else:
                     else ""
                 )
 
-                # ---- INSERT LOG ----
-                open_med_log().append_row(
-                    [
-                        f"MEDLOG{now.strftime('%Y%m%d%H%M%S%f')}",  # LogID
+                log_id = f"MEDLOG{now.strftime('%Y%m%d%H%M%S%f')}"
+
+                # ---- INSERT LOG + STOCK MOVEMENT (append-only) ----
+                save_journaled("medication", [
+                    sheet_append(MEDICATION_LOG_TAB, [[
+                        log_id,                                    # LogID
                         TagNumber,                                 # CowID
                         med_id,                                    # MedicineID
                         medicine_name,                             # MedicineName
@@ -5160,28 +8356,160 @@ else:
                         med_row["FrequencyUnit"],                  # FrequencyUnit
                         notes,                                     # Notes
                         next_due_str                               # NextDueDate (STRING)
-                    ],
-                    value_input_option="USER_ENTERED"
-                )
+                    ]]),
+                    stock_movement(med_id, "DOSE", -float(dose_given), ref_id=log_id, notes=TagNumber),
+                ])
+
+                st.cache_data.clear()
+                st.success("✅ Medication recorded & stock updated")
+                st.session_state.show_give_medication = False
+                st.query_params.clear()
+                st.rerun()
+
+            st.divider()
+
+        # ======================================================
+        # BATCH TREATMENT (ONE MEDICINE → MANY COWS)
+        # ======================================================
+        if st.session_state.show_batch_treatment:
+            st.subheader("🐄🐄 Batch Treatment")
 
+            med_id = st.selectbox(
+                "Select Medicine",
+                meds_df["MedicineID"].tolist(),
+                format_func=lambda x:
+                    meds_df.loc[meds_df["MedicineID"] == x, "MedicineName"].values[0],
+                key="batch_med_select"
+            )
+            med_row = meds_df[meds_df["MedicineID"] == med_id].iloc[0]
+            default_dose = pd.to_numeric(med_row["DefaultDose"], errors="coerce")
 
-                # ---- UPDATE STOCK ----
-                new_stock = med_row["StockAvailable"] - dose_given
-                row_idx = meds_df.index[meds_df["MedicineID"] == med_id][0] + 2
+            statuses = st.multiselect(
+                "Cow Status",
+                ["Active", "Sick"],
+                default=["Active"],
+                key="batch_status"
+            )
+            candidates = cows_df[cows_df["Status"].isin(statuses)]["TagNumber"].tolist()
 
-                open_med_master().update(
-                    f"M{row_idx}",
-                    [[new_stock]]
+            with st.form("batch_med_form"):
+                tags = st.multiselect(
+                    f"🐄 Cows ({len(candidates)} matching)",
+                    candidates,
+                    default=candidates
                 )
 
-                st.cache_data.clear()
-                st.success("✅ Medication recorded & stock updated")
-                st.session_state.show_give_medication = False
+                col1, col2 = st.columns(2)
+                with col1:
+                    dose_per_cow = st.number_input(
+                        f"💉 Dose per Cow ({med_row['DoseUnit']})",
+                        min_value=0.0,
+                        value=float(default_dose) if pd.notna(default_dose) else None,
+                        step=0.1
+                    )
+                with col2:
+                    givendate = st.date_input(
+                        "📅 Given Date",
+                        value=pd.Timestamp.today().date()
+                    )
+
+                notes = st.text_area("📝 Notes (optional)", height=80)
+
+                st.caption(f"📦 Stock Available: {med_row['StockAvailable']}")
+
+                c1, c2 = st.columns(2)
+                save = c1.form_submit_button("✅ Save Batch")
+                cancel = c2.form_submit_button("❌ Cancel")
+
+            if cancel:
+                st.session_state.show_batch_treatment = False
+                st.rerun()
+
+            if save:
+                if not tags:
+                    st.error("❌ Select at least one cow")
+                    st.stop()
+                if not dose_per_cow or dose_per_cow <= 0:
+                    st.error("❌ Dose must be greater than 0")
+                    st.stop()
+
+                # one stock check for the whole batch
+                total_dose = round(dose_per_cow * len(tags), 4)
+                if total_dose > float(med_row["StockAvailable"]):
+                    st.error(
+                        f"❌ Not enough stock: {len(tags)} cows × {dose_per_cow} = "
+                        f"{total_dose}, available {med_row['StockAvailable']}"
+                    )
+                    st.stop()
+
+                now = pd.Timestamp.now()
+                batch_id = f"MEDLOG{now.strftime('%Y%m%d%H%M%S%f')}"
+                next_due = next_due_date(med_row, now)
+                next_due_str = next_due.strftime("%Y-%m-%d") if next_due != "" else ""
+
+                log_rows = [
+                    [
+                        f"{batch_id}-{i:03d}",
+                        tag,
+                        med_id,
+                        med_row["MedicineName"],
+                        float(dose_per_cow),
+                        med_row["DoseUnit"],
+                        givendate.strftime("%Y-%m-%d"),
+                        st.session_state.user_name,
+                        med_row["FrequencyType"],
+                        med_row["FrequencyValue"],
+                        med_row["FrequencyUnit"],
+                        notes,
+                        next_due_str,
+                    ]
+                    for i, tag in enumerate(tags, start=1)
+                ]
+
+                save_journaled("medication_batch", [
+                    sheet_append(MEDICATION_LOG_TAB, log_rows),
+                    stock_movement(med_id, "DOSE", -total_dose, ref_id=batch_id, notes=f"Batch: {len(tags)} cows"),
+                ])
+
+                # only the medication sources changed
+                load_med_logs.clear()
+                load_med_stock.clear()
+                load_medicine_stock.clear()
+
+                st.success(f"✅ {med_row['MedicineName']} recorded for {len(tags)} cows")
+                st.session_state.show_batch_treatment = False
                 st.query_params.clear()
                 st.rerun()
 
             st.divider()
 
+        # ======================================================
+        # DUE DOSES
+        # ======================================================
+        st.subheader("🗓️ Due Doses")
+
+        if due_df.empty:
+            st.success(f"Nothing due in the next {DUE_SOON_DAYS} days.")
+        else:
+            for status, icon in [("Overdue", "🔴"), ("Due Today", "🟠"), ("Upcoming", "🟢")]:
+                part = due_df[due_df["Status"] == status]
+                if part.empty:
+                    continue
+                st.markdown(f"**{icon} {status} ({len(part)})**")
+                st.dataframe(
+                    pd.DataFrame({
+                        "Cow": part["CowID"],
+                        "Medicine": part["MedicineName"],
+                        "Last Given": part["LastGiven"].dt.date,
+                        "Due": part["NextDueDate"].dt.date,
+                        "Days": part["DaysLeft"],
+                    }),
+                    use_container_width=True,
+                    hide_index=True,
+                )
+
+        st.divider()
+
         # ======================================================
         # MEDICATION HISTORY
         # ======================================================
@@ -5261,7 +8589,7 @@ else:
         # ==================================================
         st.title("👤 My Profile")
 
-        user_df = auth_df[auth_df["userid"] == st.session_state.user_id].iloc[0]
+        user_df = find_user(userid=st.session_state.user_id)
 
         # ==================================================
         # HEADER ACTION BUTTONS
@@ -5405,16 +8733,15 @@ else:
 
             with c1:
                 if st.button("💾 Save Changes"):
-                    row_idx = (
-                        auth_df[auth_df["userid"] == st.session_state.user_id].index[0] + 2
-                    )
+                    row_idx = user_df["_row"]
 
                     AUTH_SHEET.update_cell(
-                        row_idx, get_col_index(auth_df, "email"), email
+                        row_idx, user_col("email"), email
                     )
                     AUTH_SHEET.update_cell(
-                        row_idx, get_col_index(auth_df, "phone"), phone
+                        row_idx, user_col("phone"), phone
                     )
+                    upsert_user(st.session_state.user_id, email=email, phone=phone)
 
                     st.cache_data.clear()
                     st.success("✅ Contact details updated")
@@ -5449,11 +8776,17 @@ else:
                         st.error("❌ Passwords do not match")
                         st.stop()
 
+                    hashed = hash_password(new_pass)
                     AUTH_SHEET.update_cell(
-                        auth_df[auth_df["userid"] == st.session_state.user_id].index[0] + 2,
-                        get_col_index(auth_df, "passwordhash"),
-                        hash_password(new_pass),
+                        user_df["_row"],
+                        user_col("passwordhash"),
+                        hashed,
                     )
+                    upsert_user(st.session_state.user_id, passwordhash=hashed)
+
+                    # sign out other devices; this one gets a fresh token
+                    revoke_user_sessions(st.session_state.user_id)
+                    st.session_state.session_token = issue_session_token(session_profile())
 
                     st.cache_data.clear()
                     st.success("✅ Password updated successfully")
@@ -5517,10 +8850,11 @@ else:
                     if st.form_submit_button("Create User"):
                         temp_password = generate_otp()
                         hashed = hash_password(temp_password)
+                        new_userid = f"U{int(datetime.now().timestamp())}"
 
                         AUTH_SHEET.append_row(
                             [
-                                f"U{int(datetime.now().timestamp())}",
+                                new_userid,
                                 username,
                                 name,
                                 email,
@@ -5534,24 +8868,94 @@ else:
                             ]
                         )
 
-                        load_auth_data.clear()
+                        upsert_user(
+                            new_userid,
+                            username=username,
+                            name=name,
+                            email=email,
+                            phone=phone,
+                            passwordhash=hashed,
+                            role=role,
+                            accesslevel=access,
+                            status="Active",
+                        )
 
-                        try:
-                            send_temp_password_email(email,name, username, temp_password)
-                            st.success("✅ User created & email sent")
-                        except:
-                            st.warning(
-                                "⚠️ User created, but email failed. Share password manually."
-                            )
+                        # kept until delivery is confirmed, so the admin can share it if the email fails
+                        st.session_state.new_user_mail = {
+                            "id": send_temp_password_email(email, name, username, temp_password),
+                            "email": email,
+                            "name": name,
+                            "username": username,
+                            "temp_password": temp_password,
+                        }
 
                         st.session_state.show_create_user = False
                         st.rerun()
 
+            # ---------- NEW USER EMAIL DELIVERY ----------
+            new_mail = st.session_state.get("new_user_mail")
+            if new_mail:
+                state, error = mail_status(new_mail["id"])
+                if state == "sent":
+                    st.success(f"✅ User {new_mail['username']} created & credentials emailed to {new_mail['email']}")
+                    st.session_state.pop("new_user_mail")
+                elif state == "queued":
+                    st.info(f"📨 User {new_mail['username']} created • sending credentials to {new_mail['email']}...")
+                    if st.button("🔄 Check email status"):
+                        st.rerun()
+                else:
+                    st.warning(
+                        f"⚠️ User {new_mail['username']} created, but the email failed ({error}). "
+                        f"Share the temporary password manually: **{new_mail['temp_password']}**"
+                    )
+                    c1, c2 = st.columns(2)
+                    if c1.button("📨 Resend email"):
+                        new_mail["id"] = send_temp_password_email(
+                            new_mail["email"], new_mail["name"], new_mail["username"], new_mail["temp_password"]
+                        )
+                        st.rerun()
+                    if c2.button("✔️ Shared manually"):
+                        st.session_state.pop("new_user_mail")
+                        st.rerun()
+
+            outbox = get_mail_queue()
+            with outbox["lock"]:
+                failed_mail = list(outbox["failed"])
+            if failed_mail:
+                with st.expander(f"📭 Undelivered emails ({len(failed_mail)})"):
+                    st.dataframe(pd.DataFrame(failed_mail), use_container_width=True, hide_index=True)
+
+            held = held_ops()
+            if held:
+                with st.expander(f"⏸️ Held sheet writes ({len(held)})"):
+                    st.caption("Saves that did not finish before a restart, whose cells were changed by someone else since. Applying writes the saved values over the current ones.")
+                    for op in held:
+                        st.markdown(f"**{op['key']}** • saved {op.get('created', '')}")
+                        st.dataframe(
+                            pd.DataFrame([
+                                {"Tab": w["tab"], "Write": w.get("range", "append"), "Values": json.dumps(w.get("values") or w.get("rows"))}
+                                for w in op["writes"]
+                            ]),
+                            use_container_width=True, hide_index=True,
+                        )
+                        c1, c2 = st.columns(2)
+                        if c1.button("✅ Apply anyway", key=f"held_apply_{op['key']}"):
+                            try:
+                                resolve_held_op(op["key"], apply=True)
+                            except Exception as e:
+                                st.error(f"❌ {e}")
+                                st.stop()
+                            st.cache_data.clear()
+                            st.rerun()
+                        if c2.button("🗑️ Discard", key=f"held_discard_{op['key']}"):
+                            resolve_held_op(op["key"], apply=False)
+                            st.rerun()
+
             # ---------- USER CARDS ----------
             st.subheader("👥 All Users")
 
             cols = st.columns(4)
-            for i, r in auth_df.iterrows():
+            for i, r in users_df().iterrows():
                 with cols[i % 4]:
                     status_color = "#22c55e" if r["status"] == "Active" else "#94a3b8"
                     role_color = "#38bdf8" if r["role"] == "Admin" else "#a78bfa"
@@ -5690,7 +9094,7 @@ else:
                 st.divider()
                 st.subheader("✏️ Edit User")
 
-                edit_df = auth_df[auth_df["userid"] == st.session_state.edit_user_id].iloc[0]
+                edit_df = find_user(userid=st.session_state.edit_user_id)
 
                 with st.form("admin_edit_user_form"):
 
@@ -5740,15 +9144,22 @@ else:
                     st.rerun()
 
                 if save:
-                    row_idx = auth_df[auth_df["userid"] == edit_df["userid"]].index[0] + 2
-
-                    AUTH_SHEET.update_cell(row_idx, get_col_index(auth_df, "name"), name)
-                    AUTH_SHEET.update_cell(row_idx, get_col_index(auth_df, "email"), email)
-                    AUTH_SHEET.update_cell(row_idx, get_col_index(auth_df, "phone"), phone)
-                    AUTH_SHEET.update_cell(row_idx, get_col_index(auth_df, "role"), role)
-                    AUTH_SHEET.update_cell(row_idx, get_col_index(auth_df, "accesslevel"), access)
-                    AUTH_SHEET.update_cell(row_idx, get_col_index(auth_df, "status"), status)
+                    row_idx = edit_df["_row"]
+
+                    AUTH_SHEET.update_cell(row_idx, user_col("name"), name)
+                    AUTH_SHEET.update_cell(row_idx, user_col("email"), email)
+                    AUTH_SHEET.update_cell(row_idx, user_col("phone"), phone)
+                    AUTH_SHEET.update_cell(row_idx, user_col("role"), role)
+                    AUTH_SHEET.update_cell(row_idx, user_col("accesslevel"), access)
+                    AUTH_SHEET.update_cell(row_idx, user_col("status"), status)
+                    upsert_user(
+                        edit_df["userid"],
+                        name=name, email=email, phone=phone,
+                        role=role, accesslevel=access, status=status,
+                    )
 
+                    # role / access / status changed: the user signs in again
+                    revoke_user_sessions(edit_df["userid"])
                     st.cache_data.clear()
 
                     st.success("✅ User updated successfully")
@@ -5760,6 +9171,7 @@ else:
     elif page == "Bank Account":
 
         st.title("🏦 Bank Account")
+        upload_failure_notice(BANK_TRANSACTION_TAB)
         
 
         bank_df = load_bank_transactions()
@@ -5803,7 +9215,8 @@ else:
             bank_df["ClosingBalance"] = pd.to_numeric(bank_df["ClosingBalance"], errors="coerce").fillna(0)
             bank_df["TransactionDate"] = pd.to_datetime(bank_df["TransactionDate"], errors="coerce")
 
-        current_balance = get_current_bank_balance(bank_df)
+        ledger = load_bank_ledger()
+        current_balance = bank_balance(ledger)
 
         # ==============================
         # KPI SECTION
@@ -5906,26 +9319,27 @@ else:
                     st.error("Amount must be greater than zero")
                     st.stop()
 
-                opening = get_current_bank_balance(bank_df)
+                # Recompute from the live sheet; opening is the balance as of txn_date
+                load_bank_transactions.clear()
+                load_bank_ledger.clear()
+                ledger = load_bank_ledger()
+                opening = balance_as_of(ledger, txn_date)
 
-                if txn_type == "DEBIT" and amount > opening:
+                if txn_type == "DEBIT" and amount > min_balance_from(ledger, txn_date):
                     st.error("❌ Debit exceeds bank balance")
                     st.stop()
 
                 closing = opening + amount if txn_type == "CREDIT" else opening - amount
 
-                doc_url = ""
-                if attachment:
-                    doc_url = upload_to_cloudinary(
-                        attachment,
-                        folder="dairy/BankTransaction"
-                    )
+                doc_url = ""  # filled in by the upload worker
 
                 now = pd.Timestamp.now()
                 bankTransactionId=f"BANKTXN{now.strftime('%Y%m%d%H%M%S%f')}"
                 ReferenceID=""
                 RelatedEntityType=""
 
+                writes = []
+
                 if category in ["USER_WALLET_CREDIT","USER_WALLET_DEBIT","CAPITAL_WITHDRAWAL","PROFIT_WITHDRAWAL"]:
                     ReferenceID=f"WTXN{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}"
                     RelatedEntityType="USER Wallet"
@@ -5934,78 +9348,80 @@ else:
                     elif txn_type=="CREDIT":
                         Wallet_txn_type="DEBIT"
                     # ---- WALLET TXN ----
-                    open_wallet_sheet().append_row(
-                            [
-                                ReferenceID,
-                                st.session_state.user_id,
-                                st.session_state.user_name,
-                                amount,
-                                Wallet_txn_type,
-                                bankTransactionId,
-                                f"Amount from {from_account} to {to_account}",
-                                dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                "COMPLETED"
-                            ],
-                            value_input_option="USER_ENTERED"
-                        )
+                    writes.append(sheet_append(WALLET_TRANSACTION_TAB, [[
+                        ReferenceID,
+                        st.session_state.user_id,
+                        st.session_state.user_name,
+                        amount,
+                        Wallet_txn_type,
+                        bankTransactionId,
+                        f"Amount from {from_account} to {to_account}",
+                        dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        "COMPLETED"
+                    ]]))
                     
                 if category=="EXPENSE":
-                    ReferenceID = f"EXP{dt.datetime.now().strftime('%Y%m%d%H%M%S')}"
+                    ReferenceID = f"EXP{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}"
                     RelatedEntityType="EXPENSE"
-                    open_expense_sheet().append_row(
-                        [
-                            ReferenceID,
-                            dt.datetime.now().strftime("%Y-%m-%d"),
-                            "Other",
-                            "All_COW",
-                            amount,
-                            "BANK ONLINE",
-                            "BANK ACCOUNT",
-                            doc_url,
-                            notes,
-                            dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        ],
-                        value_input_option="USER_ENTERED"
-                    )
+                    writes.append(sheet_append(EXPENSE_TAB, [[
+                        ReferenceID,
+                        dt.datetime.now().strftime("%Y-%m-%d"),
+                        "Other",
+                        "All COW",
+                        amount,
+                        "BANK ONLINE",
+                        "BANK ACCOUNT",
+                        doc_url,
+                        notes,
+                        dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    ]]))
                     
                 if category in ["CAPITAL_WITHDRAWAL","PROFIT_WITHDRAWAL"]:
-                    ReferenceID=f"INV{dt.datetime.now().strftime('%Y%m%d%H%M%S')}"
+                    ReferenceID=f"INV{dt.datetime.now().strftime('%Y%m%d%H%M%S%f')}"
                     RelatedEntityType="INVESTMENT"
-                    open_investment_sheet().append_row(
-                        [
-                            ReferenceID,
-                            dt.date.today().strftime("%Y-%m-%d"),
-                            "FROM BANK",
-                            amount,
-                            category,
-                            f"Personal Account : {st.session_state.user_name}",
-                            doc_url,
-                            notes,
-                            dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        ],
-                        value_input_option="USER_ENTERED",
-                    )
-
-                open_bank_sheet().append_row(
-                    [
-                        bankTransactionId,
-                        txn_date.strftime("%Y-%m-%d"),
-                        txn_type,
-                        category,
+                    writes.append(sheet_append(INVESTMENT_TAB, [[
+                        ReferenceID,
+                        dt.date.today().strftime("%Y-%m-%d"),
+                        "FROM BANK",
                         amount,
-                        from_account,
-                        to_account,
-                        RelatedEntityType,                 # RelatedEntityType (reserved)
-                        ReferenceID,                 # ReferenceID
+                        category,
+                        f"Personal Account : {st.session_state.user_name}",
+                        doc_url,
                         notes,
-                        opening,
-                        closing,
-                        st.session_state.user_name,
-                        now.strftime("%Y-%m-%d %H:%M:%S"),
-                        doc_url
-                    ],
-                    value_input_option="USER_ENTERED"
-                )
+                        dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    ]]))
+
+                writes.append(sheet_append(BANK_TRANSACTION_TAB, [[
+                    bankTransactionId,
+                    txn_date.strftime("%Y-%m-%d"),
+                    txn_type,
+                    category,
+                    amount,
+                    from_account,
+                    to_account,
+                    RelatedEntityType,                 # RelatedEntityType (reserved)
+                    ReferenceID,                 # ReferenceID
+                    notes,
+                    opening,
+                    closing,
+                    st.session_state.user_name,
+                    now.strftime("%Y-%m-%d %H:%M:%S"),
+                    doc_url
+                ]]))
+
+                # a back-dated row shifts the stored balances of every later row
+                writes += rebalance_writes(ledger, txn_date, amount if txn_type == "CREDIT" else -amount)
+
+                # wallet / expense / investment / bank rows (and the shifted balances) land together or not at all
+                landed = save_journaled("bank_txn", writes)
+
+                if attachment:
+                    # IDs from the landed payload: a retried save writes the first attempt's IDs
+                    doc_rows = [(BANK_TRANSACTION_TAB, landed_id(landed, BANK_TRANSACTION_TAB))]
+                    if RelatedEntityType in ("EXPENSE", "INVESTMENT"):
+                        tab = EXPENSE_TAB if RelatedEntityType == "EXPENSE" else INVESTMENT_TAB
+                        doc_rows.append((tab, landed_id(landed, tab)))
+                    queue_upload(attachment, "dairy/BankTransaction", doc_rows)
                 
 
                 st.cache_data.clear()
@@ -6021,10 +9437,37 @@ else:
         if bank_df.empty:
             st.info("No bank transactions recorded.")
         else:
-            # Sort by timestamp descending
-            bank_df = bank_df.sort_values("Timestamp", ascending=False)
+            statement_window = st.radio(
+                "Show",
+                WINDOW_OPTIONS,
+                index=len(WINDOW_OPTIONS) - 1,  # default = All
+                horizontal=True,
+                key="bank_statement_window"
+            )
+
+            # Slice the ledger's date index, then sort by timestamp descending
+            bank_view = date_window(ledger["rows"], window_start(statement_window))
+            bank_view = bank_view.sort_values("Timestamp", ascending=False)
+
+            if not ledger["undated"].empty:
+                st.warning(
+                    f"⚠️ {len(ledger['undated'])} row(s) have no TransactionDate or Timestamp and are left out "
+                    f"of the running balance: {', '.join(ledger['undated']['TransactionID'].astype(str))}"
+                )
+
+            mismatched = ledger["rows"][ledger["rows"]["Mismatch"]]
+            if not mismatched.empty:
+                with st.expander(f"⚠️ {len(mismatched)} row(s) with stored balances that disagree with the ledger"):
+                    st.dataframe(
+                        mismatched[[
+                            "SheetRow", "TransactionID", "TransactionDate", "Amount",
+                            "OpeningBalance", "CalcOpening", "ClosingBalance", "CalcClosing"
+                        ]].reset_index(drop=True),
+                        use_container_width=True,
+                        hide_index=True
+                    )
 
-            for _, r in bank_df.iterrows():
+            for _, r in bank_view.iterrows():
 
                 is_credit = r["TransactionType"] == "CREDIT"
 
@@ -6079,7 +9522,7 @@ else:
                         </div>
 
                         <div style="font-weight:700;color:#0f172a;">
-                            Bal: ₹ {float(r['ClosingBalance']):,.2f}
+                            Bal: ₹ {float(r['CalcClosing']):,.2f}
                         </div>
                     </div>
 
@@ -6102,6 +9545,102 @@ else:
 
                 components.html(row_html, height=90)
 
+    elif page == "Reports":
+
+        st.title("📑 Reports")
+
+        if st.button("🔄 Rebuild"):
+            store = get_report_store()
+            with store["lock"]:
+                store["pnl"].clear()
+                store["cash"].clear()
+                store["sigs"].clear()
+            st.cache_data.clear()
+            st.rerun()
+
+        report = st.radio("Statement", ["Profit & Loss", "Cash Flow", "Reconciliation"], horizontal=True)
+
+        # ======================================================
+        # RECONCILIATION (BACKGROUND JOB RESULTS)
+        # ======================================================
+        if report == "Reconciliation":
+            st.subheader("🧮 Ledger Reconciliation")
+            job = get_reconciliation_job()
+            with job["lock"]:
+                if not job["thread"].is_alive():
+                    job["error"] = job["error"] or "background worker stopped; restarted"
+                    start_reconciliation_worker(job)
+
+            if st.button("▶️ Run now"):
+                with st.spinner("Reconciling Billing, Payment, Wallet and Bank..."):
+                    try:
+                        run_reconciliation(job, init_gsheets())
+                    except Exception as e:
+                        st.error(f"❌ Reconciliation failed: {e}")
+
+            with job["lock"]:
+                result, ran_at, error, failed_at = job["result"], job["ran_at"], job["error"], job["failed_at"]
+
+            if error:
+                when = f" at {failed_at:%d %b %H:%M}" if failed_at else ""
+                st.warning(f"⚠️ Last background run failed{when}: {error} • it retries every {RECONCILE_EVERY // 60} min")
+
+            if result is None:
+                st.info("The first reconciliation run has not finished yet.")
+                st.stop()
+
+            st.caption(f"Last run: {ran_at:%d %b %Y %H:%M} • runs every {RECONCILE_EVERY // 60} min in the background")
+
+            issues = {name: df for name, df in result.items() if not df.empty}
+            if not issues:
+                st.success("✅ Billing, payments, wallet and bank agree")
+            for name, df in issues.items():
+                with st.expander(f"⚠️ {name} ({len(df)})"):
+                    st.dataframe(df, use_container_width=True, hide_index=True)
+            st.stop()
+
+        pnl_df, cash_df = load_reports()
+
+        if pnl_df.empty and cash_df.empty:
+            st.info("No transactions recorded yet.")
+            st.stop()
+
+        if report == "Profit & Loss":
+            st.subheader("📈 Monthly Profit & Loss")
+            st.caption("Billed by bill month • expenses by category • medicine counted as doses × cost per dose")
+
+            this_month = pnl_df.iloc[-1]
+            k1, k2, k3 = st.columns(3)
+            k1.metric("Billed (this month)", f"₹ {this_month['Billed']:,.0f}")
+            k2.metric("Expenses (this month)", f"₹ {this_month['Expenses']:,.0f}")
+            k3.metric("Profit (this month)", f"₹ {this_month['Profit']:,.0f}")
+
+            st.bar_chart(pnl_df[["Billed", "Expenses", "Profit"]].set_axis(pnl_df.index.strftime("%Y-%m")))
+            view = pnl_df
+        else:
+            st.subheader("💵 Monthly Cash Flow")
+            st.caption("Bank_Transaction in/out • completed wallet entries, excluding user-to-user transfers")
+
+            this_month = cash_df.iloc[-1]
+            k1, k2, k3 = st.columns(3)
+            k1.metric("Bank net (this month)", f"₹ {this_month['BankNet']:,.0f}")
+            k2.metric("Wallet net (this month)", f"₹ {this_month['WalletNet']:,.0f}")
+            k3.metric("Bank closing", f"₹ {this_month['BankClosing']:,.0f}")
+
+            st.bar_chart(cash_df[["BankNet", "WalletNet"]].set_axis(cash_df.index.strftime("%Y-%m")))
+            view = cash_df
+
+        view = view.sort_index(ascending=False)
+        view.index = view.index.strftime("%Y-%m")
+
+        st.dataframe(view.round(2), use_container_width=True)
+        st.download_button(
+            "⬇️ Download CSV",
+            view.to_csv().encode(),
+            file_name=f"{report.lower().replace(' & ', '_').replace(' ', '_')}.csv",
+            mime="text/csv"
+        )
+
     elif page == "My Wallet":
 
         st.title("👛 My Wallet")
@@ -6122,23 +9661,12 @@ else:
         # ----------------------------------
         # BALANCE CALCULATION
         # ----------------------------------
-        credit = my_df[
-            (my_df["TxnType"] == "CREDIT") &
-            (my_df["TxnStatus"] == "COMPLETED")
-        ]["Amount"].sum()
-
-        debit = my_df[
-            (my_df["TxnType"] == "DEBIT") &
-            (my_df["TxnStatus"] == "COMPLETED")
-        ]["Amount"].sum()
-
-        blocked = my_df[
-            (my_df["TxnType"] == "DEBIT") &
-            (my_df["TxnStatus"] == "PENDING")
-        ]["Amount"].sum()
+        wallet_store = refresh_wallet_balances(wallet_df)
+        my_balance = get_wallet_balance(user_id, wallet_store)
 
-        available_balance = credit - debit - blocked
-        total_balance = available_balance + blocked
+        blocked = my_balance["blocked"]
+        available_balance = my_balance["available"]
+        total_balance = my_balance["total"]
 
         # ----------------------------------
         # KPI SECTION
@@ -6178,13 +9706,9 @@ else:
 
             st.subheader("👥 Users Wallet Overview")
 
-            # Ensure numeric conversion
-            wallet_df["Amount"] = pd.to_numeric(wallet_df["Amount"], errors="coerce").fillna(0)
-
             # Exclude admin from list
-            non_admin_df = wallet_df[wallet_df["UserID"] != st.session_state.user_id].copy()
-
-            users = non_admin_df["UserID"].unique()
+            me = str(st.session_state.user_id).strip()
+            users = wallet_overview(wallet_store, exclude=me)
 
 
             cards_per_row = 3
@@ -6193,31 +9717,10 @@ else:
             for row in rows:
                 cols = st.columns(len(row))
 
-                for col, uid in zip(cols, row):
-
-                    u_df = non_admin_df[non_admin_df["UserID"] == uid]
-
-                    if u_df.empty:
-                        continue
-
-                    name = u_df["Name"].iloc[0]
-
-                    credit = u_df[
-                        (u_df["TxnType"] == "CREDIT") &
-                        (u_df["TxnStatus"] == "COMPLETED")
-                    ]["Amount"].sum()
-
-                    debit = u_df[
-                        (u_df["TxnType"] == "DEBIT") &
-                        (u_df["TxnStatus"] == "COMPLETED")
-                    ]["Amount"].sum()
+                for col, (uid, name, u_balance) in zip(cols, row):
 
-                    blocked = u_df[
-                        (u_df["TxnType"] == "DEBIT") &
-                        (u_df["TxnStatus"] == "PENDING")
-                    ]["Amount"].sum()
-
-                    available = credit - debit - blocked
+                    blocked = u_balance["blocked"]
+                    available = u_balance["available"]
 
                     with col:
                         st.markdown(
@@ -6252,15 +9755,8 @@ else:
         if "show_send_money" not in st.session_state:
             st.session_state.show_send_money = False
         # ---- Filter Dairy Users ----
-        dairy_users_df = auth_df[
-            auth_df["accesslevel"]
-            .fillna("")
-            .str.contains(r"\bdairy\b", case=False)
-        ][["userid", "name"]]
-
-        users_df = dairy_users_df[
-            dairy_users_df["userid"] != st.session_state.user_id
-        ]
+        dairy_df = dairy_users_df()
+        transfer_users = dairy_df[dairy_df["userid"] != st.session_state.user_id]
     
 
         
@@ -6272,20 +9768,17 @@ else:
 
             
 
-            if users_df.empty:
+            if transfer_users.empty:
                 st.warning("No users available to send money")
                 st.stop()
 
             to_user = st.selectbox(
                 "Send To",
-                users_df["userid"].tolist(),
-                format_func=lambda x:
-                    users_df.loc[users_df["userid"] == x, "name"].values[0]
+                transfer_users["userid"].tolist(),
+                format_func=user_name
             )
 
-            to_user_name = users_df.loc[
-                users_df["userid"] == to_user, "name"
-            ].values[0]
+            to_user_name = user_name(to_user)
 
             amount = st.number_input(
                 "Amount",
@@ -6376,10 +9869,7 @@ else:
             if not incoming.empty:
                 for _, r in incoming.iterrows():
 
-                    name = users_df.loc[
-                        users_df["userid"] == r["CounterpartyUserID"],
-                        "name"
-                    ].iloc[0]
+                    name = user_name(r["CounterpartyUserID"], r["CounterpartyUserID"])
 
                     col_text, col_btn1, col_btn2 = st.columns([6, 1.2, 1.2])
 
@@ -6405,33 +9895,20 @@ else:
 
                     with col_btn1:
                         if st.button("✅ Approve", key=f"ap_{r['TxnID']}"):
-                            ws = open_wallet_sheet()
-                            idxs = wallet_df[wallet_df["RefID"] == r["RefID"]].index + 2
-                            ws.update(
-                                f"I{idxs.min()}:I{idxs.max()}",
-                                [["COMPLETED"]] * len(idxs)
-                            )
+                            set_wallet_status(r["RefID"], "COMPLETED")
                             st.cache_data.clear()
                             st.rerun()
 
                     with col_btn2:
                         if st.button("❌ Reject", key=f"rej_{r['TxnID']}"):
-                            ws = open_wallet_sheet()
-                            idxs = wallet_df[wallet_df["RefID"] == r["RefID"]].index + 2
-                            ws.update(
-                                f"I{idxs.min()}:I{idxs.max()}",
-                                [["CANCELLED"]] * len(idxs)
-                            )
+                            set_wallet_status(r["RefID"], "CANCELLED")
                             st.cache_data.clear()
                             st.rerun()
 
             if not outgoing.empty:
                 for _, r in outgoing.iterrows():
 
-                    name = users_df.loc[
-                        users_df["userid"] == r["CounterpartyUserID"],
-                        "name"
-                    ].iloc[0]
+                    name = user_name(r["CounterpartyUserID"], r["CounterpartyUserID"])
 
                     col_text, col_btn = st.columns([7.2, 1.8])
 
@@ -6457,12 +9934,7 @@ else:
 
                     with col_btn:
                         if st.button("❌ Cancel", key=f"can_{r['TxnID']}"):
-                            ws = open_wallet_sheet()
-                            idxs = wallet_df[wallet_df["RefID"] == r["RefID"]].index + 2
-                            ws.update(
-                                f"I{idxs.min()}:I{idxs.max()}",
-                                [["CANCELLED"]] * len(idxs)
-                            )
+                            set_wallet_status(r["RefID"], "CANCELLED")
                             st.cache_data.clear()
                             st.rerun()
     
@@ -6530,6 +10002,77 @@ else:
 
             components.html(card_html, height=110)
 
+    # ----------------------------
+    # BENCHMARK PAGE (ADMIN)
+    # ----------------------------
+    elif page == "Benchmark":
+
+        st.title("⏱️ Benchmark")
+        st.caption("Times each page's data prep on synthetic sheets • nothing is read from or written to Google Sheets")
+
+        def scale_label(k):
+            s = BENCH_SCALES[k]
+            return f"{k} • {s['cows']} cows, {s['customers']} customers, {s['days']} days, {s['wallet_txns']:,} wallet txns"
+
+        c1, c2 = st.columns([3, 1])
+        scales = c1.multiselect("Scales", list(BENCH_SCALES), default=["S", "M"], format_func=scale_label)
+        repeat = c2.number_input("Repeats", min_value=1, max_value=10, value=BENCH_REPEAT)
+
+        if st.button("▶️ Run benchmark", disabled=not scales):
+            bar = st.progress(0.0)
+            report = run_benchmarks(scales, int(repeat), progress=lambda f, text: bar.progress(f, text=text))
+            save_benchmark_report(report)
+            st.success(f"✅ {len(report)} timings recorded • download the report below to keep them")
+
+        with st.expander("📂 Compare with an earlier report"):
+            earlier = st.file_uploader("Report CSV", type="csv", key="bench_import")
+            if earlier is not None and st.session_state.get("bench_imported") != earlier.file_id:
+                try:
+                    import_benchmark_report(earlier)
+                    st.session_state.bench_imported = earlier.file_id
+                except (ValueError, pd.errors.ParserError) as e:
+                    st.error(f"❌ {e}")
+
+        history = load_benchmark_history()
+        if history.empty:
+            st.info("No benchmark runs yet.")
+        else:
+            latest = compare_benchmarks(history)
+            st.subheader(f"📊 Latest run • {latest['RunAt'].iloc[0]}")
+            st.dataframe(
+                latest.pivot_table(index=["Page", "Step"], columns="Scale", values="BestMs", sort=False),
+                use_container_width=True,
+            )
+
+            with st.expander("🔁 Change vs previous run (best of repeats)"):
+                st.dataframe(
+                    latest[["Scale", "Page", "Step", "Rows", "PrevBestMs", "BestMs", "ChangePct"]],
+                    use_container_width=True, hide_index=True,
+                )
+
+            st.download_button(
+                "⬇️ Download report CSV",
+                history.to_csv(index=False).encode(),
+                file_name=BENCH_REPORT_FILE,
+                mime="text/csv",
+            )
+
+        st.divider()
+        st.subheader("🧪 Sample Data")
+        sample = st.selectbox("Scale", list(BENCH_SCALES), format_func=scale_label, key="bench_sample_scale")
+        if st.button("Generate sample sheets"):
+            with st.spinner("Generating..."):
+                st.session_state.bench_sample = (sample, synthetic_zip(synthetic_tabs(**BENCH_SCALES[sample])))
+
+        if st.session_state.get("bench_sample"):
+            name, data = st.session_state.bench_sample
+            st.download_button(
+                f"⬇️ Download {name} sheets (zip of CSVs)",
+                data,
+                file_name=f"synthetic_{name}.zip",
+                mime="application/zip",
+            )
+
     # ----------------------------
     # CHATBOT PAGE
     # ----------------------------